@@ -8,6 +8,7 @@ from config import stack, product_name, xray_enabled
 from aws_lambda import (
     lambda_get_emails,
     lambda_get_email,
+    lambda_get_email_summary,
     lambda_get_addresses,
     lambda_post_addresses,
     lambda_delete_email_item,
@@ -39,6 +40,7 @@ api_role = aws.iam.Role(
             policy=pulumi.Output.all(
                 lambda_get_emails=lambda_get_emails.arn,
                 lambda_get_email=lambda_get_email.arn,
+                lambda_get_email_summary=lambda_get_email_summary.arn,
                 lambda_get_addresses=lambda_get_addresses.arn,
                 lambda_post_addresses=lambda_post_addresses.arn,
                 lambda_delete_email_item=lambda_delete_email_item.arn,
@@ -63,6 +65,7 @@ api_role = aws.iam.Role(
                                 "Resource": [
                                     args["lambda_get_emails"],
                                     args["lambda_get_email"],
+                                    args["lambda_get_email_summary"],
                                     args["lambda_get_addresses"],
                                     args["lambda_post_addresses"],
                                     args["lambda_delete_email_item"],
@@ -214,6 +217,12 @@ api_address_get_method = aws.apigateway.Method(
     rest_api=api.id,
     authorizer_id=authorizer.id,
     authorization="COGNITO_USER_POOLS",
+    # Paging and extra fields of the email list, all optional
+    request_parameters={
+        "method.request.querystring.limit": False,
+        "method.request.querystring.cursor": False,
+        "method.request.querystring.fields": False,
+    },
 )
 api_address_get_method_integration = aws.apigateway.Integration(
     f"{local_name}_address_get_method_integration",
@@ -362,6 +371,78 @@ api_message_option_method_integration_response = aws.apigateway.IntegrationRespo
     opts=pulumi.ResourceOptions(parent=api_message_option_method_integration),
 )
 
+###address message summary###
+api_summary_resource = aws.apigateway.Resource(
+    f"{local_name}_summary_resource",
+    parent_id=api_message_resource.id,
+    path_part="summary",
+    rest_api=api.id,
+)
+
+api_summary_get_method = aws.apigateway.Method(
+    f"{local_name}_summary_get_method",
+    http_method="GET",
+    resource_id=api_summary_resource.id,
+    rest_api=api.id,
+    authorizer_id=authorizer.id,
+    authorization="COGNITO_USER_POOLS",
+)
+api_summary_get_method_integration = aws.apigateway.Integration(
+    f"{local_name}_summary_get_method_integration",
+    rest_api=api.id,
+    resource_id=api_summary_resource.id,
+    http_method=api_summary_get_method.http_method,
+    integration_http_method="POST",
+    type="AWS_PROXY",
+    uri=lambda_get_email_summary.invoke_arn,
+    credentials=api_role.arn,
+)
+
+api_summary_option_method = aws.apigateway.Method(
+    f"{local_name}_summary_option_method",
+    http_method="OPTIONS",
+    resource_id=api_summary_resource.id,
+    rest_api=api.id,
+    request_models={"application/json": "Empty"},
+    authorization="NONE",
+)
+api_summary_option_method_response = aws.apigateway.MethodResponse(
+    f"{local_name}_summary_option_method_response",
+    rest_api=api.id,
+    resource_id=api_summary_resource.id,
+    http_method=api_summary_option_method.http_method,
+    status_code="200",
+    response_parameters={
+        "method.response.header.Access-Control-Allow-Headers": True,
+        "method.response.header.Access-Control-Allow-Methods": True,
+        "method.response.header.Access-Control-Allow-Origin": True,
+        "method.response.header.Access-Control-Allow-Credentials": True,
+    },
+)
+api_summary_option_method_integration = aws.apigateway.Integration(
+    f"{local_name}_summary_option_method_integration",
+    rest_api=api.id,
+    resource_id=api_summary_resource.id,
+    http_method=api_summary_option_method.http_method,
+    type="MOCK",
+    request_templates={"application/json": '{"statusCode": 200}'},
+    passthrough_behavior="WHEN_NO_MATCH",
+)
+api_summary_option_method_integration_response = aws.apigateway.IntegrationResponse(
+    f"{local_name}_summary_option_method_integration_response",
+    status_code="200",
+    rest_api=api.id,
+    resource_id=api_summary_resource.id,
+    http_method=api_summary_option_method.http_method,
+    response_parameters={
+        "method.response.header.Access-Control-Allow-Headers": "'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token'",
+        "method.response.header.Access-Control-Allow-Methods": "'GET,OPTIONS'",
+        "method.response.header.Access-Control-Allow-Origin": "'*'",
+    },
+    response_templates={"application/json": ""},
+    opts=pulumi.ResourceOptions(parent=api_summary_option_method_integration),
+)
+
 # API Gateway Stage and Deployment
 api_deployment = aws.apigateway.Deployment(
     f"{local_name}_deployment",
@@ -390,6 +471,11 @@ api_deployment = aws.apigateway.Deployment(
             api_message_option_method_integration_response,
             api_message_delete_method,
             api_message_delete_method_integration,
+            api_summary_get_method,
+            api_summary_get_method_integration,
+            api_summary_option_method,
+            api_summary_option_method_integration,
+            api_summary_option_method_integration_response,
         ]
     ),
 )
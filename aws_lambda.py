@@ -1,4 +1,5 @@
 import json
+import secrets
 import pulumi
 import pulumi_aws as aws
 from shared.aws.tagging import register_standard_tags
@@ -11,11 +12,33 @@ from config import (
     ses_email_domain,
     log_level,
     xray_enabled,
+    attachment_streaming_threshold,
+    attachment_upload_workers,
+    ingest_batch_size,
+    ingest_batching_window_seconds,
+    ingest_max_concurrency,
+    start_execution_workers,
+    incoming_mail_pipeline,
+    fused_pipeline_workers,
+    fused_pipeline_batch_size,
+    ingest_layout,
+    stored_body_encoding,
+    summary_cache_ttl,
+    similar_summary_threshold,
+    summary_max_concurrency,
+    summary_tokens_per_minute,
+    summary_read_deadline_seconds,
+    address_cache_size,
+    address_cache_ttl,
+    address_negative_cache_ttl,
+    address_feed_poll_seconds,
+    address_filter_enabled,
+    address_counter_reconcile_schedule,
     LAMBDA_TIMEOUT,
     LAMBDA_PYTHON_VERSION,
 )
 from common import cw_log_group
-from dynamodb import table_addresses, table_emails
+from dynamodb import table_addresses, table_emails, table_blobs, table_summary_cache
 from s3 import bucket_emails
 
 register_standard_tags(environment=stack)
@@ -31,6 +54,16 @@ lambda_code_layer = aws.lambda_.LayerVersion(
 )
 local_archive = pulumi.FileArchive("./lambda")
 
+# Signs the page cursors of the email list API. Generated once, later
+# deployments keep the stored value so issued cursors stay valid
+cursor_key_parameter = aws.ssm.Parameter(
+    f"{local_name}_cursor_key",
+    name=f"/{product_name}/cursor_key",
+    type="SecureString",
+    value=secrets.token_urlsafe(32),
+    opts=pulumi.ResourceOptions(ignore_changes=["value"]),
+)
+
 lambda_role = aws.iam.Role(
     f"{local_name}_role",
     assume_role_policy=json.dumps(
@@ -71,6 +104,8 @@ lambda_role = aws.iam.Role(
             policy=pulumi.Output.all(
                 emails_table_arn=table_emails.arn,
                 address_table_arn=table_addresses.arn,
+                blobs_table_arn=table_blobs.arn,
+                summary_cache_table_arn=table_summary_cache.arn,
                 email_bucket_arn=bucket_emails.arn,
             ).apply(
                 lambda args: json.dumps(
@@ -86,12 +121,22 @@ lambda_role = aws.iam.Role(
                                     "dynamodb:DeleteItem",
                                     "dynamodb:Scan",
                                     "dynamodb:Query",
+                                    "dynamodb:BatchGetItem",
+                                    "dynamodb:BatchWriteItem",
+                                    "dynamodb:DescribeTable",
+                                    "dynamodb:DescribeStream",
+                                    "dynamodb:GetRecords",
+                                    "dynamodb:GetShardIterator",
+                                    "dynamodb:ListStreams",
                                 ],
                                 "Resource": [
                                     args["emails_table_arn"],
                                     args["address_table_arn"],
                                     f"{args['emails_table_arn']}/*",
                                     f"{args['address_table_arn']}/*",
+                                    args["blobs_table_arn"],
+                                    f"{args['blobs_table_arn']}/*",
+                                    args["summary_cache_table_arn"],
                                 ],
                             },
                             {
@@ -100,6 +145,7 @@ lambda_role = aws.iam.Role(
                                     "s3:GetObject*",
                                     "s3:PutObject*",
                                     "s3:DeleteObject*",
+                                    "s3:AbortMultipartUpload",
                                     "s3:ListBucket",
                                 ],
                                 "Resource": [
@@ -109,9 +155,34 @@ lambda_role = aws.iam.Role(
                             },
                             {
                                 "Effect": "Allow",
-                                "Action": ["bedrock:InvokeModel"],
+                                "Action": [
+                                    "bedrock:InvokeModel",
+                                    "bedrock:InvokeModelWithResponseStream",
+                                ],
                                 "Resource": ["*"],
                             },
+                            {
+                                "Effect": "Allow",
+                                "Action": [
+                                    "sqs:ReceiveMessage",
+                                    "sqs:DeleteMessage",
+                                    "sqs:GetQueueAttributes",
+                                    "sqs:SendMessage",
+                                    "sqs:ChangeMessageVisibility",
+                                ],
+                                "Resource": [
+                                    f"arn:aws:sqs:{aws_region}:{aws_account_id}:{local_name}_ingest_queue",
+                                    f"arn:aws:sqs:{aws_region}:{aws_account_id}:{local_name}_summary_queue",
+                                    f"arn:aws:sqs:{aws_region}:{aws_account_id}:{local_name}_address_changes_dlq",
+                                ],
+                            },
+                            {
+                                "Effect": "Allow",
+                                "Action": ["ssm:GetParameter"],
+                                "Resource": [
+                                    f"arn:aws:ssm:{aws_region}:{aws_account_id}:parameter/{product_name}/cursor_key"
+                                ],
+                            },
                             {
                                 "Effect": "Allow",
                                 "Action": [
@@ -142,6 +213,12 @@ lambda_check_incoming_address = aws.lambda_.Function(
             "XRAY_NAME": product_name,
             "ADDRESS_TABLE_NAME": table_addresses.name,
             "EMAILS_TABLE_NAME": table_emails.name,
+            "ADDRESS_INDEX_BUCKET": bucket_emails.bucket,
+            "ADDRESS_CACHE_SIZE": address_cache_size,
+            "ADDRESS_CACHE_TTL": address_cache_ttl,
+            "ADDRESS_NEGATIVE_CACHE_TTL": address_negative_cache_ttl,
+            "ADDRESS_FEED_POLL_SECONDS": address_feed_poll_seconds,
+            "ADDRESS_FILTER_ENABLED": address_filter_enabled,
         }
     ),
     timeout=LAMBDA_TIMEOUT,
@@ -169,6 +246,72 @@ aws.lambda_.Permission(
     source_account=aws_account_id,
 )
 
+lambda_address_changes = aws.lambda_.Function(
+    f"{local_name}_address_changes",
+    runtime=LAMBDA_PYTHON_VERSION,
+    memory_size=128,
+    description="Publish address table changes and filter for the SES receipt check",
+    handler="ddb_address_changes_function.lambda_handler",
+    role=lambda_role.arn,
+    environment=aws.lambda_.FunctionEnvironmentArgs(
+        variables={
+            "LOG_LEVEL": log_level,
+            "XRAY_ENABLED": xray_enabled,
+            "XRAY_NAME": product_name,
+            "ADDRESS_TABLE_NAME": table_addresses.name,
+            "ADDRESS_INDEX_BUCKET": bucket_emails.bucket,
+        }
+    ),
+    timeout=LAMBDA_TIMEOUT,
+    layers=[lambda_code_layer.arn],
+    tracing_config=(
+        aws.lambda_.FunctionTracingConfigArgs(mode="Active")
+        if xray_enabled.lower() == "true"
+        else None
+    ),
+    code=local_archive,
+    logging_config=aws.lambda_.FunctionLoggingConfigArgs(
+        log_format="JSON",
+        application_log_level=log_level,
+        system_log_level=log_level,
+        log_group=cw_log_group.name,
+    ),
+    opts=pulumi.ResourceOptions(depends_on=[cw_log_group]),
+)
+
+# Records of batches that keep failing, so they stop blocking the shard
+address_changes_dead_letter_queue = aws.sqs.Queue(
+    f"{local_name}_address_changes_dlq",
+    name=f"{local_name}_address_changes_dlq",
+    message_retention_seconds=14 * 24 * 60 * 60,
+)
+aws.lambda_.EventSourceMapping(
+    f"{local_name}_address_changes_stream",
+    event_source_arn=table_addresses.stream_arn,
+    function_name=lambda_address_changes.arn,
+    starting_position="LATEST",
+    batch_size=100,
+    maximum_batching_window_in_seconds=1,
+    # The feed is rewritten as a whole, keep a single writer
+    parallelization_factor=1,
+    maximum_retry_attempts=5,
+    bisect_batch_on_function_error=True,
+    # Counter updates modify the address item on every ingest, read and
+    # delete, only created and deleted addresses matter here
+    filter_criteria=aws.lambda_.EventSourceMappingFilterCriteriaArgs(
+        filters=[
+            aws.lambda_.EventSourceMappingFilterCriteriaFilterArgs(
+                pattern=json.dumps({"eventName": ["INSERT", "REMOVE"]}),
+            )
+        ],
+    ),
+    destination_config=aws.lambda_.EventSourceMappingDestinationConfigArgs(
+        on_failure=aws.lambda_.EventSourceMappingDestinationConfigOnFailureArgs(
+            destination_arn=address_changes_dead_letter_queue.arn,
+        ),
+    ),
+)
+
 lambda_store_email = aws.lambda_.Function(
     f"{local_name}_store_email",
     runtime=LAMBDA_PYTHON_VERSION,
@@ -183,6 +326,7 @@ lambda_store_email = aws.lambda_.Function(
             "XRAY_NAME": product_name,
             "ADDRESS_TABLE_NAME": table_addresses.name,
             "EMAILS_TABLE_NAME": table_emails.name,
+            "INGEST_LAYOUT": ingest_layout,
         }
     ),
     timeout=LAMBDA_TIMEOUT,
@@ -206,7 +350,7 @@ lambda_start_incoming_mail = aws.lambda_.Function(
     f"{local_name}_start_incoming_mail",
     runtime=LAMBDA_PYTHON_VERSION,
     memory_size=128,
-    description="SNS starts incoming email state machine",
+    description="Ingest queue starts incoming email state machine",
     handler="sns_start_incoming_mail_sm_function.lambda_handler",
     role=lambda_role.arn,
     environment=aws.lambda_.FunctionEnvironmentArgs(
@@ -214,6 +358,7 @@ lambda_start_incoming_mail = aws.lambda_.Function(
             "LOG_LEVEL": log_level,
             "XRAY_ENABLED": xray_enabled,
             "XRAY_NAME": product_name,
+            "START_EXECUTION_WORKERS": start_execution_workers,
             "INCOMING_MAIL_STATE_MACHINE_ARN": f"arn:aws:states:{aws_region}:{aws_account_id}:stateMachine:{local_name}_sm_incoming_mail",
         }
     ),
@@ -239,11 +384,51 @@ lambda_sns_check_incoming_address_topic = aws.sns.Topic(
     display_name="Store Successful Incoming Email Topic",
     tracing_config="Active" if xray_enabled.lower() == "true" else None,
 )
+
+# Notifications are buffered so bursts are drained in batches
+ingest_dead_letter_queue = aws.sqs.Queue(
+    f"{local_name}_ingest_dlq",
+    name=f"{local_name}_ingest_dlq",
+    message_retention_seconds=14 * 24 * 60 * 60,
+)
+ingest_queue = aws.sqs.Queue(
+    f"{local_name}_ingest_queue",
+    name=f"{local_name}_ingest_queue",
+    # AWS recommends six times the function timeout
+    visibility_timeout_seconds=LAMBDA_TIMEOUT * 6,
+    redrive_policy=ingest_dead_letter_queue.arn.apply(
+        lambda arn: json.dumps({"deadLetterTargetArn": arn, "maxReceiveCount": 5})
+    ),
+)
+aws.sqs.QueuePolicy(
+    f"{local_name}_ingest_queue_policy",
+    queue_url=ingest_queue.url,
+    policy=pulumi.Output.all(
+        ingest_queue_arn=ingest_queue.arn,
+        topic_arn=lambda_sns_check_incoming_address_topic.arn,
+    ).apply(
+        lambda args: json.dumps(
+            {
+                "Version": "2012-10-17",
+                "Statement": [
+                    {
+                        "Effect": "Allow",
+                        "Principal": {"Service": "sns.amazonaws.com"},
+                        "Action": "sqs:SendMessage",
+                        "Resource": args["ingest_queue_arn"],
+                        "Condition": {"ArnEquals": {"aws:SourceArn": args["topic_arn"]}},
+                    }
+                ],
+            }
+        )
+    ),
+)
 lambda_sns_incoming_mail_topic_subscription = aws.sns.TopicSubscription(
     f"{local_name}_sns_check_incoming_address_topic_subscription",
     topic=lambda_sns_check_incoming_address_topic.arn,
-    protocol="lambda",
-    endpoint=lambda_start_incoming_mail.arn,
+    protocol="sqs",
+    endpoint=ingest_queue.arn,
+    raw_message_delivery=True,
 )
 
 lambda_sns_incoming_mail_topic_policy = aws.sns.TopicPolicy(
@@ -273,14 +458,6 @@ lambda_sns_incoming_mail_topic_policy = aws.sns.TopicPolicy(
     ),
 )
 
-aws.lambda_.Permission(
-    f"{local_name}_sns_start_incoming_mail_state_machine_permission",
-    action="lambda:InvokeFunction",
-    function=lambda_start_incoming_mail.arn,
-    principal="sns.amazonaws.com",
-    source_arn=lambda_sns_check_incoming_address_topic.arn,
-)
-
 lambda_get_emails = aws.lambda_.Function(
     f"{local_name}_get_emails",
     runtime=LAMBDA_PYTHON_VERSION,
@@ -294,6 +471,7 @@ lambda_get_emails = aws.lambda_.Function(
             "XRAY_NAME": product_name,
             "EMAILS_TABLE_NAME": table_emails.name,
             "ADDRESS_TABLE_NAME": table_addresses.name,
+            "CURSOR_KEY_PARAMETER": cursor_key_parameter.name,
         }
     ),
     timeout=LAMBDA_TIMEOUT,
@@ -388,6 +566,7 @@ lambda_delete_address = aws.lambda_.Function(
             "XRAY_ENABLED": xray_enabled,
             "XRAY_NAME": product_name,
             "EMAILS_TABLE_NAME": table_emails.name,
+            "BLOBS_TABLE_NAME": table_blobs.name,
             "ADDRESS_TABLE_NAME": table_addresses.name,
         }
     ),
@@ -420,6 +599,7 @@ lambda_delete_email_item = aws.lambda_.Function(
             "XRAY_ENABLED": xray_enabled,
             "XRAY_NAME": product_name,
             "EMAILS_TABLE_NAME": table_emails.name,
+            "BLOBS_TABLE_NAME": table_blobs.name,
             "ADDRESS_TABLE_NAME": table_addresses.name,
         }
     ),
@@ -440,12 +620,65 @@ lambda_delete_email_item = aws.lambda_.Function(
     opts=pulumi.ResourceOptions(depends_on=[cw_log_group]),
 )
 
+# Summaries are made after the email is visible, throttled jobs wait in the queue
+SUMMARY_TIMEOUT = LAMBDA_TIMEOUT + 120
+summary_dead_letter_queue = aws.sqs.Queue(
+    f"{local_name}_summary_dlq",
+    name=f"{local_name}_summary_dlq",
+    message_retention_seconds=14 * 24 * 60 * 60,
+)
+summary_queue = aws.sqs.Queue(
+    f"{local_name}_summary_queue",
+    name=f"{local_name}_summary_queue",
+    visibility_timeout_seconds=SUMMARY_TIMEOUT * 6,
+    message_retention_seconds=2 * 24 * 60 * 60,
+    # Every throttled attempt counts as a receive
+    redrive_policy=summary_dead_letter_queue.arn.apply(
+        lambda arn: json.dumps({"deadLetterTargetArn": arn, "maxReceiveCount": 12})
+    ),
+)
+
 lambda_get_email = aws.lambda_.Function(
     f"{local_name}_get_email",
     runtime=LAMBDA_PYTHON_VERSION,
     description="Get contents of a specific email for a user",
     handler="api_get_email_function.lambda_handler",
     role=lambda_role.arn,
+    environment=aws.lambda_.FunctionEnvironmentArgs(
+        variables={
+            "LOG_LEVEL": log_level,
+            "XRAY_ENABLED": xray_enabled,
+            "XRAY_NAME": product_name,
+            "EMAILS_TABLE_NAME": table_emails.name,
+            "ADDRESS_TABLE_NAME": table_addresses.name,
+            "SUMMARY_QUEUE_URL": summary_queue.url,
+            "SUMMARY_READ_DEADLINE_SECONDS": summary_read_deadline_seconds,
+        }
+    ),
+    timeout=LAMBDA_TIMEOUT,
+    layers=[lambda_code_layer.arn],
+    tracing_config=(
+        aws.lambda_.FunctionTracingConfigArgs(mode="Active")
+        if xray_enabled.lower() == "true"
+        else None
+    ),
+    code=local_archive,
+    logging_config=aws.lambda_.FunctionLoggingConfigArgs(
+        log_format="JSON",
+        application_log_level=log_level,
+        system_log_level=log_level,
+        log_group=cw_log_group.name,
+    ),
+    opts=pulumi.ResourceOptions(depends_on=[cw_log_group]),
+)
+
+lambda_get_email_summary = aws.lambda_.Function(
+    f"{local_name}_get_email_summary",
+    runtime=LAMBDA_PYTHON_VERSION,
+    memory_size=128,
+    description="Get the summary of an email, polled while it is generated",
+    handler="api_get_email_summary_function.lambda_handler",
+    role=lambda_role.arn,
     environment=aws.lambda_.FunctionEnvironmentArgs(
         variables={
             "LOG_LEVEL": log_level,
@@ -485,6 +718,10 @@ lambda_store_attachments = aws.lambda_.Function(
             "XRAY_ENABLED": xray_enabled,
             "XRAY_NAME": product_name,
             "EMAILS_TABLE_NAME": table_emails.name,
+            "BLOBS_TABLE_NAME": table_blobs.name,
+            "ATTACHMENT_STREAMING_THRESHOLD": attachment_streaming_threshold,
+            "ATTACHMENT_UPLOAD_WORKERS": attachment_upload_workers,
+            "STORED_BODY_ENCODING": stored_body_encoding,
         }
     ),
     timeout=LAMBDA_TIMEOUT,
@@ -508,8 +745,60 @@ lambda_summarize_email = aws.lambda_.Function(
     f"{local_name}_summarize_email",
     runtime=LAMBDA_PYTHON_VERSION,
     memory_size=512,
-    description="Summarize incoming emails",
-    handler="sm_summarize_email_function.lambda_handler",
+    description="Summary queue worker for incoming emails",
+    handler="sqs_summarize_email_function.lambda_handler",
+    role=lambda_role.arn,
+    environment=aws.lambda_.FunctionEnvironmentArgs(
+        variables={
+            "LOG_LEVEL": log_level,
+            "XRAY_ENABLED": xray_enabled,
+            "XRAY_NAME": product_name,
+            "EMAILS_TABLE_NAME": table_emails.name,
+            "ADDRESS_TABLE_NAME": table_addresses.name,
+            "SUMMARY_CACHE_TABLE_NAME": table_summary_cache.name,
+            "SUMMARY_CACHE_TTL": summary_cache_ttl,
+            "SIMILAR_SUMMARY_THRESHOLD": similar_summary_threshold,
+            "SUMMARY_QUEUE_URL": summary_queue.url,
+            "SUMMARY_TOKENS_PER_MINUTE": summary_tokens_per_minute,
+            "SUMMARY_MAX_CONCURRENCY": str(summary_max_concurrency),
+        }
+    ),
+    timeout=SUMMARY_TIMEOUT,
+    layers=[lambda_code_layer.arn],
+    tracing_config=(
+        aws.lambda_.FunctionTracingConfigArgs(mode="Active")
+        if xray_enabled.lower() == "true"
+        else None
+    ),
+    code=local_archive,
+    logging_config=aws.lambda_.FunctionLoggingConfigArgs(
+        log_format="JSON",
+        application_log_level=log_level,
+        system_log_level=log_level,
+        log_group=cw_log_group.name,
+    ),
+    opts=pulumi.ResourceOptions(depends_on=[cw_log_group]),
+)
+
+aws.lambda_.EventSourceMapping(
+    f"{local_name}_summary_queue_summarize_email",
+    event_source_arn=summary_queue.arn,
+    function_name=lambda_summarize_email.arn,
+    # One model call per invoke, the concurrency limit is the Bedrock limit
+    batch_size=1,
+    function_response_types=["ReportBatchItemFailures"],
+    scaling_config=aws.lambda_.EventSourceMappingScalingConfigArgs(
+        maximum_concurrency=summary_max_concurrency
+    ),
+)
+
+
+lambda_mark_processed = aws.lambda_.Function(
+    f"{local_name}_mark_processed",
+    runtime=LAMBDA_PYTHON_VERSION,
+    memory_size=128,
+    description="Mark incoming emails processed and queue their summary",
+    handler="sm_mark_processed_function.lambda_handler",
     role=lambda_role.arn,
     environment=aws.lambda_.FunctionEnvironmentArgs(
         variables={
@@ -518,9 +807,10 @@ lambda_summarize_email = aws.lambda_.Function(
             "XRAY_NAME": product_name,
             "EMAILS_TABLE_NAME": table_emails.name,
             "ADDRESS_TABLE_NAME": table_addresses.name,
+            "SUMMARY_QUEUE_URL": summary_queue.url,
         }
     ),
-    timeout=LAMBDA_TIMEOUT + 120,
+    timeout=LAMBDA_TIMEOUT,
     layers=[lambda_code_layer.arn],
     tracing_config=(
         aws.lambda_.FunctionTracingConfigArgs(mode="Active")
@@ -538,6 +828,189 @@ lambda_summarize_email = aws.lambda_.Function(
 )
 
 
+# Run by hand to compress emails stored before compression, see README
+lambda_compress_stored_emails = aws.lambda_.Function(
+    f"{local_name}_compress_stored_emails",
+    runtime=LAMBDA_PYTHON_VERSION,
+    memory_size=1024,
+    description="Backfill job compressing stored emails",
+    handler="job_compress_stored_emails_function.lambda_handler",
+    role=lambda_role.arn,
+    environment=aws.lambda_.FunctionEnvironmentArgs(
+        variables={
+            "LOG_LEVEL": log_level,
+            "XRAY_ENABLED": xray_enabled,
+            "XRAY_NAME": product_name,
+            "EMAILS_TABLE_NAME": table_emails.name,
+        }
+    ),
+    timeout=900,
+    layers=[lambda_code_layer.arn],
+    tracing_config=(
+        aws.lambda_.FunctionTracingConfigArgs(mode="Active")
+        if xray_enabled.lower() == "true"
+        else None
+    ),
+    code=local_archive,
+    logging_config=aws.lambda_.FunctionLoggingConfigArgs(
+        log_format="JSON",
+        application_log_level=log_level,
+        system_log_level=log_level,
+        log_group=cw_log_group.name,
+    ),
+    opts=pulumi.ResourceOptions(depends_on=[cw_log_group]),
+)
+pulumi.export("compress_stored_emails_function", lambda_compress_stored_emails.name)
+
+
+# Run by hand to add the attributes the list index needs to older emails, see README
+lambda_backfill_email_list_fields = aws.lambda_.Function(
+    f"{local_name}_backfill_email_list_fields",
+    runtime=LAMBDA_PYTHON_VERSION,
+    memory_size=256,
+    description="Backfill job adding the list index attributes to emails",
+    handler="job_backfill_email_list_fields_function.lambda_handler",
+    role=lambda_role.arn,
+    environment=aws.lambda_.FunctionEnvironmentArgs(
+        variables={
+            "LOG_LEVEL": log_level,
+            "XRAY_ENABLED": xray_enabled,
+            "XRAY_NAME": product_name,
+            "EMAILS_TABLE_NAME": table_emails.name,
+        }
+    ),
+    timeout=900,
+    layers=[lambda_code_layer.arn],
+    tracing_config=(
+        aws.lambda_.FunctionTracingConfigArgs(mode="Active")
+        if xray_enabled.lower() == "true"
+        else None
+    ),
+    code=local_archive,
+    logging_config=aws.lambda_.FunctionLoggingConfigArgs(
+        log_format="JSON",
+        application_log_level=log_level,
+        system_log_level=log_level,
+        log_group=cw_log_group.name,
+    ),
+    opts=pulumi.ResourceOptions(depends_on=[cw_log_group]),
+)
+pulumi.export("backfill_email_list_fields_function", lambda_backfill_email_list_fields.name)
+
+
+# Recounts the address counters on a schedule, see README
+lambda_reconcile_address_counters = aws.lambda_.Function(
+    f"{local_name}_reconcile_address_counters",
+    runtime=LAMBDA_PYTHON_VERSION,
+    memory_size=256,
+    description="Repairs drift in the email counters of addresses",
+    handler="job_reconcile_address_counters_function.lambda_handler",
+    role=lambda_role.arn,
+    environment=aws.lambda_.FunctionEnvironmentArgs(
+        variables={
+            "LOG_LEVEL": log_level,
+            "XRAY_ENABLED": xray_enabled,
+            "XRAY_NAME": product_name,
+            "ADDRESS_TABLE_NAME": table_addresses.name,
+            "EMAILS_TABLE_NAME": table_emails.name,
+        }
+    ),
+    timeout=900,
+    layers=[lambda_code_layer.arn],
+    tracing_config=(
+        aws.lambda_.FunctionTracingConfigArgs(mode="Active")
+        if xray_enabled.lower() == "true"
+        else None
+    ),
+    code=local_archive,
+    logging_config=aws.lambda_.FunctionLoggingConfigArgs(
+        log_format="JSON",
+        application_log_level=log_level,
+        system_log_level=log_level,
+        log_group=cw_log_group.name,
+    ),
+    opts=pulumi.ResourceOptions(depends_on=[cw_log_group]),
+)
+reconcile_address_counters_rule = aws.cloudwatch.EventRule(
+    f"{local_name}_reconcile_address_counters_rule",
+    description="Recounts the email counters of addresses",
+    schedule_expression=address_counter_reconcile_schedule,
+)
+aws.cloudwatch.EventTarget(
+    f"{local_name}_reconcile_address_counters_target",
+    rule=reconcile_address_counters_rule.name,
+    arn=lambda_reconcile_address_counters.arn,
+)
+aws.lambda_.Permission(
+    f"{local_name}_reconcile_address_counters_permission",
+    action="lambda:InvokeFunction",
+    function=lambda_reconcile_address_counters.name,
+    principal="events.amazonaws.com",
+    source_arn=reconcile_address_counters_rule.arn,
+)
+pulumi.export("reconcile_address_counters_function", lambda_reconcile_address_counters.name)
+
+
+if incoming_mail_pipeline == "fused":
+    lambda_fused_incoming_mail = aws.lambda_.Function(
+        f"{local_name}_fused_incoming_mail",
+        runtime=LAMBDA_PYTHON_VERSION,
+        memory_size=1024,
+        description="Store and extract attachments of incoming emails in one invoke",
+        handler="fused_incoming_mail_function.lambda_handler",
+        role=lambda_role.arn,
+        environment=aws.lambda_.FunctionEnvironmentArgs(
+            variables={
+                "LOG_LEVEL": log_level,
+                "XRAY_ENABLED": xray_enabled,
+                "XRAY_NAME": product_name,
+                "EMAILS_TABLE_NAME": table_emails.name,
+                "BLOBS_TABLE_NAME": table_blobs.name,
+                "ADDRESS_TABLE_NAME": table_addresses.name,
+                "ATTACHMENT_STREAMING_THRESHOLD": attachment_streaming_threshold,
+                "ATTACHMENT_UPLOAD_WORKERS": attachment_upload_workers,
+                "STORED_BODY_ENCODING": stored_body_encoding,
+                "PIPELINE_WORKERS": fused_pipeline_workers,
+                "INGEST_LAYOUT": ingest_layout,
+                "SUMMARY_QUEUE_URL": summary_queue.url,
+            }
+        ),
+        # Queue visibility is six times LAMBDA_TIMEOUT, keep well inside it
+        timeout=LAMBDA_TIMEOUT * 3,
+        layers=[lambda_code_layer.arn],
+        tracing_config=(
+            aws.lambda_.FunctionTracingConfigArgs(mode="Active")
+            if xray_enabled.lower() == "true"
+            else None
+        ),
+        code=local_archive,
+        logging_config=aws.lambda_.FunctionLoggingConfigArgs(
+            log_format="JSON",
+            application_log_level=log_level,
+            system_log_level=log_level,
+            log_group=cw_log_group.name,
+        ),
+        opts=pulumi.ResourceOptions(depends_on=[cw_log_group]),
+    )
+    ingest_function = lambda_fused_incoming_mail
+    ingest_function_batch_size = fused_pipeline_batch_size
+else:
+    ingest_function = lambda_start_incoming_mail
+    ingest_function_batch_size = ingest_batch_size
+
+aws.lambda_.EventSourceMapping(
+    f"{local_name}_ingest_queue_start_incoming_mail",
+    event_source_arn=ingest_queue.arn,
+    function_name=ingest_function.arn,
+    batch_size=ingest_function_batch_size,
+    maximum_batching_window_in_seconds=ingest_batching_window_seconds,
+    function_response_types=["ReportBatchItemFailures"],
+    scaling_config=aws.lambda_.EventSourceMappingScalingConfigArgs(
+        maximum_concurrency=ingest_max_concurrency
+    ),
+)
+
+
 incoming_mail_state_machine_role = aws.iam.Role(
     f"{local_name}_sfn",
     assume_role_policy=json.dumps(
@@ -585,7 +1058,7 @@ incoming_mail_state_machine_role = aws.iam.Role(
             policy=pulumi.Output.all(
                 lambda_store_email_arn=lambda_store_email.arn,
                 lambda_store_attachments_arn=lambda_store_attachments.arn,
-                lambda_summarize_email_arn=lambda_summarize_email.arn,
+                lambda_mark_processed_arn=lambda_mark_processed.arn,
             ).apply(
                 lambda args: json.dumps(
                     {
@@ -596,7 +1069,7 @@ incoming_mail_state_machine_role = aws.iam.Role(
                                 "Resource": [
                                     args["lambda_store_email_arn"],
                                     args["lambda_store_attachments_arn"],
-                                    args["lambda_summarize_email_arn"],
+                                    args["lambda_mark_processed_arn"],
                                 ],
                                 "Effect": "Allow",
                             }
@@ -608,10 +1081,27 @@ incoming_mail_state_machine_role = aws.iam.Role(
     ],
 )
 
+lambda_invoke_retry = [
+    {
+        "ErrorEquals": [
+            "Lambda.Unknown",
+            "Lambda.ServiceException",
+            "Lambda.AWSLambdaException",
+            "Lambda.SdkClientException",
+            "Lambda.TooManyRequestsException",
+        ],
+        "IntervalSeconds": 1,
+        "MaxAttempts": 3,
+        "BackoffRate": 2,
+    }
+]
+
+# The email is visible once stored and extracted, Mark Processed queues
+# its summary for the summary worker
 state_machine_incoming_mail_definition = pulumi.Output.all(
     lambda_store_email_arn=lambda_store_email.arn,
     lambda_store_attachments_arn=lambda_store_attachments.arn,
-    lambda_summarize_email_arn=lambda_summarize_email.arn,
+    lambda_mark_processed_arn=lambda_mark_processed.arn,
 ).apply(
     lambda args: json.dumps(
         {
@@ -625,20 +1115,7 @@ state_machine_incoming_mail_definition = pulumi.Output.all(
                         "Payload.$": "$",
                         "FunctionName": f"{args['lambda_store_email_arn']}",
                     },
-                    "Retry": [
-                        {
-                            "ErrorEquals": [
-                                "Lambda.Unknown",
-                                "Lambda.ServiceException",
-                                "Lambda.AWSLambdaException",
-                                "Lambda.SdkClientException",
-                                "Lambda.TooManyRequestsException",
-                            ],
-                            "IntervalSeconds": 1,
-                            "MaxAttempts": 3,
-                            "BackoffRate": 2,
-                        }
-                    ],
+                    "Retry": lambda_invoke_retry,
                     "Next": "Extract Attachments",
                     "OutputPath": "$.Payload",
                 },
@@ -649,44 +1126,19 @@ state_machine_incoming_mail_definition = pulumi.Output.all(
                         "Payload.$": "$",
                         "FunctionName": f"{args['lambda_store_attachments_arn']}",
                     },
-                    "Retry": [
-                        {
-                            "ErrorEquals": [
-                                "Lambda.Unknown",
-                                "Lambda.ServiceException",
-                                "Lambda.AWSLambdaException",
-                                "Lambda.SdkClientException",
-                                "Lambda.TooManyRequestsException",
-                            ],
-                            "IntervalSeconds": 1,
-                            "MaxAttempts": 3,
-                            "BackoffRate": 2,
-                        }
-                    ],
-                    "Next": "Summarize Email",
+                    "Retry": lambda_invoke_retry,
+                    "Next": "Mark Processed",
+                    # Carries the text body on to the summary job
                     "OutputPath": "$.Payload",
                 },
-                "Summarize Email": {
+                "Mark Processed": {
                     "Type": "Task",
                     "Resource": "arn:aws:states:::lambda:invoke",
                     "Parameters": {
                         "Payload.$": "$",
-                        "FunctionName": f"{args['lambda_summarize_email_arn']}",
+                        "FunctionName": f"{args['lambda_mark_processed_arn']}",
                     },
-                    "Retry": [
-                        {
-                            "ErrorEquals": [
-                                "Lambda.Unknown",
-                                "Lambda.ServiceException",
-                                "Lambda.AWSLambdaException",
-                                "Lambda.SdkClientException",
-                                "Lambda.TooManyRequestsException",
-                            ],
-                            "IntervalSeconds": 1,
-                            "MaxAttempts": 3,
-                            "BackoffRate": 2,
-                        }
-                    ],
+                    "Retry": lambda_invoke_retry,
                     "End": True,
                     "OutputPath": "$.Payload",
                 },
@@ -0,0 +1,142 @@
+"""Email list payload and read units, full rows against the list projection
+
+Builds email rows shaped like the ones ingest writes, then compares the
+JSON a list page returns and the read capacity a query for it consumes
+when whole rows are read and when only LIST_FIELDS are.
+
+    python benchmarks/list_projection_benchmark.py --attachments 8
+"""
+import os
+import sys
+import json
+import math
+import random
+import argparse
+from decimal import Decimal
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCHMARKS), "lambda"))
+
+from email_index import header_fields  # noqa: E402
+from text_normalize import email_preview  # noqa: E402
+
+# Same attributes as api_get_emails_list_function.LIST_FIELDS, that module
+# needs AWS clients at import
+LIST_FIELDS = (
+    "destination",
+    "messageId",
+    "timestamp",
+    "sender",
+    "subject",
+    "date",
+    "preview",
+    "attachment_count",
+    "is_read",
+)
+READ_UNIT_BYTES = 4096
+WORDS = "please review the attached plan budget timeline before friday thanks team update meeting notes".split()
+
+
+def sentence(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+def email_row(rng, index, attachments, recipients):
+    """An email row as stored and processed, with attachments extracted"""
+    destination = "inbox@example.com"
+    message_id = f"{rng.getrandbits(128):032x}"
+    timestamp = f"2024-03-{1 + index % 28:02d}T10:{index % 60:02d}:00.000Z"
+    common_headers = {
+        "returnPath": f"bounce-{index}@mail.example.org",
+        "from": [f"Sender {index} <sender{index}@example.org>"],
+        "date": "Tue, 5 Mar 2024 10:12:33 +0100",
+        "to": [f"user{n}@example.com" for n in range(recipients)],
+        "messageId": f"<{message_id}@mail.example.org>",
+        "subject": sentence(rng, 8),
+    }
+    body = "\n".join(sentence(rng, 14) for _ in range(12))
+    return {
+        "destination": destination,
+        "messageId": message_id,
+        "timestamp": timestamp,
+        "visible_at": timestamp,
+        "source": common_headers["returnPath"],
+        "commonHeaders": common_headers,
+        **header_fields(common_headers),
+        "attachments": [
+            {
+                "filename": f"{sentence(rng, 3)[:-1].replace(' ', '_')}_{n}.pdf",
+                "Content-Type": "application/pdf",
+                "Content-Transfer-Encoding": "base64",
+                "Content-ID": f"<part{n}.{message_id}@mail.example.org>",
+                "X-Attachment-Id": f"f_{rng.getrandbits(40):010x}",
+                "sha256": f"{rng.getrandbits(256):064x}",
+                "size": Decimal(rng.randint(20_000, 5_000_000)),
+            }
+            for n in range(attachments)
+        ],
+        "attachment_count": Decimal(attachments),
+        "preview": email_preview(body, "plain"),
+        "bucketName": "email-catcher-bucket",
+        "bucketObjectKey": f"stored_emails/{destination}/{message_id}/email.eml",
+        "artifactObjectKey": f"stored_emails/{destination}/{message_id}/email.eml.artifact.json",
+        "storageLayout": "copied",
+        "bodyEncoding": "gzip",
+        "recipients": common_headers["to"],
+        "is_read": False,
+        "is_processed": True,
+        "summary_text": " ".join(sentence(rng, 12) for _ in range(4)),
+    }
+
+
+def value_size(value) -> int:
+    """Approximate DynamoDB size of an attribute value"""
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    if isinstance(value, bool):
+        return 1
+    if isinstance(value, Decimal):
+        return math.ceil(len(value.as_tuple().digits) / 2) + 1
+    if isinstance(value, list):
+        return 3 + sum(1 + value_size(element) for element in value)
+    if isinstance(value, dict):
+        return 3 + sum(1 + len(name) + value_size(element) for name, element in value.items())
+    raise TypeError(type(value).__name__)
+
+
+def item_size(item) -> int:
+    return sum(len(name) + value_size(value) for name, value in item.items())
+
+
+def query_read_units(items) -> float:
+    """Eventually consistent read units of a query returning items, a query
+    is charged on the summed size of the items it reads"""
+    return math.ceil(sum(item_size(item) for item in items) / READ_UNIT_BYTES) * 0.5
+
+
+def payload_size(items) -> int:
+    body = json.dumps({"items": items, "cursor": None}, default=str)
+    return len(body.encode("utf-8"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--attachments", type=int, default=8, help="attachments per email")
+    parser.add_argument("--recipients", type=int, default=5, help="To addresses per email")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    rows = [email_row(rng, index, args.attachments, args.recipients) for index in range(args.page_size)]
+    projected = [{field: row[field] for field in LIST_FIELDS} for row in rows]
+
+    full_units, list_units = query_read_units(rows), query_read_units(projected)
+    full_payload, list_payload = payload_size(rows), payload_size(projected)
+    print(f"page of {args.page_size} emails, {args.attachments} attachments each")
+    print(f"read units  full {full_units:8.1f}  list {list_units:8.1f}  {full_units / list_units:5.1f}x")
+    print(f"payload     full {full_payload:8d}  list {list_payload:8d}  {full_payload / list_payload:5.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Signature cost and summary reuse rate of the MinHash near duplicate index
+
+Builds a synthetic corpus of templated emails, where every message of a
+template only differs in names, codes and links, and replays it through an
+in-memory version of the per address band index used by the summarizer.
+
+    python benchmarks/minhash_benchmark.py --templates 50 --messages 2000
+"""
+import os
+import sys
+import time
+import random
+import string
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "lambda"))
+
+import minhash  # noqa: E402
+
+WORDS = (
+    "account order shipping invoice payment update please review confirm your "
+    "details team support thanks regards welcome password reset link below "
+    "delivery tracking package customer service subscription renewal receipt "
+    "total amount due date balance statement security alert login device new "
+    "report weekly summary project status meeting agenda notes action items"
+).split()
+
+
+def random_code(rng):
+    return "".join(rng.choices(string.ascii_uppercase + string.digits, k=rng.randint(6, 12)))
+
+
+def make_template(rng, length):
+    words = [rng.choice(WORDS) for _ in range(length)]
+    # Slots for the parts that change between messages
+    for _ in range(max(3, length // 40)):
+        words.insert(rng.randrange(len(words)), rng.choice(["{name}", "{code}", "{link}"]))
+    return " ".join(words)
+
+
+def fill(rng, template):
+    text = template
+    while "{name}" in text:
+        text = text.replace("{name}", rng.choice(["Alice", "Bob", "Carol", "Dan", "Erin"]) + " " + random_code(rng), 1)
+    while "{code}" in text:
+        text = text.replace("{code}", random_code(rng), 1)
+    while "{link}" in text:
+        text = text.replace("{link}", f"https://example.com/{random_code(rng)}/{random_code(rng)}", 1)
+    return text
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--templates", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--min-words", type=int, default=80)
+    parser.add_argument("--max-words", type=int, default=1500)
+    parser.add_argument("--threshold", type=float, default=0.8)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    templates = [make_template(rng, rng.randint(args.min_words, args.max_words)) for _ in range(args.templates)]
+    corpus = []
+    for _ in range(args.messages):
+        template_id = rng.randrange(len(templates))
+        corpus.append((template_id, fill(rng, templates[template_id])))
+
+    minhash.signature("warm up")
+    timings = []
+    bands = {}
+    seen_templates = set()
+    reused = wrong = missed = exact = 0
+    exact_keys = set()
+    for template_id, text in corpus:
+        start = time.perf_counter()
+        sig = minhash.signature(text)
+        keys = minhash.band_keys(sig)
+        timings.append(time.perf_counter() - start)
+
+        if text in exact_keys:
+            exact += 1
+            continue
+        best, best_similarity = None, args.threshold
+        for key in keys:
+            candidate = bands.get(key)
+            if candidate is not None:
+                candidate_similarity = minhash.similarity(sig, candidate[1])
+                if candidate_similarity >= best_similarity:
+                    best, best_similarity = candidate, candidate_similarity
+        if best is not None:
+            reused += 1
+            wrong += best[0] != template_id
+            continue
+        missed += template_id in seen_templates
+        seen_templates.add(template_id)
+        exact_keys.add(text)
+        for key in keys:
+            bands[key] = (template_id, sig)
+
+    timings_us = sorted(t * 1e6 for t in timings)
+    repeats = args.messages - len(seen_templates)
+    print(f"messages            {args.messages} from {args.templates} templates")
+    print(f"signature mean      {statistics.mean(timings_us):.0f} us")
+    print(f"signature p50/p99   {timings_us[len(timings_us) // 2]:.0f} / {timings_us[int(len(timings_us) * 0.99)]:.0f} us")
+    print(f"exact hash hits     {exact}")
+    print(f"summaries reused    {reused} of {repeats} repeats ({reused / max(repeats, 1):.1%})")
+    print(f"wrong template      {wrong}")
+    print(f"missed repeats      {missed}")
+
+
+if __name__ == "__main__":
+    main()
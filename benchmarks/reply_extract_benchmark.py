@@ -0,0 +1,77 @@
+"""Accuracy, throughput and retained size of quoted reply and signature stripping
+
+Checks latest_content against the labeled fixtures in
+fixtures/reply_extract.json, then measures throughput and the share of
+estimated prompt tokens kept on generated reply chains.
+
+    python benchmarks/reply_extract_benchmark.py --threads 20
+"""
+import os
+import sys
+import json
+import random
+import timeit
+import argparse
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCHMARKS), "lambda"))
+
+from reply_extract import latest_content  # noqa: E402
+
+AVG_TOKEN_CHAR_CONVERSION = 3.25
+WORDS = "please review the attached plan budget timeline before friday thanks team update meeting notes".split()
+NAMES = ["Alice", "Bob", "Carol", "Dan", "Erin"]
+
+
+def sentence(rng):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(6, 16))).capitalize() + "."
+
+
+def reply_chain(rng, depth):
+    """A reply with depth earlier messages quoted below it, mixing client styles"""
+    body = "\n".join(sentence(rng) for _ in range(rng.randint(2, 6)))
+    for _ in range(depth):
+        name = rng.choice(NAMES)
+        earlier = "\n".join(sentence(rng) for _ in range(rng.randint(2, 6)))
+        style = rng.randrange(3)
+        if style == 0:
+            quoted = "\n".join("> " + line for line in (earlier + "\n" + body).splitlines())
+            body = f"On Tue, Mar 5, 2024 at 10:12 AM {name} <{name.lower()}@example.com> wrote:\n{quoted}"
+        elif style == 1:
+            body = f"-----Original Message-----\nFrom: {name}\nSent: Monday, March 4, 2024\nSubject: Plan\n\n{earlier}\n\n{body}"
+        else:
+            body = f"{earlier}\n\n-- \n{name}\nExample Corp\n\n{body}"
+    newest = "\n".join(sentence(rng) for _ in range(rng.randint(1, 4)))
+    return f"{newest}\n\n-- \nMe\n\n{body}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=200, help="generated reply chains")
+    parser.add_argument("--max-depth", type=int, default=12)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    with open(os.path.join(BENCHMARKS, "fixtures", "reply_extract.json"), encoding="utf-8") as fixture_file:
+        fixtures = json.load(fixture_file)
+    failures = [case["name"] for case in fixtures if latest_content(case["text"]) != case["expected"]]
+    print(f"fixtures            {len(fixtures) - len(failures)}/{len(fixtures)} correct")
+    for name in failures:
+        print(f"  failed            {name}")
+
+    rng = random.Random(args.seed)
+    corpus = [reply_chain(rng, rng.randint(0, args.max_depth)) for _ in range(args.threads)]
+    total_chars = sum(len(text) for text in corpus)
+    seconds = min(timeit.repeat(lambda: [latest_content(text) for text in corpus], number=1, repeat=5))
+    kept_chars = sum(len(latest_content(text)) for text in corpus)
+
+    print(f"reply chains        {len(corpus)}, {total_chars / len(corpus):.0f} characters on average")
+    print(f"throughput          {total_chars / seconds / 1e6:.1f} MB/s, {seconds / len(corpus) * 1e6:.0f} us per message")
+    print(
+        f"retained tokens     {kept_chars / AVG_TOKEN_CHAR_CONVERSION:.0f} of "
+        f"{total_chars / AVG_TOKEN_CHAR_CONVERSION:.0f} ({kept_chars / total_chars:.1%})"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Cost of preparing the summarizer prompt text from large newsletters
+
+Compares the previous chain of re.sub passes over the whole body with the
+bounded single pass normalizer, and times the HTML to text path.
+
+    python benchmarks/text_normalize_benchmark.py --size 2000000
+"""
+import os
+import re
+import sys
+import random
+import timeit
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "lambda"))
+
+from text_normalize import html_to_text, normalize_text  # noqa: E402
+
+CHARACTER_LIMIT = int(4096 * 3.25 - 1000)
+WORDS = "news update offer weekly team article read more today product launch event sale".split()
+
+
+def chained_re_sub(email_body: str, char_limit: int) -> str:
+    """The summarizer before the single pass normalizer"""
+    email_body = re.sub(r"<https?://[^>]*>", "", email_body)
+    email_body = re.sub(r"\n>", "", email_body)
+    email_body = re.sub(r">+", "", email_body)
+    email_body = re.sub(r"[ \t]+", " ", email_body)
+    return email_body[:char_limit]
+
+
+def plain_newsletter(rng, size):
+    lines = []
+    length = 0
+    while length < size:
+        words = " ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 14)))
+        line = rng.choice(
+            [
+                words,
+                f"{words} <https://example.com/{rng.randrange(10**6)}>",
+                f"> {words}",
+                f">> {words}\t\t  {words}",
+                f"    {words}",
+            ]
+        )
+        lines.append(line)
+        length += len(line) + 1
+    return "\n".join(lines)
+
+
+def html_newsletter(rng, size):
+    parts = ["<html><head><style>td { color: red; }</style></head><body><table>"]
+    length = 0
+    while length < size:
+        words = " ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 14)))
+        part = (
+            f'<tr><td class="c{rng.randrange(9)}"><a href="https://example.com/{rng.randrange(10**6)}">'
+            f"{words}</a>&nbsp;&amp;</td><td><p>{words}</p></td></tr>\n"
+        )
+        parts.append(part)
+        length += len(part)
+    parts.append("</table></body></html>")
+    return "".join(parts)
+
+
+def report(name, func, number):
+    seconds = min(timeit.repeat(func, number=number, repeat=5)) / number
+    print(f"{name:<28} {seconds * 1000:9.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=1_000_000, help="characters per newsletter")
+    parser.add_argument("--number", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    plain = plain_newsletter(rng, args.size)
+    html = html_newsletter(rng, args.size)
+
+    same = chained_re_sub(plain, CHARACTER_LIMIT) == normalize_text(plain, CHARACTER_LIMIT)
+    print(f"newsletter size              {args.size} characters, output identical: {same}")
+    report("chained re.sub (plain)", lambda: chained_re_sub(plain, CHARACTER_LIMIT), args.number)
+    report("normalize_text (plain)", lambda: normalize_text(plain, CHARACTER_LIMIT), args.number)
+    report("chained re.sub (html)", lambda: chained_re_sub(html, CHARACTER_LIMIT), args.number)
+    report("html_to_text (html)", lambda: html_to_text(html, CHARACTER_LIMIT), args.number)
+
+
+if __name__ == "__main__":
+    main()
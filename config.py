@@ -7,6 +7,7 @@ aws_region = aws.get_region().name
 product_name = f"{stack}_email_catcher"
 
 LAMBDA_TIMEOUT = 120
+# The layer is built for this version, see LAYER_PYTHON_VERSION in pulumi_deploy.py
 LAMBDA_PYTHON_VERSION = "python3.12"
 
 ses_email_domain = (
@@ -23,6 +24,52 @@ cloudfront_web_domain = (
 pulumi.export("web_url", f"https://{cloudfront_web_domain}")
 log_level = "INFO"
 xray_enabled = "true"
+# Emails larger than this (bytes) are streamed through attachment extraction
+attachment_streaming_threshold = str(8 * 1024 * 1024)
+# Concurrent S3 uploads per attachment extraction invocation
+attachment_upload_workers = "8"
+# Incoming mail notifications are buffered in SQS and started in batches
+ingest_batch_size = 100
+ingest_batching_window_seconds = 5
+ingest_max_concurrency = 10
+start_execution_workers = "10"
+# "step_functions" runs each stage as its own Lambda in the state machine,
+# "fused" runs all stages in one Lambda for lower end to end latency
+incoming_mail_pipeline = "step_functions"
+fused_pipeline_workers = "4"
+fused_pipeline_batch_size = 10
+# "copy" moves incoming mail under stored_emails/<address>/, "in_place" keeps
+# the object SES wrote in incoming_mail/ and only indexes it per address
+ingest_layout = "copy"
+# Encoding of stored .eml objects, "gzip" or "identity"
+stored_body_encoding = "gzip"
+# Seconds a Bedrock summary is reused for identical email content
+summary_cache_ttl = str(7 * 24 * 60 * 60)
+# Estimated similarity (0-1) from which the summary of a near duplicate
+# email to the same address is reused, "0" turns this off
+similar_summary_threshold = "0.8"
+# Summaries are made by a queue worker after the email is visible. At most
+# this many workers call Bedrock at once, together staying under the
+# estimated input tokens per minute ("0" turns pacing off)
+summary_max_concurrency = 5
+summary_tokens_per_minute = "100000"
+# Addresses in the "on_read" summarize mode get a summary when an email is
+# first opened, the API waits this long for it before answering without
+# one (API Gateway stops waiting after 29 seconds)
+summary_read_deadline_seconds = "8"
+# Per container cache of address lookups made by the SES receipt check,
+# TTLs in seconds, invalidated early through the address change feed
+address_cache_size = "10000"
+address_cache_ttl = "300"
+address_negative_cache_ttl = "60"
+address_feed_poll_seconds = "5"
+# Reject addresses missing from the address filter snapshot without a lookup.
+# A new address can be rejected until the snapshot reaches the check
+# function, usually within a few seconds.
+address_filter_enabled = "true"
+# The email, unread and stored byte counters of each address are recounted
+# on this schedule, repairing drift left by failed updates
+address_counter_reconcile_schedule = "rate(1 day)"
 disable_public_registration = True
 initial_user = {
     "enabled": True,
@@ -23,6 +23,9 @@ table_addresses = aws.dynamodb.Table(
         ),
     ],
     billing_mode="PAY_PER_REQUEST",
+    # Feeds the address change feed used by the SES receipt check
+    stream_enabled=True,
+    stream_view_type="KEYS_ONLY",
 )
 
 # EmailsTable
@@ -32,7 +35,54 @@ table_emails = aws.dynamodb.Table(
     attributes=[
         aws.dynamodb.TableAttributeArgs(name="destination", type="S"),
         aws.dynamodb.TableAttributeArgs(name="messageId", type="S"),
+        aws.dynamodb.TableAttributeArgs(name="visible_at", type="S"),
     ],
     hash_key="destination",
     range_key="messageId",
+    global_secondary_indexes=[
+        # Processed emails of an address newest first, the list API pages
+        # through it. Sparse, visible_at is only set once an email is
+        # processed, so rows still being ingested are never read. DynamoDB
+        # fills it from existing rows when it is added
+        aws.dynamodb.TableGlobalSecondaryIndexArgs(
+            name="DestinationVisibleIndex",
+            hash_key="destination",
+            range_key="visible_at",
+            # What a list item shows, keep in step with LIST_FIELDS of the
+            # list function, and size_bytes for recounting the address
+            # counters. Changing it makes DynamoDB rebuild the index
+            projection_type="INCLUDE",
+            non_key_attributes=[
+                "timestamp",
+                "sender",
+                "subject",
+                "date",
+                "preview",
+                "attachment_count",
+                "is_read",
+                "size_bytes",
+            ],
+        ),
+    ],
+)
+
+# BlobsTable, reference counts for content-addressed attachments
+table_blobs = aws.dynamodb.Table(
+    f"{local_name}_table_blobs",
+    billing_mode="PAY_PER_REQUEST",
+    attributes=[
+        aws.dynamodb.TableAttributeArgs(name="sha256", type="S"),
+    ],
+    hash_key="sha256",
+)
+
+# SummaryCacheTable, Bedrock summaries keyed by content hash
+table_summary_cache = aws.dynamodb.Table(
+    f"{local_name}_table_summary_cache",
+    billing_mode="PAY_PER_REQUEST",
+    attributes=[
+        aws.dynamodb.TableAttributeArgs(name="cache_key", type="S"),
+    ],
+    hash_key="cache_key",
+    ttl=aws.dynamodb.TableTtlArgs(attribute_name="expires_at", enabled=True),
 )
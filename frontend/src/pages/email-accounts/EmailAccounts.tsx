@@ -21,6 +21,17 @@ import { Cache } from 'aws-amplify/utils';
 import { FiCopy,  } from 'react-icons/fi';  // Import the copy icon
 import { LuMousePointerClick } from "react-icons/lu";
 
+function formatBytes(bytes: number) {
+  const units = ['B', 'KB', 'MB', 'GB'];
+  let size = bytes;
+  let unit = 0;
+  while (size >= 1024 && unit < units.length - 1) {
+    size /= 1024;
+    unit += 1;
+  }
+  return `${unit === 0 ? size : size.toFixed(1)} ${units[unit]}`;
+}
+
 const EmailAccounts = () => {
   const ADDRESSES_CACHE_KEY = 'addressesCache';
   const cacheExpirationDuration = 5 * 60 * 1000; // 5 minutes
@@ -30,6 +41,7 @@ const EmailAccounts = () => {
   const [error, setError] = useState<unknown>(null);
   const [newAddress, setNewAddress] = useState(String);
   const [summarizeEmails, setSummarizeEmails] = useState(Boolean);
+  const [summarizeOnOpen, setSummarizeOnOpen] = useState(Boolean);
 
   const handleAccountClick = (emailAddress) => {
     navigate(`/email-accounts/${encodeURIComponent(emailAddress)}`);
@@ -86,10 +98,12 @@ const EmailAccounts = () => {
       const postData = {
         new_address: newAddress + `@${awsExports.emailDomain}`,
         summarize_emails: summarizeEmails,
+        summarize_mode: summarizeOnOpen ? "on_read" : "ingest",
       };
       await post({ apiName: 'disposible', path: 'addresses', options: { body: postData } });
       setAddresses(prevAddresses => [...prevAddresses, { address: newAddress + `@${awsExports.emailDomain}` }]);
       setSummarizeEmails(false);
+      setSummarizeOnOpen(false);
     } catch (err) {
       console.error('POST call failed: ', err);
       setError(err);
@@ -117,6 +131,9 @@ const EmailAccounts = () => {
         <Label htmlFor="new_address" className="form-label">New Address:</Label>
         <Input id="new_address" name="new_address" className="form-input" placeholder={`@${awsExports.emailDomain}`} onChange={(e) => setNewAddress(e.target.value)} />
         <CheckboxField isDisabled={loading} label="Summarize Emails" name="summarize_emails" checked={summarizeEmails} onChange={(e) => setSummarizeEmails(e.target.checked)} />
+        {summarizeEmails && (
+          <CheckboxField isDisabled={loading} label="Only When Opened" name="summarize_on_open" checked={summarizeOnOpen} onChange={(e) => setSummarizeOnOpen(e.target.checked)} />
+        )}
         <Button isLoading={loading} isDisabled={loading} variation="primary" className="form-button" onClick={handleSubmit}>
           <FiPlus />
         </Button>
@@ -134,6 +151,8 @@ const EmailAccounts = () => {
             <TableHead>
               <TableRow>
                 <TableCell>Address</TableCell>
+                <TableCell>Unread / Total</TableCell>
+                <TableCell>Stored</TableCell>
                 <TableCell>Actions</TableCell>
               </TableRow>
             </TableHead>
@@ -142,6 +161,8 @@ const EmailAccounts = () => {
                 return (
                   <TableRow onClick={() => handleAccountClick(item.address)} key={index}>
                     <TableCell>{item.address}</TableCell>
+                    <TableCell>{item.email_count !== undefined ? `${item.unread_count ?? 0} / ${item.email_count}` : ''}</TableCell>
+                    <TableCell>{item.stored_bytes !== undefined ? formatBytes(Number(item.stored_bytes)) : ''}</TableCell>
                     <TableCell>
                       <Flex justifyContent="flex-start" alignItems="center" gap="small">
                         <Button onClick={(event) => handleCopyEmail(event, item.address)} size="small">
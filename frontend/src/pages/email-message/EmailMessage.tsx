@@ -10,6 +10,9 @@ import DOMPurify from 'dompurify';
 const EmailMessage = () => {
     const [message, setMessage] = useState<any>(null);
     const [summary, setSummary] = useState<string>(null);
+    const [summaryPending, setSummaryPending] = useState(false);
+    const SUMMARY_POLL_INTERVAL = 700; // milliseconds
+    const SUMMARY_POLL_LIMIT = 3 * 60 * 1000; // give up after 3 minutes
     const [attachments, setAttachments] = useState([]);
     const [loading, setLoading] = useState(false);
     const [error, setError] = useState<unknown>(null);
@@ -37,7 +40,8 @@ const EmailMessage = () => {
             const parser = new PostalMime();
             const response = await parser.parse(raw["body"]);
             setMessage(response);
-            setSummary(raw["summary"]);
+            setSummary(raw["summary"] || raw["summary_partial"]);
+            setSummaryPending(raw["summary_pending"] === true);
             setAttachments(raw["attachments"] || []);
         } catch (err) {
             console.error('GET call failed: ', err);
@@ -47,6 +51,15 @@ const EmailMessage = () => {
         }
     }
 
+    async function getSummary(emailAddress, messageId) {
+        const restOperation = get({
+            apiName: 'disposible',
+            path: `addresses/${emailAddress}/${messageId}/summary`,
+        });
+        const { body } = await restOperation.response;
+        return await body.json();
+    }
+
     async function handleDeleteMessage(emailAddress, messageId) {
         try {
             setLoading(true)
@@ -69,6 +82,35 @@ const EmailMessage = () => {
         getMessage(emailAddress, messageId); // Call the function to fetch addresses
     }, []);
 
+    // Show the summary as it is generated
+    useEffect(() => {
+        if (!summaryPending) return;
+        const started = Date.now();
+        let cancelled = false;
+        let timer = null;
+        const poll = async () => {
+            try {
+                const state = await getSummary(emailAddress, messageId);
+                if (cancelled) return;
+                setSummary(state["summary"] || state["partial"]);
+                if (!state["pending"]) {
+                    setSummaryPending(false);
+                    return;
+                }
+            } catch (err) {
+                console.error('Summary poll failed: ', err);
+            }
+            if (!cancelled && Date.now() - started < SUMMARY_POLL_LIMIT) {
+                timer = setTimeout(poll, SUMMARY_POLL_INTERVAL);
+            }
+        };
+        timer = setTimeout(poll, SUMMARY_POLL_INTERVAL);
+        return () => {
+            cancelled = true;
+            clearTimeout(timer);
+        };
+    }, [summaryPending]);
+
     const resizeIframe = () => {
         const iframe = iframeRef.current;
         iframe.style.width = '100%';
@@ -117,6 +159,19 @@ const EmailMessage = () => {
                 <Button size="small" isLoading={loading} isDisabled={loading} onClick={() => handleBackClick(emailAddress)}>Back</Button>
             </Flex>
             <br></br>
+            {!summary && summaryPending && (
+                <Card style={{
+                    width: '100%',
+                    maxWidth: '100%',
+                    marginBottom: '1rem',
+                    boxSizing: 'border-box',
+                }}>
+                    <Text textDecoration="underline">Summary</Text>
+                    <br></br>
+                    <Text>The summary is being generated...</Text>
+                    <br></br>
+                </Card>
+            )}
             {summary && (
                 <Card style={{
                     width: '100%', // Set width to 100% to fit the screen
@@ -126,7 +181,7 @@ const EmailMessage = () => {
                 }}>
                     <Text textDecoration="underline">Summary</Text>
                     <br></br>
-                    <Text>{summary}</Text>
+                    <Text>{summary}{summaryPending && " ..."}</Text>
                     <br></br>
                 </Card>
             )}
@@ -10,7 +10,7 @@ import {
     ScrollView,
     Flex,
 } from "@aws-amplify/ui-react";
-import { FiMail, FiRefreshCw } from "react-icons/fi";
+import { FiMail, FiPaperclip, FiRefreshCw } from "react-icons/fi";
 import { useNavigate, useParams } from "react-router-dom";
 import { get, del } from 'aws-amplify/api';
 import moment from "moment";
@@ -20,7 +20,10 @@ import { MdDeleteForever } from "react-icons/md";
 
 const EmailMessages = () => {
     const cacheExpirationDuration = 5 * 60 * 1000; // 5 minutes
+    const pageSize = 50;
     const [messages, setMessages] = useState<any[]>([]);
+    const [nextCursor, setNextCursor] = useState<string>(null);
+    const [loadingMore, setLoadingMore] = useState(false);
     const [error, setError] = useState<unknown>(null);
     const [loading, setLoading] = useState(false);
     const navigate = useNavigate();
@@ -72,31 +75,42 @@ const EmailMessages = () => {
         }
     }
 
+    async function getMessagesPage(emailAddress: string, cursor: string = null) {
+        const queryParams = { limit: String(pageSize) };
+        if (cursor) {
+            queryParams["cursor"] = cursor;
+        }
+        const restOperation = get({
+            apiName: 'disposible',
+            path: `addresses/${emailAddress}`,
+            options: { queryParams },
+        });
+        const { body } = await restOperation.response;
+        return await body.json();
+    }
+
     async function getMessages(emailAddress: string, useCache = false) {
         setLoading(true);
-        const cacheKey = `messagesCache_${emailAddress}`; // Unique cache key per email address
+        const cacheKey = `messagesCache_v2_${emailAddress}`; // Unique cache key per email address and list item shape
 
         try {
-            // Check cache first
+            // Check cache first, only the first page is cached
             if (useCache) {
                 const cachedData = await Cache.getItem(cacheKey);
                 if (cachedData) {
-                    setMessages(cachedData);
+                    setMessages(cachedData["items"]);
+                    setNextCursor(cachedData["cursor"]);
                     setLoading(false);
                     return;
                 }
             }
 
             // Fetch data from API if not cached or cache is bypassed
-            const restOperation = get({
-                apiName: 'disposible',
-                path: `addresses/${emailAddress}`,
-            });
-            const { body } = await restOperation.response;
-            const response = await body.json();
+            const response = await getMessagesPage(emailAddress);
 
-            if (Array.isArray(response)) {
-                setMessages(response);
+            if (Array.isArray(response["items"])) {
+                setMessages(response["items"]);
+                setNextCursor(response["cursor"]);
                 // Cache the data
                 Cache.setItem(cacheKey, response, { expires: new Date().getTime() + cacheExpirationDuration });
             }
@@ -108,6 +122,22 @@ const EmailMessages = () => {
         }
     }
 
+    async function getMoreMessages(emailAddress: string) {
+        setLoadingMore(true);
+        try {
+            const response = await getMessagesPage(emailAddress, nextCursor);
+            if (Array.isArray(response["items"])) {
+                setMessages((prevMessages) => [...prevMessages, ...response["items"]]);
+                setNextCursor(response["cursor"]);
+            }
+        } catch (err) {
+            console.error('GET call failed: ', err);
+            setError(err);
+        } finally {
+            setLoadingMore(false);
+        }
+    }
+
     useEffect(() => {
         getMessages(emailAddress); // Call the function to fetch addresses
     }, [emailAddress]);
@@ -159,10 +189,14 @@ const EmailMessages = () => {
                                 return (
                                     <TableRow onClick={() => handleMessageClick(emailAddress, item.messageId)} key={index}>
                                         <TableCell className="responsive-cell" data-label="From">
-                                            {!item.is_read && <FiMail />}&nbsp;{item.commonHeaders.sender || item.commonHeaders.returnPath}
+                                            {!item.is_read && <FiMail />}&nbsp;{item.sender}
+                                        </TableCell>
+                                        <TableCell className="responsive-cell" data-label="Subject">
+                                            {item.attachment_count > 0 && <><FiPaperclip title={`${item.attachment_count} attachments`} />&nbsp;</>}
+                                            {item.subject}
+                                            {item.preview && <div style={{ color: "var(--amplify-colors-font-tertiary)" }}>{item.preview}</div>}
                                         </TableCell>
-                                        <TableCell className="responsive-cell" data-label="Subject">{item.commonHeaders.subject}</TableCell>
-                                        <TableCell className="responsive-cell" data-label="Date">{moment(item.commonHeaders.date).calendar()}</TableCell>
+                                        <TableCell className="responsive-cell" data-label="Date">{moment(item.date).calendar()}</TableCell>
                                         <TableCell className="responsive-cell" data-label="Action">
                                             <Flex justifyContent="flex-start" alignItems="center" gap="small">
                                                 <Button size="small" colorTheme="error" onClick={(event) => handleDeleteMessage(event, emailAddress, item.messageId)}>
@@ -178,6 +212,13 @@ const EmailMessages = () => {
                             })}
                         </TableBody>
                     </Table>
+                    {nextCursor && (
+                        <Flex justifyContent="center" padding="1rem">
+                            <Button size="small" isLoading={loadingMore} isDisabled={loadingMore} onClick={() => getMoreMessages(emailAddress)}>
+                                Load more
+                            </Button>
+                        </Flex>
+                    )}
                 </ScrollView>
             </View>
         </>
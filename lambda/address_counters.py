@@ -0,0 +1,44 @@
+import logging
+
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+
+# Kept on each address item for the emails visible in its list, so the
+# address list shows them without querying the emails of every address
+COUNTER_FIELDS = ("email_count", "unread_count", "stored_bytes")
+
+
+def email_counts(item) -> dict:
+    """What the row of a visible email adds to the counters of its address"""
+    return {
+        "emails": 1,
+        "unread": 0 if item.get("is_read") else 1,
+        "stored_bytes": int(item.get("size_bytes", 0)),
+    }
+
+
+def update_counters(table_addresses, address, emails=0, unread=0, stored_bytes=0) -> bool:
+    """Atomically add to the counters of address, negative values subtract
+
+    Addresses that are not registered, or were deleted meanwhile, are not
+    created. Failures are logged and left to the reconciliation job rather
+    than failing the caller.
+
+    :return: True if the counters were updated, otherwise False
+    """
+    try:
+        table_addresses.update_item(
+            Key={"address": address},
+            UpdateExpression="ADD email_count :emails, unread_count :unread, stored_bytes :bytes",
+            ConditionExpression="attribute_exists(address)",
+            ExpressionAttributeValues={":emails": emails, ":unread": unread, ":bytes": stored_bytes},
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            logger.info(f"## No address item for {address}, counters left alone")
+        else:
+            logger.error(f"## Unable to update counters of {address}")
+            logger.error(e.response["Error"]["Message"])
+        return False
+    return True
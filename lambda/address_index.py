@@ -0,0 +1,293 @@
+import json
+import math
+import time
+import struct
+import hashlib
+import logging
+
+from botocore.exceptions import ClientError
+
+from util import backoff
+
+logger = logging.getLogger()
+
+FEED_KEY = "address_index/changes.json"
+BLOOM_KEY = "address_index/addresses.bloom"
+# Readers that fall further behind than this drop their whole cache
+FEED_RETENTION_SECONDS = 60 * 60
+FEED_MAX_ENTRIES = 5000
+# Stream shards publish concurrently, every write is conditional on the
+# object read and is redone on a conflict
+UPDATE_ATTEMPTS = 10
+CONFLICT_CODES = ("PreconditionFailed", "412", "ConditionalRequestConflict", "409")
+
+
+def empty_feed() -> dict:
+    return {"entries": [], "truncated_at": 0}
+
+
+def read_object(s3, bucket: str, key: str):
+    """Body and ETag of an object, (None, None) if it does not exist"""
+    try:
+        data = s3.get_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return None, None
+        raise
+    return data["Body"].read(), data["ETag"]
+
+
+def update_object(s3, bucket: str, key: str, update, content_type: str):
+    """Read-modify-write an object without losing concurrent writes
+
+    update(body) gets the current body, None if there is none, and returns
+    the new one. The put only succeeds if the object is still the one that
+    was read, otherwise the update is redone on the newer object.
+    """
+    for attempt in range(UPDATE_ATTEMPTS):
+        body, etag = read_object(s3, bucket, key)
+        condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+        try:
+            s3.put_object(Bucket=bucket, Key=key, Body=update(body), ContentType=content_type, **condition)
+            return
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in CONFLICT_CODES:
+                raise
+        logger.info(f"## {key} changed while updating it, retrying")
+        backoff(attempt + 1)
+    raise RuntimeError(f"Unable to update {key}, too many concurrent writes")
+
+
+def load_feed(s3, bucket: str) -> dict:
+    body, _ = read_object(s3, bucket, FEED_KEY)
+    return json.loads(body) if body is not None else empty_feed()
+
+
+def append_changes(s3, bucket: str, addresses, now: float = None):
+    """Record that addresses were added or removed
+
+    Entries older than FEED_RETENTION_SECONDS, or beyond FEED_MAX_ENTRIES,
+    are dropped and truncated_at tells readers how far back the feed is
+    complete.
+    """
+    now = time.time() if now is None else now
+
+    def update(body):
+        feed = json.loads(body) if body is not None else empty_feed()
+        entries = feed["entries"] + [{"address": address, "at": now} for address in addresses]
+        cutoff = now - FEED_RETENTION_SECONDS
+        kept = [entry for entry in entries if entry["at"] > cutoff][-FEED_MAX_ENTRIES:]
+        dropped = len(entries) - len(kept)
+        if dropped:
+            feed["truncated_at"] = max(feed["truncated_at"], entries[dropped - 1]["at"])
+        feed["entries"] = kept
+        return json.dumps(feed, separators=(",", ":")).encode("utf-8")
+
+    update_object(s3, bucket, FEED_KEY, update, "application/json")
+
+
+class ChangeFeedReader:
+    """Applies the address change feed to a per-container cache
+
+    The feed object is fetched at most once per poll interval, and only
+    downloaded when its ETag changed.
+    """
+
+    def __init__(self, s3, bucket: str, poll_interval: float, clock=time.monotonic):
+        self.s3 = s3
+        self.bucket = bucket
+        self.poll_interval = poll_interval
+        self.clock = clock
+        self.etag = None
+        self.last_seen = None
+        self.next_poll = 0
+
+    def poll(self, cache):
+        if self.clock() < self.next_poll:
+            return
+        self.next_poll = self.clock() + self.poll_interval
+        kwargs = {"IfNoneMatch": self.etag} if self.etag else {}
+        try:
+            data = self.s3.get_object(Bucket=self.bucket, Key=FEED_KEY, **kwargs)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("304", "NotModified", "NoSuchKey", "404"):
+                return
+            logger.warning("## Unable to read address change feed")
+            logger.warning(e.response["Error"]["Message"])
+            return
+        self.etag = data.get("ETag")
+        feed = json.loads(data["Body"].read())
+        self.apply(feed, cache)
+
+    def apply(self, feed: dict, cache):
+        entries = feed["entries"]
+        if self.last_seen is not None:
+            if feed["truncated_at"] > self.last_seen:
+                logger.info("## Address change feed truncated past last poll, clearing cache")
+                cache.clear()
+            else:
+                for entry in entries:
+                    if entry["at"] >= self.last_seen:
+                        cache.invalidate(entry["address"])
+        elif entries:
+            # Anything cached before the first successful poll may predate the feed
+            cache.clear()
+        if entries:
+            self.last_seen = max(self.last_seen or 0, entries[-1]["at"])
+        elif self.last_seen is None:
+            self.last_seen = feed["truncated_at"]
+
+
+BLOOM_MAGIC = b"ECBF"
+BLOOM_HEADER = struct.Struct(">4sBIIII")
+BLOOM_VERSION = 1
+BLOOM_CAPACITY = 100000
+BLOOM_ERROR_RATE = 0.01
+# Removed addresses keep their bits set, rebuild once they make up this
+# share of the filter
+BLOOM_REBUILD_REMOVED_RATIO = 0.25
+
+
+class BloomFilter:
+    """Bloom filter over addresses, serialized as a fixed header and the bit array
+
+    Membership tests can give false positives but never false negatives, so
+    an address that is not in the filter is known not to exist.
+    """
+
+    def __init__(self, size: int, hashes: int, count: int = 0, removed: int = 0, bits: bytearray = None):
+        self.size = size
+        self.hashes = hashes
+        self.count = count
+        self.removed = removed
+        self.bits = bits if bits is not None else bytearray((size + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity: int, error_rate: float = BLOOM_ERROR_RATE):
+        capacity = max(capacity, 1)
+        size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        hashes = max(1, int(round(size / capacity * math.log(2))))
+        return cls(size, hashes)
+
+    @property
+    def capacity(self) -> int:
+        return int(self.size * math.log(2) ** 2 / -math.log(BLOOM_ERROR_RATE))
+
+    def _positions(self, address: str):
+        digest = hashlib.blake2b(address.encode("utf-8"), digest_size=16).digest()
+        h1, h2 = struct.unpack(">QQ", digest)
+        # Double hashing, an odd step never cycles early
+        h2 |= 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, address: str):
+        for position in self._positions(address):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, address: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(address))
+
+    def to_bytes(self) -> bytes:
+        header = BLOOM_HEADER.pack(BLOOM_MAGIC, BLOOM_VERSION, self.size, self.hashes, self.count, self.removed)
+        return header + bytes(self.bits)
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        magic, version, size, hashes, count, removed = BLOOM_HEADER.unpack_from(data)
+        if magic != BLOOM_MAGIC or version != BLOOM_VERSION:
+            raise ValueError("Unsupported address filter format")
+        return cls(size, hashes, count, removed, bytearray(data[BLOOM_HEADER.size :]))
+
+
+def scan_addresses(table):
+    kwargs = {"ProjectionExpression": "address"}
+    while True:
+        response = table.scan(**kwargs)
+        for item in response.get("Items", []):
+            yield item["address"]
+        if "LastEvaluatedKey" not in response:
+            return
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def build_bloom(table) -> BloomFilter:
+    addresses = list(scan_addresses(table))
+    # Leave room to grow before the next rebuild
+    bloom = BloomFilter.for_capacity(max(BLOOM_CAPACITY, len(addresses) * 2))
+    for address in addresses:
+        bloom.add(address)
+    return bloom
+
+
+def load_bloom(s3, bucket: str):
+    body, _ = read_object(s3, bucket, BLOOM_KEY)
+    return BloomFilter.from_bytes(body) if body is not None else None
+
+
+def update_bloom(s3, table, bucket: str, added, removed: int):
+    """Add new addresses to the filter snapshot, rebuilding it from the table
+    when it does not exist yet, is full or holds too many removed addresses"""
+    updated = {}
+
+    def update(body):
+        bloom = BloomFilter.from_bytes(body) if body is not None else None
+        if bloom is not None:
+            bloom.removed += removed
+            for address in added:
+                bloom.add(address)
+        if (
+            bloom is None
+            or bloom.count > bloom.capacity
+            or bloom.removed > bloom.count * BLOOM_REBUILD_REMOVED_RATIO
+        ):
+            logger.info("## Rebuilding address filter from the table")
+            bloom = build_bloom(table)
+        updated["bloom"] = bloom
+        return bloom.to_bytes()
+
+    update_object(s3, bucket, BLOOM_KEY, update, "application/octet-stream")
+    return updated["bloom"]
+
+
+class BloomSnapshotReader:
+    """Keeps the latest address filter snapshot in memory
+
+    Like the change feed, the object is checked at most once per poll
+    interval and only downloaded when it changed.
+    """
+
+    def is_current(self, last_change) -> bool:
+        """Whether the snapshot contains every change up to last_change, the
+        time of the newest change feed entry"""
+        return self.updated_at is not None and (last_change is None or self.updated_at >= last_change)
+
+    def __init__(self, s3, bucket: str, poll_interval: float, clock=time.monotonic):
+        self.s3 = s3
+        self.bucket = bucket
+        self.poll_interval = poll_interval
+        self.clock = clock
+        self.etag = None
+        self.bloom = None
+        # When the snapshot was written, misses only count for changes
+        # published before it
+        self.updated_at = None
+        self.next_poll = 0
+
+    def poll(self):
+        if self.clock() < self.next_poll:
+            return self.bloom
+        self.next_poll = self.clock() + self.poll_interval
+        kwargs = {"IfNoneMatch": self.etag} if self.etag else {}
+        try:
+            data = self.s3.get_object(Bucket=self.bucket, Key=BLOOM_KEY, **kwargs)
+            self.bloom = BloomFilter.from_bytes(data["Body"].read())
+            self.etag = data.get("ETag")
+            self.updated_at = data["LastModified"].timestamp()
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("304", "NotModified", "NoSuchKey", "404"):
+                logger.warning("## Unable to read address filter")
+                logger.warning(e.response["Error"]["Message"])
+        except ValueError as e:
+            logger.warning(f"## Ignoring address filter: {e}")
+        return self.bloom
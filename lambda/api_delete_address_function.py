@@ -6,6 +6,7 @@ from botocore.exceptions import ClientError
 from boto3.dynamodb.conditions import Key
 from aws_xray_sdk.core import xray_recorder, patch_all
 from util import check_access, create_response, get_user_sub_from_event
+from email_index import release_email
 
 if os.environ.get("XRAY_ENABLED", "false").lower() == "true":
     XRAY_NAME = os.environ.get("XRAY_NAME", "email-catcher")
@@ -21,26 +22,23 @@ s3 = boto3.client("s3")
 
 table_addresses = ddb_client.Table(os.environ["ADDRESS_TABLE_NAME"])
 table_emails = ddb_client.Table(os.environ["EMAILS_TABLE_NAME"])
+table_blobs = ddb_client.Table(os.environ["BLOBS_TABLE_NAME"])
 
 
-def delete_object(bucket_name, destination, message_id):
-    """Delete an object from an S3 bucket
+def delete_object(item):
+    """Delete the stored objects of an email unless other recipients share them
 
-    :param bucket_name: string
-    :param destination: string
-    :param message_id: string
-    :return: True if the referenced object was deleted, otherwise False
+    :param item: email item whose row was deleted
+    :return: True if the objects were released, otherwise False
     """
     logger.info("## Deleting S3")
-    logger.info(f"{bucket_name}: {message_id}")
+    logger.info(f"{item['bucketName']}: {item['messageId']}")
 
     # Delete the object
     try:
-        email_objects = s3.list_objects_v2(Bucket=bucket_name, Prefix=f"stored_emails/{destination}/{message_id}")
-        for email_object in email_objects['Contents']:
-            logger.info(f"Deleting: {email_object['Key']}")
-            s3.delete_object(Bucket=bucket_name, Key=email_object['Key'])
-    except ClientError as e:
+        release_email(s3, ddb_client, table_emails, table_blobs, item)
+    except (ClientError, RuntimeError) as e:
+        # The stored object is kept when the other rows cannot be checked
         logger.error(e)
         return False
     return True
@@ -74,11 +72,13 @@ def find_emails(destination):
     else:
         # Clean response
         for Item in response["Items"]:
-            delete_object(Item["bucketName"], destination, Item["messageId"])
             delete_email_item(destination, Item["messageId"])
+            delete_object(Item)
 
 
 def cleanup(address):
+    # The address counters go with its item, the emails deleted here are
+    # not counted down one by one
     find_emails(address)
     delete_address_item(address)
 
@@ -6,6 +6,8 @@ from botocore.exceptions import ClientError
 from aws_xray_sdk.core import xray_recorder, patch_all
 
 from util import check_access, create_response, get_user_sub_from_event
+from email_index import release_email
+from address_counters import email_counts, update_counters
 
 
 if os.environ.get("XRAY_ENABLED", "false").lower() == "true":
@@ -22,6 +24,7 @@ s3 = boto3.client("s3")
 
 table_addresses = ddb_client.Table(os.environ["ADDRESS_TABLE_NAME"])
 table_emails = ddb_client.Table(os.environ["EMAILS_TABLE_NAME"])
+table_blobs = ddb_client.Table(os.environ["BLOBS_TABLE_NAME"])
 
 
 def get_email_item(destination, messageId):
@@ -42,14 +45,21 @@ def get_email_item(destination, messageId):
 
 
 def delete_email_item(destination, messageId):
+    """Delete the row and take it off the counters of its address, only the
+    request that actually deleted it does"""
     try:
-        table_emails.delete_item(
-            Key={"destination": destination, "messageId": messageId}
+        response = table_emails.delete_item(
+            Key={"destination": destination, "messageId": messageId},
+            ReturnValues="ALL_OLD",
         )
     except ClientError as e:
         logger.error("## DynamoDB Client Exception")
         logger.error(e.response["Error"]["Message"])
         raise e.response["Error"]["Message"]
+    deleted = response.get("Attributes")
+    if deleted and "visible_at" in deleted:
+        counts = email_counts(deleted)
+        update_counters(table_addresses, destination, **{name: -count for name, count in counts.items()})
 
 
 def lambda_handler(event, context):
@@ -66,11 +76,9 @@ def lambda_handler(event, context):
         if check_access(table_addresses, user_sub, destination):
             email_file = get_email_item(destination, messageId)
             if email_file is not None:
-                email_objects = s3.list_objects_v2(Bucket=email_file["bucketName"], Prefix=f"stored_emails/{destination}/{messageId}")
-                for email_object in email_objects['Contents']:
-                    logger.info(f"Deleting: {email_object['Key']}")
-                    s3.delete_object(Bucket=email_file["bucketName"], Key=email_object['Key'])
                 delete_email_item(destination, messageId)
+                # The stored object may be shared with other recipients
+                release_email(s3, ddb_client, table_emails, table_blobs, email_file)
                 return create_response(
                     status_code=200,
                     body=None,
@@ -1,11 +1,17 @@
 import os
+import time
 import logging
+import urllib.parse
 
 import boto3
 from botocore.exceptions import ClientError
 from aws_xray_sdk.core import xray_recorder, patch_all
 
 from util import check_access, create_response, get_user_sub_from_event
+from address_counters import update_counters
+from blob_store import attachment_object_key
+from stored_body import read_body
+from summary_queue import SUMMARIZE_ON_READ, SUMMARY_REQUEST_EXPIRY, queue_summary, summary_state
 
 if os.environ.get("XRAY_ENABLED", "false").lower() == "true":
     XRAY_NAME = os.environ.get("XRAY_NAME", "email-catcher")
@@ -18,9 +24,14 @@ logger.setLevel(LOGGING_LEVEL)
 
 ddb_client = boto3.resource("dynamodb")
 s3 = boto3.client("s3")
+sqs = boto3.client("sqs")
 
 table_addresses = ddb_client.Table(os.environ["ADDRESS_TABLE_NAME"])
 table_emails = ddb_client.Table(os.environ["EMAILS_TABLE_NAME"])
+SUMMARY_QUEUE_URL = os.environ["SUMMARY_QUEUE_URL"]
+
+# Seconds to wait for an on read summary before answering without it
+SUMMARY_READ_DEADLINE = float(os.environ.get("SUMMARY_READ_DEADLINE_SECONDS", 8))
 
 
 def get_email_file(destination, messageId):
@@ -40,29 +51,106 @@ def get_email_file(destination, messageId):
         raise e.response["Error"]["Message"]
 
 
-def set_as_read(destination, messageId):
+def set_as_read(email_file):
+    """Mark the email read, once for concurrent requests, and take it off
+    the unread counter of its address if it was counted"""
     try:
         table_emails.update_item(
-            Key={"destination": destination, "messageId": messageId},
+            Key={"destination": email_file["destination"], "messageId": email_file["messageId"]},
             UpdateExpression="SET is_read = :updated",
+            ConditionExpression="attribute_exists(messageId) AND is_read <> :updated",
             ExpressionAttributeValues={":updated": True},
         )
     except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            logger.info("## Email already read")
+            return
         logger.error("## DynamoDB Client Exception")
         logger.error(e.response["Error"]["Message"])
         raise e.response["Error"]["Message"]
+    if "visible_at" in email_file:
+        update_counters(table_addresses, email_file["destination"], unread=-1)
+
+
+def summarize_on_read(address, email_file):
+    """Whether opening email_file should request its summary, emails that
+    already had a summary attempt are left alone"""
+    return (
+        address.get("summarize_emails") is True
+        and address.get("summarize_mode") == SUMMARIZE_ON_READ
+        and email_file.get("is_processed") is True
+        and "summary_text" not in email_file
+    )
+
+
+def request_summary(email_file):
+    """Queue the summary of an opened email, once for concurrent requests
+
+    The request is claimed on the email row, so only the first of several
+    simultaneous fetches sends a job.
+    """
+    now = int(time.time())
+    try:
+        table_emails.update_item(
+            Key={"destination": email_file["destination"], "messageId": email_file["messageId"]},
+            UpdateExpression="SET summary_requested_at = :now",
+            ConditionExpression="attribute_not_exists(summary_text) AND "
+            "(attribute_not_exists(summary_requested_at) OR summary_requested_at < :expired)",
+            ExpressionAttributeValues={":now": now, ":expired": now - SUMMARY_REQUEST_EXPIRY},
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        logger.info("## Summary already requested")
+        return
+    queue_summary(sqs, SUMMARY_QUEUE_URL, email_file, on_read=True)
+
+
+def wait_for_summary(destination, messageId, deadline):
+    """Poll the summary attributes of the email row until the summary or
+    its first streamed text is there, or the monotonic deadline passes"""
+    delay = 0.25
+    while True:
+        item = table_emails.get_item(
+            Key={"destination": destination, "messageId": messageId},
+            ProjectionExpression="summary_text, summary_partial, summary_requested_at",
+            ConsistentRead=True,
+        ).get("Item", {})
+        if "summary_text" in item or "summary_partial" in item or time.monotonic() + delay >= deadline:
+            return item
+        time.sleep(delay)
+        delay = min(delay * 2, 1)
+
+
+def content_disposition(filename) -> str:
+    """Content-Disposition keeping the filename, RFC 6266 style
+
+    filename holds an ASCII fallback for old clients, filename* the name
+    itself percent-encoded as UTF-8.
+    """
+    filename = filename or "attachment"
+    fallback = "".join(
+        char if " " <= char <= "~" and char not in '"\\' else "_" for char in filename
+    )
+    return f"inline; filename=\"{fallback}\"; filename*=UTF-8''{urllib.parse.quote(filename, safe='')}"
 
 
 def generate_presigned_urls(attachments, bucket, destination, messageId):
     urls = []
     for attachment in attachments:
         try:
+            params = {
+                "Bucket": bucket,
+                "Key": attachment_object_key(attachment, destination, messageId),
+            }
+            if attachment.get("sha256"):
+                # Blobs are shared between emails, keep this email's filename on download
+                params["ResponseContentDisposition"] = content_disposition(attachment.get("filename"))
+                if attachment.get("Content-Type"):
+                    params["ResponseContentType"] = attachment["Content-Type"]
             url = s3.generate_presigned_url(
                 "get_object",
-                Params={
-                    "Bucket": bucket,
-                    "Key": f"stored_emails/{destination}/{messageId}/attachments/{attachment.get('filename')}",
-                },
+                Params=params,
                 ExpiresIn=3600,  # URL expiration time in seconds
             )
             urls.append({"metadata": attachment, "url": url})
@@ -85,30 +173,41 @@ def lambda_handler(event, context):
         messageId = event["pathParameters"]["messageId"]
         user_sub = get_user_sub_from_event(event)
 
-        has_access = check_access(table_addresses, user_sub, destination)
+        has_access, address = check_access(table_addresses, user_sub, destination, full_response=True)
         logger.info(f"## has_access: {has_access}")
         if has_access:
             email_file = get_email_file(destination, messageId)
             if email_file is not None:
-                data = s3.get_object(
-                    Bucket=email_file["bucketName"], Key=email_file["bucketObjectKey"]
+                # The summary is made while the body is read and signed
+                deadline = time.monotonic() + SUMMARY_READ_DEADLINE
+                summary_requested = summarize_on_read(address, email_file)
+                if summary_requested:
+                    request_summary(email_file)
+
+                email_content_bytes = read_body(
+                    s3, email_file["bucketName"], email_file["bucketObjectKey"]
                 )
-                email_content_bytes = data["Body"].read()
                 contents = email_content_bytes.decode("utf-8")
-                summary = email_file.get("summary_text", None)
 
                 # Generate pre-signed URLs for attachments
                 attachments = email_file.get("attachments", [])
                 presigned_urls = generate_presigned_urls(attachments, email_file["bucketName"], destination, messageId)
 
+                summary = summary_state(email_file)
+                if summary_requested:
+                    summary = summary_state(wait_for_summary(destination, messageId, deadline))
+
                 email_response = {
                     "body": contents,
-                    "summary": summary,
+                    "summary": summary["summary"],
+                    # While pending, poll the summary endpoint for the rest of it
+                    "summary_partial": summary["partial"],
+                    "summary_pending": summary["pending"],
                     "attachments": presigned_urls,
                 }
 
                 if not email_file["is_read"]:
-                    set_as_read(destination, messageId)
+                    set_as_read(email_file)
 
                 return create_response(
                     status_code=200,
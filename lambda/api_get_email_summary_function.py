@@ -0,0 +1,49 @@
+import os
+import logging
+
+import boto3
+from aws_xray_sdk.core import xray_recorder, patch_all
+
+from util import check_access, create_response, get_user_sub_from_event
+from summary_queue import summary_state
+
+if os.environ.get("XRAY_ENABLED", "false").lower() == "true":
+    XRAY_NAME = os.environ.get("XRAY_NAME", "email-catcher")
+    xray_recorder.configure(service=XRAY_NAME)
+    patch_all()
+
+LOGGING_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+logger = logging.getLogger()
+logger.setLevel(LOGGING_LEVEL)
+
+ddb_client = boto3.resource("dynamodb")
+
+table_addresses = ddb_client.Table(os.environ["ADDRESS_TABLE_NAME"])
+table_emails = ddb_client.Table(os.environ["EMAILS_TABLE_NAME"])
+
+
+def lambda_handler(event, context):
+    """Polled by an open email while its summary is generated, the response
+    is only a few attributes of the row"""
+    logger.info("## EVENT")
+    logger.info(event)
+
+    try:
+        destination = event["pathParameters"]["addressId"]
+        messageId = event["pathParameters"]["messageId"]
+        user_sub = get_user_sub_from_event(event)
+
+        if not check_access(table_addresses, user_sub, destination):
+            return create_response(status_code=401, body=None)
+
+        response = table_emails.get_item(
+            Key={"destination": destination, "messageId": messageId},
+            ProjectionExpression="summary_text, summary_partial, summary_requested_at",
+            ConsistentRead=True,
+        )
+        if "Item" not in response:
+            return create_response(status_code=404, body=None)
+        return create_response(status_code=200, body=summary_state(response["Item"]))
+    except Exception as e:
+        logger.exception(e)
+        return create_response(status_code=500, body=str(e))
@@ -1,4 +1,6 @@
 import os
+import re
+import time
 import logging
 
 import boto3
@@ -6,7 +8,8 @@ from botocore.exceptions import ClientError
 from boto3.dynamodb.conditions import Key, Attr
 from aws_xray_sdk.core import xray_recorder, patch_all
 
-from util import check_access, create_response, get_user_sub_from_event
+from util import BATCH_GET_LIMIT, BATCH_RETRY_ATTEMPTS, backoff, check_access, create_response, get_user_sub_from_event
+from page_cursor import InvalidCursor, decode_cursor, encode_cursor, load_cursor_key
 
 
 if os.environ.get("XRAY_ENABLED", "false").lower() == "true":
@@ -21,19 +24,187 @@ logger.setLevel(LOGGING_LEVEL)
 ddb_client = boto3.resource("dynamodb")
 table_addresses = ddb_client.Table(os.environ["ADDRESS_TABLE_NAME"])
 table_emails = ddb_client.Table(os.environ["EMAILS_TABLE_NAME"])
+cursor_key = load_cursor_key(boto3.client("ssm"), os.environ["CURSOR_KEY_PARAMETER"])
 
+# Sparse index of processed emails, newest first
+VISIBLE_INDEX = "DestinationVisibleIndex"
+# While the index is being built the list falls back to the table, the
+# status is checked again after this many seconds
+INDEX_STATUS_TTL = 60
+index_status = {"active": False, "checked_at": 0.0}
 
-def get_emails(destination, user_sub):
+# Attributes of a list item, the only ones the visible index projects. Other
+# attributes are fetched from the table when asked for with fields=
+LIST_FIELDS = (
+    "destination",
+    "messageId",
+    "timestamp",
+    "sender",
+    "subject",
+    "date",
+    "preview",
+    "attachment_count",
+    "is_read",
+)
+FIELD_NAME = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+MAX_EXTRA_FIELDS = 20
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 100
+# Queries made for one page at most. Reading the table, unprocessed emails
+# are filtered out after the read so a page can come back short; its cursor
+# still moves on
+MAX_QUERIES_PER_PAGE = 5
+
+
+def visible_index_active() -> bool:
+    """Whether the visible index is queryable, it stays active until a query
+    finds it gone"""
+    now = time.monotonic()
+    if not index_status["active"] and now - index_status["checked_at"] > INDEX_STATUS_TTL:
+        index_status["checked_at"] = now
+        try:
+            indexes = table_emails.meta.client.describe_table(TableName=table_emails.name)["Table"].get(
+                "GlobalSecondaryIndexes", []
+            )
+        except ClientError as e:
+            logger.error("## Unable to describe emails table")
+            logger.error(e.response["Error"]["Message"])
+            return False
+        index_status["active"] = any(
+            index["IndexName"] == VISIBLE_INDEX and index["IndexStatus"] == "ACTIVE" for index in indexes
+        )
+    return index_status["active"]
+
+
+def index_unavailable(e: ClientError) -> bool:
+    """Whether a query failed because the visible index is gone or not
+    queryable, the index is then checked again before it is used"""
+    if e.response["Error"]["Code"] not in ("ValidationException", "ResourceNotFoundException"):
+        return False
+    index_status["active"] = False
+    index_status["checked_at"] = time.monotonic()
+    logger.warning(f"## {VISIBLE_INDEX} unavailable, reading the table")
+    return True
+
+
+def parse_fields(value) -> list:
+    """Attributes asked for on top of the list fields, from a comma separated
+    fields= parameter"""
+    if not value:
+        return []
+    fields = [field.strip() for field in value.split(",") if field.strip()]
+    if len(fields) > MAX_EXTRA_FIELDS or not all(FIELD_NAME.fullmatch(field) for field in fields):
+        raise ValueError(f"Invalid fields {value!r}")
+    return [field for field in dict.fromkeys(fields) if field not in LIST_FIELDS]
+
+
+def projection(fields) -> dict:
+    """ProjectionExpression arguments for fields, names are placeholders as
+    several list fields are reserved words"""
+    names = {f"#f{position}": field for position, field in enumerate(fields)}
+    return {"ProjectionExpression": ", ".join(names), "ExpressionAttributeNames": names}
+
+
+def add_fields(destination, items, fields):
+    """Copy fields from the table rows of items into items, for attributes
+    the visible index does not project"""
+    by_id = {item["messageId"]: item for item in items}
+    message_ids = list(by_id)
+    for start in range(0, len(message_ids), BATCH_GET_LIMIT):
+        request = {
+            table_emails.name: {
+                "Keys": [
+                    {"destination": destination, "messageId": message_id}
+                    for message_id in message_ids[start : start + BATCH_GET_LIMIT]
+                ],
+                **projection(("messageId", *fields)),
+            }
+        }
+        attempt = 0
+        while request:
+            response = ddb_client.batch_get_item(RequestItems=request)
+            for row in response["Responses"].get(table_emails.name, []):
+                by_id[row["messageId"]].update(row)
+            request = response.get("UnprocessedKeys")
+            if request:
+                attempt += 1
+                if attempt > BATCH_RETRY_ATTEMPTS:
+                    raise RuntimeError("Unprocessed keys left after retries")
+                backoff(attempt)
+
+
+def query_page(destination, limit, start_key, index_name=None, fields=LIST_FIELDS):
+    """Up to limit processed emails of destination from start_key on, newest
+    first when read from the visible index
+
+    :return: the emails and the key to continue from, None at the end
+    """
+    items = []
+    query_kwargs = {
+        "KeyConditionExpression": Key("destination").eq(destination),
+        **projection(fields),
+    }
+    if index_name is not None:
+        # Only processed emails are in the index, nothing is read to be dropped
+        query_kwargs["IndexName"] = index_name
+        query_kwargs["ScanIndexForward"] = False
+    else:
+        query_kwargs["FilterExpression"] = Attr("is_processed").eq(True)
+    for _ in range(MAX_QUERIES_PER_PAGE):
+        if start_key is not None:
+            query_kwargs["ExclusiveStartKey"] = start_key
+        # Limit counts evaluated items, so a page never overshoots its cursor
+        response = table_emails.query(Limit=limit - len(items), **query_kwargs)
+        items.extend(response["Items"])
+        start_key = response.get("LastEvaluatedKey")
+        if start_key is None or len(items) >= limit:
+            break
+    return items, start_key
+
+
+def get_emails(destination, user_sub, limit=DEFAULT_PAGE_SIZE, cursor=None, extra_fields=()):
+    """One page of the emails of destination and the cursor of the next page
+
+    :param extra_fields: attributes returned on top of LIST_FIELDS
+    """
     try:
         if check_access(table_addresses, user_sub, destination):
-            filter_key = Key("destination").eq(destination)
-            filter_attr = Attr("is_processed").eq(True)
-            response = table_emails.query(KeyConditionExpression=filter_key, FilterExpression=filter_attr)
-            items = response["Items"]
-            sorted_items = sorted(items, key=lambda x: x["timestamp"], reverse=True)
-            return sorted_items
+            # A cursor keeps paging the source it was issued for
+            if cursor:
+                position = decode_cursor(cursor_key, destination, cursor)
+                if "key" in position:
+                    index_name, start_key = position["index"], position["key"]
+                else:
+                    # Issued before the list read an index, a plain table key
+                    index_name, start_key = None, position
+                if index_name not in (None, VISIBLE_INDEX):
+                    raise InvalidCursor("Cursor for an index that was replaced")
+            else:
+                index_name, start_key = (VISIBLE_INDEX if visible_index_active() else None), None
+            if index_name is not None:
+                try:
+                    items, last_key = query_page(destination, limit, start_key, index_name)
+                except ClientError as e:
+                    if not index_unavailable(e):
+                        raise
+                    if start_key is not None:
+                        # Index keys are no position in the table
+                        raise InvalidCursor("Cursor for an index that was removed") from e
+                    index_name = None
+                else:
+                    if extra_fields and items:
+                        add_fields(destination, items, extra_fields)
+            if index_name is None:
+                # The table has every attribute, read them all in the query
+                items, last_key = query_page(destination, limit, start_key, None, (*LIST_FIELDS, *extra_fields))
+                items = sorted(items, key=lambda x: x["timestamp"], reverse=True)
+            next_cursor = None
+            if last_key:
+                next_cursor = encode_cursor(cursor_key, destination, {"index": index_name, "key": last_key})
+            return items, next_cursor
         else:
-            return []
+            return [], None
     except ClientError as e:
         logger.error("## DynamoDB Client Exception")
         logger.error(e.response["Error"]["Message"])
@@ -48,9 +219,16 @@ def lambda_handler(event, context):
     try:
         destination = event["pathParameters"]["addressId"]
         user_sub = get_user_sub_from_event(event)
-        items = get_emails(destination, user_sub)
+        query = event.get("queryStringParameters") or {}
+        limit = min(max(int(query.get("limit", DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+        extra_fields = parse_fields(query.get("fields"))
+        items, cursor = get_emails(destination, user_sub, limit, query.get("cursor"), extra_fields)
 
-        return create_response(status_code=200, body=items)
+        return create_response(status_code=200, body={"items": items, "cursor": cursor})
+    except ValueError as e:
+        # A limit that is not a number, bad fields or an InvalidCursor
+        logger.warning(f"## Bad page request: {e}")
+        return create_response(status_code=400, body="Invalid request data")
     except Exception as e:
         logger.exception(e)
         return create_response(status_code=500, body=e)
@@ -8,6 +8,7 @@ from botocore.exceptions import ClientError
 from aws_xray_sdk.core import xray_recorder, patch_all
 
 from util import create_response, get_user_sub_from_event
+from summary_queue import SUMMARIZE_MODES, SUMMARIZE_ON_INGEST
 
 if os.environ.get("XRAY_ENABLED", "false").lower() == "true":
     XRAY_NAME = os.environ.get("XRAY_NAME", "email-catcher")
@@ -40,13 +41,19 @@ def address_exists(address: str):
         return False
 
 
-def create_address(address: str, user_sub: str, summarize_emails: bool = False):
+def create_address(
+    address: str,
+    user_sub: str,
+    summarize_emails: bool = False,
+    summarize_mode: str = SUMMARIZE_ON_INGEST,
+):
     try:
         table_addresses.put_item(
             Item={
                 "address": address.lower(),
                 "user_sub": user_sub,
                 "summarize_emails": summarize_emails,
+                "summarize_mode": summarize_mode,
             }
         )
     except ClientError as e:
@@ -83,7 +90,10 @@ def lambda_handler(event, context):
         body = json.loads(event["body"])
         new_address = body.get("new_address", None)
         summarize_emails = body.get("summarize_emails", None)
+        summarize_mode = body.get("summarize_mode") or SUMMARIZE_ON_INGEST
 
+        if summarize_mode not in SUMMARIZE_MODES:
+            return create_response(status_code=400, body="Invalid request data")
         if validate_email(new_address):
             if address_exists(new_address):
                 message = "email address already exists, please use a different address"
@@ -91,7 +101,7 @@ def lambda_handler(event, context):
                 return create_response(status_code=400, body=message)
             else:
                 logger.info(f"## Creating {new_address}")
-                create_address(new_address, user_sub, summarize_emails)
+                create_address(new_address, user_sub, summarize_emails, summarize_mode)
                 message = "email address created"
                 return create_response(status_code=201, body=message)
         else:
@@ -0,0 +1,195 @@
+import time
+import uuid
+import hashlib
+import logging
+
+from botocore.exceptions import ClientError
+
+from mime_stream import DEFAULT_PART_SIZE, MultipartUploadWriter
+from util import backoff
+
+logger = logging.getLogger()
+
+BLOB_PREFIX = "blobs/sha256"
+TEMP_PREFIX = "blobs/tmp"
+# A blob is tombstoned before its object is deleted and new references wait
+# for the row to go. A tombstone older than this was left by a release that
+# died halfway, the next reference takes the row over
+TOMBSTONE_EXPIRY = 15 * 60
+ACQUIRE_ATTEMPTS = 10
+
+
+def blob_key(digest: str) -> str:
+    return f"{BLOB_PREFIX}/{digest[:2]}/{digest}"
+
+
+def attachment_object_key(attachment: dict, destination: str, messageId: str) -> str:
+    """S3 key of an attachment, for blobs as well as the per message layout used before them"""
+    if attachment.get("sha256"):
+        return blob_key(attachment["sha256"])
+    return f"stored_emails/{destination}/{messageId}/attachments/{attachment.get('filename')}"
+
+
+def acquire(table, digest: str) -> bool:
+    """Take a reference on a blob
+
+    :return: True if the blob content is already in S3 and the upload can be skipped
+
+    A retried invocation takes a second reference, which only keeps the blob
+    around longer than needed, never shorter. A blob being deleted is waited
+    for, the reference then starts a new row and the content is uploaded
+    again.
+    """
+    for attempt in range(ACQUIRE_ATTEMPTS):
+        try:
+            response = table.update_item(
+                Key={"sha256": digest},
+                UpdateExpression="ADD ref_count :one",
+                ConditionExpression="attribute_not_exists(deleting)",
+                ExpressionAttributeValues={":one": 1},
+                ReturnValues="ALL_NEW",
+            )
+            return bool(response["Attributes"].get("stored"))
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+        if take_over(table, digest):
+            return False
+        logger.info(f"## Blob {digest} is being deleted, waiting")
+        backoff(attempt + 1)
+    raise RuntimeError(f"Blob {digest} is still being deleted")
+
+
+def take_over(table, digest: str) -> bool:
+    """Revive the row of a blob whose release died after tombstoning it
+
+    :return: True if the row now holds the only reference and the content
+        has to be uploaded again
+    """
+    try:
+        table.update_item(
+            Key={"sha256": digest},
+            UpdateExpression="SET ref_count = :one REMOVE deleting, stored",
+            ConditionExpression="deleting < :expired",
+            ExpressionAttributeValues={":one": 1, ":expired": int(time.time()) - TOMBSTONE_EXPIRY},
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        return False
+    logger.warning(f"## Took over stale tombstone of blob {digest}")
+    return True
+
+
+def mark_stored(table, digest: str):
+    table.update_item(
+        Key={"sha256": digest},
+        UpdateExpression="SET stored = :stored",
+        ExpressionAttributeValues={":stored": True},
+    )
+
+
+def store_blob(s3, table, bucket: str, data: bytes, content_type: str = None) -> dict:
+    digest = hashlib.sha256(data).hexdigest()
+    if acquire(table, digest):
+        logger.info(f"## Blob {digest} already stored, skipping upload")
+    else:
+        put_kwargs = {"ContentType": content_type} if content_type else {}
+        s3.put_object(Bucket=bucket, Key=blob_key(digest), Body=data, **put_kwargs)
+        mark_stored(table, digest)
+    return {"sha256": digest, "size": len(data)}
+
+
+def release(s3, table, bucket: str, digest: str):
+    """Drop a reference on a blob and delete it once nothing refers to it"""
+    try:
+        response = table.update_item(
+            Key={"sha256": digest},
+            UpdateExpression="ADD ref_count :minus_one",
+            ExpressionAttributeValues={":minus_one": -1},
+            ReturnValues="UPDATED_NEW",
+        )
+        if response["Attributes"]["ref_count"] > 0:
+            return
+        # Only if no new reference was taken in the meantime. From here on
+        # acquire waits instead of referencing the object being deleted
+        tombstone = int(time.time())
+        table.update_item(
+            Key={"sha256": digest},
+            UpdateExpression="SET deleting = :tombstone",
+            ConditionExpression="ref_count <= :zero AND attribute_not_exists(deleting)",
+            ExpressionAttributeValues={":zero": 0, ":tombstone": tombstone},
+        )
+        logger.info(f"## Deleting unreferenced blob {digest}")
+        s3.delete_object(Bucket=bucket, Key=blob_key(digest))
+        table.delete_item(
+            Key={"sha256": digest},
+            ConditionExpression="deleting = :tombstone",
+            ExpressionAttributeValues={":tombstone": tombstone},
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            return
+        logger.error(f"## Failed to release blob {digest}")
+        logger.error(e.response["Error"]["Message"])
+
+
+def release_attachments(s3, table, bucket: str, attachments):
+    for attachment in attachments or []:
+        if attachment.get("sha256"):
+            release(s3, table, bucket, attachment["sha256"])
+
+
+class BlobWriter(MultipartUploadWriter):
+    """Streaming counterpart of store_blob
+
+    Content is hashed as it is written. Blobs that fit in a single part are
+    stored directly once closed; larger ones are uploaded to a temporary key
+    and moved under their digest afterwards, or dropped if the blob exists.
+    """
+
+    def __init__(self, s3, table, bucket: str, part_size: int = DEFAULT_PART_SIZE, executor=None, content_type: str = None):
+        put_kwargs = {"ContentType": content_type} if content_type else {}
+        super().__init__(s3, bucket, f"{TEMP_PREFIX}/{uuid.uuid4()}", part_size, executor, **put_kwargs)
+        self.table = table
+        self.content_type = content_type
+        self.hash = hashlib.sha256()
+        self.blob = None
+
+    def write(self, data: bytes):
+        self.hash.update(data)
+        super().write(data)
+
+    def close(self):
+        digest = self.hash.hexdigest()
+        if self.upload_id is None:
+            body = bytes(self.buffer)
+            self.buffer = bytearray()
+            self._run(store_blob, self.s3, self.table, self.bucket, body, self.content_type)
+        else:
+            super().close()
+            self._run(self._promote, digest)
+
+    def _run(self, fn, *args):
+        if self.executor is None:
+            self.blob = fn(*args)
+        else:
+            self.pending = self.executor.submit(fn, *args)
+
+    def _promote(self, digest: str) -> dict:
+        if acquire(self.table, digest):
+            logger.info(f"## Blob {digest} already stored, dropping upload")
+        else:
+            self.s3.copy_object(
+                CopySource={"Bucket": self.bucket, "Key": self.key},
+                Bucket=self.bucket,
+                Key=blob_key(digest),
+            )
+            mark_stored(self.table, digest)
+        self.s3.delete_object(Bucket=self.bucket, Key=self.key)
+        return {"sha256": digest, "size": self.size}
+
+    def wait(self):
+        if self.pending is not None:
+            self.blob = self.pending.result()
+        return self.blob
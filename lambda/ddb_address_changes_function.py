@@ -0,0 +1,52 @@
+import os
+import logging
+
+import boto3
+from aws_xray_sdk.core import xray_recorder, patch_all
+
+from address_index import append_changes, update_bloom
+
+if os.environ.get("XRAY_ENABLED", "false").lower() == "true":
+    XRAY_NAME = os.environ.get("XRAY_NAME", "email-catcher")
+    xray_recorder.configure(service=XRAY_NAME)
+    patch_all()
+
+LOGGING_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+logger = logging.getLogger()
+logger.setLevel(LOGGING_LEVEL)
+
+s3 = boto3.client("s3")
+ddb_client = boto3.resource("dynamodb")
+table_addresses = ddb_client.Table(os.environ["ADDRESS_TABLE_NAME"])
+address_index_bucket = os.environ["ADDRESS_INDEX_BUCKET"]
+
+
+def changed_addresses(records, event_names=("INSERT", "REMOVE")):
+    """Addresses that were created or deleted, updates don't change existence"""
+    addresses = []
+    for record in records:
+        if record["eventName"] not in event_names:
+            continue
+        address = record["dynamodb"]["Keys"]["address"]["S"]
+        if address not in addresses:
+            addresses.append(address)
+    return addresses
+
+
+def lambda_handler(event, context):
+    logger.info("## ENVIRONMENT VARIABLES")
+    logger.info(os.environ)
+    logger.info("## EVENT")
+    logger.info(event)
+
+    addresses = changed_addresses(event["Records"])
+    if not addresses:
+        return
+    # The feed goes first, a reader holding a filter older than the newest
+    # change looks addresses up instead of trusting its misses. A filter
+    # update that keeps failing then leaves the filter unused, not wrong
+    logger.info(f"## Publishing {len(addresses)} address changes")
+    append_changes(s3, address_index_bucket, addresses)
+    added = changed_addresses(event["Records"], event_names=("INSERT",))
+    bloom = update_bloom(s3, table_addresses, address_index_bucket, added, len(addresses) - len(added))
+    logger.info(f"## Address filter holds {bloom.count} addresses")
@@ -0,0 +1,282 @@
+import json
+import binascii
+import quopri
+import logging
+from email import policy
+from email.parser import BytesHeaderParser
+
+logger = logging.getLogger()
+
+ARTIFACT_VERSION = 1
+# Bounds for the extracted text body: the full artifact keeps more than the
+# state machine payload, which has to stay well under the 256KB Step Functions limit.
+ARTIFACT_TEXT_LIMIT = 65536
+PAYLOAD_TEXT_LIMIT = 16384
+MAX_PART_DEPTH = 32
+DEFAULT_ATTACHMENT_FILENAME = "inline_attachment"
+
+header_parser = BytesHeaderParser(policy=policy.default)
+
+
+def artifact_key(object_key: str) -> str:
+    return f"{object_key}.artifact.json"
+
+
+def is_attachment(headers) -> bool:
+    content_disposition = headers.get("Content-Disposition", "")
+    return "attachment" in content_disposition or "inline" in content_disposition
+
+
+def decode_payload(data: bytes, encoding) -> bytes:
+    encoding = (encoding or "7bit").lower()
+    if encoding == "base64":
+        try:
+            return binascii.a2b_base64(data)
+        except binascii.Error:
+            # Tolerate bad padding the same way the email package does
+            try:
+                return binascii.a2b_base64(data.rstrip() + b"==")
+            except binascii.Error:
+                return data
+    if encoding == "quoted-printable":
+        return quopri.decodestring(data)
+    return data
+
+
+def decode_text(data: bytes, charset) -> str:
+    try:
+        return data.decode(charset or "utf-8", errors="replace")
+    except LookupError:
+        return data.decode("utf-8", errors="replace")
+
+
+def _header_block(raw: bytes, start: int, end: int):
+    """Return the offset where the body of the part starting at start begins."""
+    if raw.startswith(b"\r\n", start, end):
+        return start + 2
+    if raw.startswith(b"\n", start, end):
+        return start + 1
+    crlf = raw.find(b"\r\n\r\n", start, end)
+    lf = raw.find(b"\n\n", start, end)
+    candidates = []
+    if crlf != -1:
+        candidates.append((crlf, crlf + 4))
+    if lf != -1:
+        candidates.append((lf, lf + 2))
+    if not candidates:
+        return end
+    return min(candidates)[1]
+
+
+def _split_multipart(raw: bytes, boundary: bytes, start: int, end: int):
+    """Return the (start, end) spans of the sub-parts between the boundary lines."""
+    delimiter = b"--" + boundary
+    spans = []
+    part_start = None
+    pos = start
+    while pos < end:
+        idx = raw.find(delimiter, pos, end)
+        if idx == -1:
+            break
+        if idx != start and raw[idx - 1 : idx] != b"\n":
+            pos = idx + 1
+            continue
+        line_end = raw.find(b"\n", idx, end)
+        line_end = end if line_end == -1 else line_end + 1
+        is_close = raw.startswith(b"--", idx + len(delimiter), end)
+        tail = raw[idx + len(delimiter) + (2 if is_close else 0) : line_end]
+        if tail.strip():
+            # A longer boundary that happens to share our prefix
+            pos = idx + 1
+            continue
+        if part_start is not None:
+            # The line break in front of a delimiter belongs to the delimiter
+            part_end = idx
+            if raw[part_end - 2 : part_end] == b"\r\n":
+                part_end -= 2
+            elif raw[part_end - 1 : part_end] == b"\n":
+                part_end -= 1
+            spans.append((part_start, max(part_end, part_start)))
+        if is_close:
+            return spans
+        part_start = line_end
+        pos = line_end
+    if part_start is not None:
+        spans.append((part_start, end))
+    return spans
+
+
+def leaf_fields(headers) -> dict:
+    encoding = headers.get("Content-Transfer-Encoding")
+    return {
+        "encoding": str(encoding).strip().lower() if encoding else "7bit",
+        "charset": headers.get_content_charset(),
+    }
+
+
+def manifest_entry(headers, node: dict) -> dict:
+    """Attachment manifest entry for a leaf part, or None if it is not an attachment"""
+    if not is_attachment(headers):
+        return None
+    filename = headers.get_filename() or DEFAULT_ATTACHMENT_FILENAME
+    node["filename"] = filename
+    encoding = headers.get("Content-Transfer-Encoding")
+    return {
+        "filename": filename,
+        "Content-Type": headers.get_content_type(),
+        "Content-Transfer-Encoding": str(encoding) if encoding else None,
+        "Content-ID": str(headers["Content-ID"]) if headers["Content-ID"] else None,
+        "X-Attachment-Id": str(headers["X-Attachment-Id"]) if headers["X-Attachment-Id"] else None,
+        "body": node["body"],
+        "encoding": node["encoding"],
+    }
+
+
+def is_text_body(headers) -> bool:
+    return headers.get_content_type() in ("text/plain", "text/html") and (
+        headers.get_content_disposition() != "attachment"
+    )
+
+
+def header_map(headers) -> dict:
+    result = {}
+    for name, value in headers.items():
+        name = name.lower()
+        value = str(value)
+        if name in result:
+            if not isinstance(result[name], list):
+                result[name] = [result[name]]
+            result[name].append(value)
+        else:
+            result[name] = value
+    return result
+
+
+def _index_part(raw: bytes, start: int, end: int, depth: int, state: dict):
+    body_start = _header_block(raw, start, end)
+    headers = header_parser.parsebytes(raw[start:body_start])
+    node = {
+        "content_type": headers.get_content_type(),
+        "offset": [start, end],
+        "body": [body_start, end],
+    }
+    boundary = headers.get_boundary()
+    if headers.get_content_maintype() == "multipart" and boundary and depth < MAX_PART_DEPTH:
+        node["parts"] = [
+            _index_part(raw, part_start, part_end, depth + 1, state)
+            for part_start, part_end in _split_multipart(
+                raw, boundary.encode("utf-8", errors="replace"), body_start, end
+            )
+        ]
+        return node
+
+    node.update(leaf_fields(headers))
+    attachment = manifest_entry(headers, node)
+    if attachment is not None:
+        state["attachments"].append(attachment)
+    if is_text_body(headers):
+        state["text_parts"].setdefault(node["content_type"], node)
+    return node
+
+
+def build_artifact(raw: bytes) -> dict:
+    """Parse a raw email once into the artifact shared by the pipeline stages
+
+    :param raw: bytes of the .eml object
+    :return: dict with the header map, the part tree with byte offsets,
+        the extracted text body and the attachment manifest
+    """
+    state = {"attachments": [], "text_parts": {}}
+    root = _index_part(raw, 0, len(raw), 0, state)
+    top_headers = header_parser.parsebytes(raw[: _header_block(raw, 0, len(raw))])
+
+    text, text_type = None, None
+    for content_type in ("text/plain", "text/html"):
+        part = state["text_parts"].get(content_type)
+        if part is not None:
+            body_start, body_end = part["body"]
+            payload = decode_payload(raw[body_start:body_end], part["encoding"])
+            text = decode_text(payload, part["charset"])[:ARTIFACT_TEXT_LIMIT]
+            text_type = content_type.split("/")[1]
+            break
+
+    return {
+        "version": ARTIFACT_VERSION,
+        "size": len(raw),
+        "headers": header_map(top_headers),
+        "parts": root,
+        "text": text,
+        "text_type": text_type,
+        "attachments": state["attachments"],
+    }
+
+
+def attachment_payload(raw: bytes, attachment: dict) -> bytes:
+    body_start, body_end = attachment["body"]
+    return decode_payload(raw[body_start:body_end], attachment["encoding"])
+
+
+def attachment_metadata(attachment: dict) -> dict:
+    """Attachment manifest entry without the parser bookkeeping, as stored in DynamoDB"""
+    return {k: v for k, v in attachment.items() if k not in ("body", "encoding")}
+
+
+def _shift_offsets(node: dict, shift):
+    for key in ("offset", "body"):
+        if key in node:
+            node[key] = [shift(node[key][0]), shift(node[key][1])]
+    for part in node.get("parts", []):
+        _shift_offsets(part, shift)
+
+
+def strip_attachments(raw: bytes, artifact: dict) -> bytes:
+    """Remove attachment bodies from the raw email without re-serializing it
+
+    The artifact offsets are rewritten in place to match the returned bytes.
+    """
+    removed = sorted(tuple(attachment["body"]) for attachment in artifact["attachments"])
+    if not removed:
+        return raw
+
+    pieces = []
+    pos = 0
+    for body_start, body_end in removed:
+        pieces.append(raw[pos:body_start])
+        pos = body_end
+    pieces.append(raw[pos:])
+
+    def shift(offset):
+        total = 0
+        for body_start, body_end in removed:
+            if body_end <= offset:
+                total += body_end - body_start
+            elif body_start < offset:
+                total += offset - body_start
+            else:
+                break
+        return offset - total
+
+    _shift_offsets(artifact["parts"], shift)
+    for attachment in artifact["attachments"]:
+        attachment["body"] = [shift(attachment["body"][0]), shift(attachment["body"][1])]
+    stripped = b"".join(pieces)
+    artifact["size"] = len(stripped)
+    return stripped
+
+
+def save_artifact(s3, bucket: str, key: str, artifact: dict):
+    s3.put_object(
+        Bucket=bucket,
+        Key=key,
+        Body=json.dumps(artifact, separators=(",", ":")).encode("utf-8"),
+        ContentType="application/json",
+    )
+
+
+def load_artifact(s3, bucket: str, key: str):
+    try:
+        data = s3.get_object(Bucket=bucket, Key=key)
+        return json.loads(data["Body"].read())
+    except Exception as e:
+        logger.warning(f"## Unable to load artifact {bucket}/{key}: {e}")
+        return None
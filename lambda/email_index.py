@@ -0,0 +1,119 @@
+import logging
+import posixpath
+from concurrent.futures import ThreadPoolExecutor
+
+from blob_store import release_attachments
+from email_artifact import artifact_key
+from util import BATCH_GET_LIMIT, BATCH_RETRY_ATTEMPTS, backoff
+
+logger = logging.getLogger()
+
+# An email sent to several registered addresses has one row per recipient,
+# all pointing at the same stored object
+row_executor = ThreadPoolExecutor(max_workers=10, thread_name_prefix="rows")
+
+
+def header_fields(common_headers) -> dict:
+    """Flat copies of the headers the email list shows, so the list reads
+    them without the whole commonHeaders map"""
+    return {
+        "sender": common_headers.get("sender") or common_headers.get("returnPath") or "",
+        "subject": common_headers.get("subject") or "",
+        "date": common_headers.get("date") or "",
+    }
+
+
+def email_recipients(message) -> list:
+    """Destinations of every row of the email, a single row for emails stored
+    before fan-out"""
+    return message.get("recipients") or [message["destination"]]
+
+
+def each_email_row(message, action, destinations=None):
+    """Call action(destination) for the row of every recipient, or of the
+    given destinations only"""
+    recipients = email_recipients(message) if destinations is None else destinations
+    if not recipients:
+        return
+    if len(recipients) == 1:
+        action(recipients[0])
+        return
+    for future in [row_executor.submit(action, destination) for destination in recipients]:
+        future.result()
+
+
+def update_email_rows(email_table, message, destinations=None, **update_kwargs):
+    """Apply the same update_item to the row of every recipient, or of the
+    given destinations only"""
+
+    def update(destination):
+        email_table.update_item(
+            Key={"destination": destination, "messageId": message["messageId"]},
+            **update_kwargs,
+        )
+
+    each_email_row(message, update, destinations)
+
+
+def other_rows_exist(ddb_client, email_table, item) -> bool:
+    """Whether another recipient still has a row for the stored object of item"""
+    others = [destination for destination in email_recipients(item) if destination != item["destination"]]
+    for start in range(0, len(others), BATCH_GET_LIMIT):
+        request = {
+            email_table.name: {
+                "Keys": [
+                    {"destination": destination, "messageId": item["messageId"]}
+                    for destination in others[start : start + BATCH_GET_LIMIT]
+                ],
+                "ProjectionExpression": "destination",
+            }
+        }
+        attempt = 0
+        while request:
+            response = ddb_client.batch_get_item(RequestItems=request)
+            if response["Responses"].get(email_table.name):
+                return True
+            request = response.get("UnprocessedKeys")
+            if request:
+                attempt += 1
+                if attempt > BATCH_RETRY_ATTEMPTS:
+                    raise RuntimeError("Unprocessed keys left after retries")
+                backoff(attempt)
+    return False
+
+
+def stored_object_keys(s3, item) -> list:
+    """Keys of the stored object of an email and everything derived from it
+
+    Emails copied under stored_emails/ own their whole directory. Emails
+    kept in place share incoming_mail/ with every other email, so only the
+    object and the keys derived from its name belong to them.
+    """
+    key = item["bucketObjectKey"]
+    if item.get("storageLayout") == "in_place":
+        return [key, artifact_key(key), key + ".orginal"]
+    prefix = posixpath.dirname(key) + "/"
+    email_objects = s3.list_objects_v2(Bucket=item["bucketName"], Prefix=prefix)
+    return [email_object["Key"] for email_object in email_objects.get("Contents", [])]
+
+
+def delete_stored_email(s3, table_blobs, item):
+    """Delete the stored object of an email, its derived objects and its
+    attachment references"""
+    release_attachments(s3, table_blobs, item["bucketName"], item.get("attachments"))
+    for key in stored_object_keys(s3, item):
+        logger.info(f"Deleting: {key}")
+        s3.delete_object(Bucket=item["bucketName"], Key=key)
+
+
+def release_email(s3, ddb_client, email_table, table_blobs, item):
+    """Clean up after the row of item was deleted
+
+    The stored object goes once the last recipient's row is gone. Two
+    recipients deleting at the same moment can both see the other row and
+    leave the object behind, never the other way around.
+    """
+    if other_rows_exist(ddb_client, email_table, item):
+        logger.info(f"## Stored email {item['bucketObjectKey']} still shared, keeping it")
+        return
+    delete_stored_email(s3, table_blobs, item)
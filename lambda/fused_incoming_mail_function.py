@@ -0,0 +1,71 @@
+import os
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from aws_xray_sdk.core import xray_recorder, patch_all
+
+from util import get_record_id, get_record_message
+
+# The stage modules are imported once per container, their clients and
+# thread pools are reused by every record this function processes
+import sm_store_email_function
+import sm_store_attachments_function
+import sm_mark_processed_function
+
+if os.environ.get("XRAY_ENABLED", "false").lower() == "true":
+    XRAY_NAME = os.environ.get("XRAY_NAME", "email-catcher")
+    xray_recorder.configure(service=XRAY_NAME)
+    patch_all()
+
+LOGGING_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+logger = logging.getLogger()
+logger.setLevel(LOGGING_LEVEL)
+
+PIPELINE_WORKERS = int(os.environ.get("PIPELINE_WORKERS", 4))
+
+pipeline_executor = ThreadPoolExecutor(max_workers=PIPELINE_WORKERS, thread_name_prefix="pipeline")
+
+
+def run_pipeline(record, context):
+    """Run the incoming mail state machine in process for an ingest record
+
+    Mirrors the state machine: the email is stored, its attachments are
+    extracted, then it is marked processed and its summary is queued.
+    Stages get their input as is, without a payload round trip.
+    """
+    message = json.loads(get_record_message(record))
+    logger.info(f"## Store Email: {message['mail']['messageId']}")
+    message = sm_store_email_function.lambda_handler(message, context)
+    if message["is_processed"]:
+        # A redelivered record, marking processed again only queues the
+        # summary, rows already counted are left alone
+        logger.info(f"## Already extracted: {message['messageId']}")
+    else:
+        logger.info(f"## Extract Attachments: {message['messageId']}")
+        message = sm_store_attachments_function.lambda_handler(message, context)
+    return sm_mark_processed_function.lambda_handler(message, context)
+
+
+def lambda_handler(event, context):
+    logger.info("## ENVIRONMENT VARIABLES")
+    logger.info(os.environ)
+    logger.info("## EVENT")
+    logger.info(event)
+
+    records = event["Records"]
+    futures = [pipeline_executor.submit(run_pipeline, record, context) for record in records]
+
+    # Failed records, unparsable ones included, go back to the queue, its
+    # redrive policy replaces the state machine retries
+    failures = []
+    for record, future in zip(records, futures):
+        try:
+            future.result()
+        except Exception as e:
+            logger.error(f"## Failed to process {get_record_id(record)}")
+            logger.exception(e)
+            failures.append({"itemIdentifier": get_record_id(record)})
+
+    logger.info(f"## Processed {len(records) - len(failures)} of {len(records)} emails")
+    return {"batchItemFailures": failures}
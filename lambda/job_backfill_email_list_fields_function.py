@@ -0,0 +1,129 @@
+import os
+import logging
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import boto3
+from botocore.exceptions import ClientError
+from boto3.dynamodb.conditions import Attr
+from aws_xray_sdk.core import xray_recorder, patch_all
+
+from email_artifact import load_artifact
+from email_index import header_fields
+from text_normalize import email_preview
+
+if os.environ.get("XRAY_ENABLED", "false").lower() == "true":
+    XRAY_NAME = os.environ.get("XRAY_NAME", "email-catcher")
+    xray_recorder.configure(service=XRAY_NAME)
+    patch_all()
+
+LOGGING_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+logger = logging.getLogger()
+logger.setLevel(LOGGING_LEVEL)
+
+s3 = boto3.client("s3")
+ddb_client = boto3.resource("dynamodb")
+email_table = ddb_client.Table(os.environ["EMAILS_TABLE_NAME"])
+
+# Stop picking up new pages with this much time left
+TIME_MARGIN_MS = 60 * 1000
+# Emails without a usable date sort after every other email
+UNKNOWN_TIMESTAMP = "1970-01-01T00:00:00.000Z"
+
+
+def email_timestamp(item) -> str:
+    """SES style timestamp from the Date header of an email row"""
+    date = (item.get("commonHeaders") or {}).get("date")
+    try:
+        parsed = parsedate_to_datetime(date)
+    except (TypeError, ValueError):
+        return UNKNOWN_TIMESTAMP
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.") + f"{parsed.microsecond // 1000:03d}Z"
+
+
+def email_list_fields(item) -> dict:
+    """The flat list fields ingest gives a processed email today"""
+    fields = header_fields(item.get("commonHeaders") or {})
+    fields["attachment_count"] = len(item.get("attachments") or [])
+    artifact = None
+    if item.get("artifactObjectKey"):
+        artifact = load_artifact(s3, item["bucketName"], item["artifactObjectKey"])
+    fields["preview"] = email_preview(artifact["text"], artifact["text_type"]) if artifact else ""
+    return fields
+
+
+def backfill_update(item) -> dict:
+    """update_item arguments filling in what the list index needs and item
+    is missing"""
+    timestamp = item.get("timestamp") or email_timestamp(item)
+    assignments = ["#timestamp = if_not_exists(#timestamp, :timestamp)"]
+    names = {"#timestamp": "timestamp"}
+    values = {":timestamp": timestamp}
+    if item.get("is_processed") is True:
+        assignments.append("visible_at = if_not_exists(visible_at, :timestamp)")
+        if "attachment_count" not in item:
+            for position, (name, value) in enumerate(email_list_fields(item).items()):
+                assignments.append(f"#f{position} = :f{position}")
+                names[f"#f{position}"] = name
+                values[f":f{position}"] = value
+    return {
+        "Key": {"destination": item["destination"], "messageId": item["messageId"]},
+        "UpdateExpression": "SET " + ", ".join(assignments),
+        # Rows deleted since the scan stay deleted
+        "ConditionExpression": "attribute_exists(messageId)",
+        "ExpressionAttributeNames": names,
+        "ExpressionAttributeValues": values,
+    }
+
+
+def lambda_handler(event, context):
+    """Fill in the attributes the email list reads on rows stored before
+    ingest set them: the timestamp, and on processed rows visible_at and
+    the flat list fields, so they appear in the sparse list index
+
+    Invoke with {} to start. When the time budget runs out the response
+    holds an exclusive_start_key, invoke again with that response as the
+    event until it comes back without one.
+    """
+    logger.info("## ENVIRONMENT VARIABLES")
+    logger.info(os.environ)
+    logger.info("## EVENT")
+    logger.info(event)
+
+    scan_kwargs = {
+        "FilterExpression": Attr("timestamp").not_exists()
+        | (
+            Attr("is_processed").eq(True)
+            & (Attr("visible_at").not_exists() | Attr("attachment_count").not_exists())
+        ),
+        "ProjectionExpression": "destination, messageId, commonHeaders, is_processed, #ts, "
+        "visible_at, attachment_count, attachments, bucketName, artifactObjectKey",
+        "ExpressionAttributeNames": {"#ts": "timestamp"},
+        "Limit": int(event.get("limit", 500)),
+    }
+    if event.get("exclusive_start_key"):
+        scan_kwargs["ExclusiveStartKey"] = event["exclusive_start_key"]
+
+    updated = 0
+    while True:
+        response = email_table.scan(**scan_kwargs)
+        for item in response.get("Items", []):
+            try:
+                email_table.update_item(**backfill_update(item))
+            except ClientError as e:
+                if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                    raise
+                continue
+            updated += 1
+        last_key = response.get("LastEvaluatedKey")
+        if last_key is None:
+            break
+        scan_kwargs["ExclusiveStartKey"] = last_key
+        if context.get_remaining_time_in_millis() < TIME_MARGIN_MS:
+            logger.info(f"## Out of time, continue from {last_key}")
+            return {"exclusive_start_key": last_key, "updated": updated}
+
+    logger.info(f"## Backfill done, updated {updated}")
+    return {"updated": updated}
@@ -0,0 +1,90 @@
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from boto3.dynamodb.conditions import Attr
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from aws_xray_sdk.core import xray_recorder, patch_all
+
+from stored_body import GZIP, encode_body, is_gzip
+
+if os.environ.get("XRAY_ENABLED", "false").lower() == "true":
+    XRAY_NAME = os.environ.get("XRAY_NAME", "email-catcher")
+    xray_recorder.configure(service=XRAY_NAME)
+    patch_all()
+
+LOGGING_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+logger = logging.getLogger()
+logger.setLevel(LOGGING_LEVEL)
+
+WORKERS = 8
+
+s3 = boto3.client("s3", config=Config(max_pool_connections=WORKERS))
+ddb_client = boto3.resource("dynamodb")
+email_table = ddb_client.Table(os.environ["EMAILS_TABLE_NAME"])
+executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="compress")
+
+# Stop picking up new pages with this much time left
+TIME_MARGIN_MS = 60 * 1000
+
+
+def compress_email(item):
+    """Compress the stored object of item unless another row sharing it
+    already did, then record the encoding on the row"""
+    bucket, key = item["bucketName"], item["bucketObjectKey"]
+    try:
+        data = s3.get_object(Bucket=bucket, Key=key)["Body"].read()
+    except ClientError as e:
+        logger.error(f"## Unable to read {bucket}/{key}")
+        logger.error(e.response["Error"]["Message"])
+        return False
+    if not is_gzip(data):
+        s3.put_object(Bucket=bucket, Key=key, Body=encode_body(data, GZIP))
+    email_table.update_item(
+        Key={"destination": item["destination"], "messageId": item["messageId"]},
+        UpdateExpression="SET bodyEncoding = :encoding",
+        ExpressionAttributeValues={":encoding": GZIP},
+    )
+    return True
+
+
+def lambda_handler(event, context):
+    """Backfill gzip compression of stored .eml objects
+
+    Invoke with {} to start. When the time budget runs out the response
+    holds an exclusive_start_key, invoke again with that response as the
+    event until it comes back without one.
+    """
+    logger.info("## ENVIRONMENT VARIABLES")
+    logger.info(os.environ)
+    logger.info("## EVENT")
+    logger.info(event)
+
+    scan_kwargs = {
+        # Emails still in the pipeline get their encoding from attachment extraction
+        "FilterExpression": Attr("is_processed").eq(True)
+        & (Attr("bodyEncoding").not_exists() | Attr("bodyEncoding").ne(GZIP)),
+        "ProjectionExpression": "destination, messageId, bucketName, bucketObjectKey",
+        "Limit": int(event.get("limit", 100)),
+    }
+    if event.get("exclusive_start_key"):
+        scan_kwargs["ExclusiveStartKey"] = event["exclusive_start_key"]
+
+    compressed, failed = 0, 0
+    while True:
+        response = email_table.scan(**scan_kwargs)
+        results = list(executor.map(compress_email, response.get("Items", [])))
+        compressed += results.count(True)
+        failed += results.count(False)
+        last_key = response.get("LastEvaluatedKey")
+        if last_key is None:
+            break
+        scan_kwargs["ExclusiveStartKey"] = last_key
+        if context.get_remaining_time_in_millis() < TIME_MARGIN_MS:
+            logger.info(f"## Out of time, continue from {last_key}")
+            return {"exclusive_start_key": last_key, "compressed": compressed, "failed": failed}
+
+    logger.info(f"## Backfill done, compressed {compressed}, failed {failed}")
+    return {"compressed": compressed, "failed": failed}
@@ -0,0 +1,127 @@
+import os
+import time
+import logging
+
+import boto3
+from botocore.exceptions import ClientError
+from boto3.dynamodb.conditions import Key
+from aws_xray_sdk.core import xray_recorder, patch_all
+
+from address_counters import COUNTER_FIELDS, email_counts
+
+if os.environ.get("XRAY_ENABLED", "false").lower() == "true":
+    XRAY_NAME = os.environ.get("XRAY_NAME", "email-catcher")
+    xray_recorder.configure(service=XRAY_NAME)
+    patch_all()
+
+LOGGING_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+logger = logging.getLogger()
+logger.setLevel(LOGGING_LEVEL)
+
+ddb_client = boto3.resource("dynamodb")
+table_addresses = ddb_client.Table(os.environ["ADDRESS_TABLE_NAME"])
+table_emails = ddb_client.Table(os.environ["EMAILS_TABLE_NAME"])
+
+# Sparse index of the emails the counters count, it projects what they need
+VISIBLE_INDEX = "DestinationVisibleIndex"
+# Stop picking up new addresses with this much time left
+TIME_MARGIN_MS = 60 * 1000
+# The index is eventually consistent, an email just processed can be
+# counted on the address before the index has it. Drift is only repaired
+# when a recount this many seconds later finds the same values
+CONFIRM_DELAY_SECONDS = 5
+
+
+def count_emails(address) -> dict:
+    """Counter values recounted from the visible emails of address"""
+    counters = dict.fromkeys(COUNTER_FIELDS, 0)
+    query_kwargs = {
+        "IndexName": VISIBLE_INDEX,
+        "KeyConditionExpression": Key("destination").eq(address),
+        "ProjectionExpression": "is_read, size_bytes",
+    }
+    while True:
+        response = table_emails.query(**query_kwargs)
+        for item in response["Items"]:
+            counts = email_counts(item)
+            counters["email_count"] += counts["emails"]
+            counters["unread_count"] += counts["unread"]
+            counters["stored_bytes"] += counts["stored_bytes"]
+        if "LastEvaluatedKey" not in response:
+            return counters
+        query_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def repair_counters(item, counters) -> bool:
+    """Set the counters of an address item to the recounted values
+
+    The write only goes through if the counters still hold what was read
+    before the recount, an email counted meanwhile leaves the address for
+    the next run instead of being lost.
+
+    :return: True if the counters were repaired, otherwise False
+    """
+    conditions = ["attribute_exists(address)"]
+    values = {}
+    for field in COUNTER_FIELDS:
+        values[f":{field}"] = counters[field]
+        if field in item:
+            conditions.append(f"{field} = :old_{field}")
+            values[f":old_{field}"] = item[field]
+        else:
+            conditions.append(f"attribute_not_exists({field})")
+    try:
+        table_addresses.update_item(
+            Key={"address": item["address"]},
+            UpdateExpression="SET " + ", ".join(f"{field} = :{field}" for field in COUNTER_FIELDS),
+            ConditionExpression=" AND ".join(conditions),
+            ExpressionAttributeValues=values,
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        logger.info(f"## Counters of {item['address']} changed during the recount, skipped")
+        return False
+    return True
+
+
+def lambda_handler(event, context):
+    """Recount the counters of every address and repair the ones that
+    drifted, run on a schedule
+
+    When the time budget runs out the response holds an
+    exclusive_start_key, invoking with that response as the event goes on
+    from there.
+    """
+    logger.info("## ENVIRONMENT VARIABLES")
+    logger.info(os.environ)
+    logger.info("## EVENT")
+    logger.info(event)
+
+    scan_kwargs = {"ProjectionExpression": "address, " + ", ".join(COUNTER_FIELDS)}
+    if event.get("exclusive_start_key"):
+        scan_kwargs["ExclusiveStartKey"] = event["exclusive_start_key"]
+
+    checked, repaired = 0, 0
+    while True:
+        response = table_addresses.scan(**scan_kwargs)
+        for item in response.get("Items", []):
+            counters = count_emails(item["address"])
+            checked += 1
+            if any(item.get(field) != counters[field] for field in COUNTER_FIELDS):
+                logger.info(f"## Counters of {item['address']} drifted to {item}, recounted {counters}")
+                time.sleep(CONFIRM_DELAY_SECONDS)
+                if count_emails(item["address"]) != counters:
+                    logger.info(f"## Emails of {item['address']} changed during the recount, skipped")
+                    continue
+                repaired += repair_counters(item, counters)
+        last_key = response.get("LastEvaluatedKey")
+        if last_key is None:
+            break
+        scan_kwargs["ExclusiveStartKey"] = last_key
+        if context.get_remaining_time_in_millis() < TIME_MARGIN_MS:
+            logger.info(f"## Out of time, continue from {last_key}")
+            return {"exclusive_start_key": last_key, "checked": checked, "repaired": repaired}
+
+    logger.info(f"## Reconciled {checked} addresses, repaired {repaired}")
+    return {"checked": checked, "repaired": repaired}
@@ -0,0 +1,357 @@
+import re
+import binascii
+import quopri
+import logging
+import threading
+
+from email_artifact import MAX_PART_DEPTH, decode_payload, header_parser
+
+logger = logging.getLogger()
+
+# S3 multipart uploads need at least 5MB per part except the last one
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+MAX_HEADER_BYTES = 256 * 1024
+MAX_DELIMITER_LINE = 1024
+CARRY_LIMIT = 64 * 1024
+
+BASE64_JUNK = re.compile(rb"[^A-Za-z0-9+/=]")
+
+
+class MimePart:
+    def __init__(self, depth: int):
+        self.depth = depth
+        self.headers = None
+        self.header_size = 0
+        self.boundary = None
+        self.closed = False
+
+    @property
+    def is_multipart(self) -> bool:
+        return self.boundary is not None
+
+
+class MimeStreamParser:
+    """Incremental MIME parser
+
+    Bytes are fed in arbitrarily sized chunks and come back as events, so a
+    message never has to be held in memory as a whole:
+
+    ("raw", data)           structural bytes: headers, boundary lines, preamble, epilogue
+    ("headers", part)       the headers of part have been read
+    ("body", part, data)    body bytes of a leaf part, still transfer encoded
+    ("end", part)           part is complete
+
+    Concatenating every raw and body chunk gives back the input byte for byte.
+    """
+
+    def __init__(self):
+        self.buffer = b""
+        self.events = []
+        self.open_parts = [MimePart(depth=0)]
+        self.state = "headers"
+        self.header_bytes = b""
+        self.pending_eol = b""
+        self.line_start = True
+
+    @property
+    def current(self) -> MimePart:
+        return self.open_parts[-1]
+
+    def feed(self, data: bytes):
+        self.buffer += data
+        self._process(final=False)
+        return self._drain()
+
+    def close(self):
+        self._process(final=True)
+        if self.state == "headers":
+            self.header_bytes += self.buffer
+            self.buffer = b""
+            self._finish_headers()
+        self._content(self.pending_eol + self.buffer)
+        self.pending_eol = b""
+        self.buffer = b""
+        while self.open_parts:
+            self.events.append(("end", self.open_parts.pop()))
+        return self._drain()
+
+    def _drain(self):
+        events, self.events = self.events, []
+        return events
+
+    def _content(self, data: bytes):
+        if not data:
+            return
+        if self.state == "body":
+            self.events.append(("body", self.current, data))
+        else:
+            self.events.append(("raw", data))
+
+    def _process(self, final: bool):
+        pos = 0
+        buffer = self.buffer
+        while pos < len(buffer):
+            if self.state == "headers":
+                nl = buffer.find(b"\n", pos)
+                if nl == -1:
+                    if len(self.header_bytes) + len(buffer) - pos > MAX_HEADER_BYTES:
+                        self.header_bytes += buffer[pos:]
+                        pos = len(buffer)
+                        self._finish_headers()
+                    break
+                line = buffer[pos : nl + 1]
+                pos = nl + 1
+                self.header_bytes += line
+                if line in (b"\r\n", b"\n") or len(self.header_bytes) > MAX_HEADER_BYTES:
+                    self._finish_headers()
+                continue
+
+            if self.line_start and len(buffer) - pos < 2 and not final:
+                break
+            if self.line_start and buffer.startswith(b"--", pos):
+                nl = buffer.find(b"\n", pos)
+                if nl == -1 and not final and len(buffer) - pos < MAX_DELIMITER_LINE:
+                    # Might be a boundary line, wait for the rest of it
+                    break
+                line_end = len(buffer) if nl == -1 else nl + 1
+                if self._delimiter(buffer[pos:line_end]):
+                    pos = line_end
+                    continue
+            self.line_start = False
+
+            # Everything up to the next "\n--" is plain content
+            candidate = buffer.find(b"\n--", pos)
+            if candidate == -1:
+                # Hold back a possible partial "\r\n-" at the end of the buffer
+                safe_end = len(buffer) if final else max(pos, len(buffer) - 3)
+                if safe_end > pos:
+                    self._content(self.pending_eol + buffer[pos:safe_end])
+                    self.pending_eol = b""
+                    pos = safe_end
+                break
+            eol_start = candidate - 1 if candidate > pos and buffer[candidate - 1 : candidate] == b"\r" else candidate
+            self._content(self.pending_eol + buffer[pos:eol_start])
+            # The line break in front of a boundary belongs to the boundary
+            self.pending_eol = buffer[eol_start : candidate + 1]
+            pos = candidate + 1
+            self.line_start = True
+        self.buffer = buffer[pos:]
+
+    def _finish_headers(self):
+        part = self.current
+        part.header_size = len(self.header_bytes)
+        part.headers = header_parser.parsebytes(self.header_bytes)
+        self.events.append(("raw", self.header_bytes))
+        self.header_bytes = b""
+        boundary = part.headers.get_boundary()
+        if part.headers.get_content_maintype() == "multipart" and boundary and part.depth < MAX_PART_DEPTH:
+            part.boundary = boundary.encode("utf-8", errors="replace")
+            self.state = "raw"
+        else:
+            self.state = "body"
+        self.events.append(("headers", part))
+        self.line_start = True
+
+    def _delimiter(self, line: bytes) -> bool:
+        stripped = line.rstrip()
+        for index in range(len(self.open_parts) - 1, -1, -1):
+            part = self.open_parts[index]
+            if not part.is_multipart or part.closed:
+                continue
+            delimiter = b"--" + part.boundary
+            if stripped == delimiter:
+                is_close = False
+            elif stripped == delimiter + b"--":
+                is_close = True
+            else:
+                continue
+            while len(self.open_parts) > index + 1:
+                self.events.append(("end", self.open_parts.pop()))
+            self.events.append(("raw", self.pending_eol + line))
+            self.pending_eol = b""
+            if is_close:
+                part.closed = True
+                self.state = "raw"
+                self.line_start = True
+            else:
+                self.open_parts.append(MimePart(depth=part.depth + 1))
+                self.state = "headers"
+            return True
+        return False
+
+
+class Base64Decoder:
+    def __init__(self):
+        self.carry = b""
+
+    def decode(self, data: bytes) -> bytes:
+        data = self.carry + BASE64_JUNK.sub(b"", data)
+        usable = len(data) - len(data) % 4
+        self.carry = data[usable:]
+        return binascii.a2b_base64(data[:usable]) if usable else b""
+
+    def flush(self) -> bytes:
+        carry, self.carry = self.carry, b""
+        return decode_payload(carry, "base64") if carry else b""
+
+
+class QuotedPrintableDecoder:
+    def __init__(self):
+        self.carry = b""
+
+    def decode(self, data: bytes) -> bytes:
+        data = self.carry + data
+        cut = data.rfind(b"\n") + 1
+        if cut == 0 and len(data) > CARRY_LIMIT:
+            # Very long line, split it without breaking an =XX escape
+            cut = len(data) - 2
+            escape = data.find(b"=", cut - 1)
+            if escape != -1:
+                cut = escape
+        self.carry = data[cut:]
+        return quopri.decodestring(data[:cut])
+
+    def flush(self) -> bytes:
+        carry, self.carry = self.carry, b""
+        return quopri.decodestring(carry)
+
+
+class IdentityDecoder:
+    def decode(self, data: bytes) -> bytes:
+        return data
+
+    def flush(self) -> bytes:
+        return b""
+
+
+def stream_decoder(encoding):
+    encoding = (encoding or "7bit").lower()
+    if encoding == "base64":
+        return Base64Decoder()
+    if encoding == "quoted-printable":
+        return QuotedPrintableDecoder()
+    return IdentityDecoder()
+
+
+class BoundedExecutor:
+    """Wraps an executor so that at most max_pending jobs are queued or running.
+
+    submit() blocks once the limit is reached, which keeps the number of part
+    buffers held in memory bounded while uploads are in flight.
+    """
+
+    def __init__(self, executor, max_pending: int):
+        self.executor = executor
+        self.semaphore = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, fn, *args, **kwargs):
+        self.semaphore.acquire()
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self.semaphore.release()
+            raise
+        future.add_done_callback(lambda _: self.semaphore.release())
+        return future
+
+
+class MultipartUploadWriter:
+    """Write-only S3 object that is uploaded part by part
+
+    At most one part is buffered. Objects smaller than a single part are
+    written with a plain put_object instead of a multipart upload. With an
+    executor, parts and single puts are sent in the background and wait()
+    has to be called before the object is relied upon.
+    """
+
+    def __init__(
+        self,
+        s3,
+        bucket: str,
+        key: str,
+        part_size: int = DEFAULT_PART_SIZE,
+        executor=None,
+        **put_kwargs,
+    ):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.executor = executor
+        self.put_kwargs = put_kwargs
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.pending = None
+        self.size = 0
+
+    def write(self, data: bytes):
+        self.buffer += data
+        self.size += len(data)
+        while len(self.buffer) >= self.part_size:
+            self._upload_part(bytes(self.buffer[: self.part_size]))
+            del self.buffer[: self.part_size]
+
+    def _upload_part(self, body: bytes):
+        if self.upload_id is None:
+            response = self.s3.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, **self.put_kwargs
+            )
+            self.upload_id = response["UploadId"]
+        part_number = len(self.parts) + 1
+        if self.executor is None:
+            self.parts.append(self._send_part(part_number, body))
+        else:
+            self.parts.append(self.executor.submit(self._send_part, part_number, body))
+
+    def _send_part(self, part_number: int, body: bytes) -> dict:
+        response = self.s3.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=body,
+        )
+        return {"ETag": response["ETag"], "PartNumber": part_number}
+
+    def _put(self, body: bytes):
+        self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=body, **self.put_kwargs)
+
+    def close(self):
+        if self.upload_id is None:
+            body = bytes(self.buffer)
+            if self.executor is None:
+                self._put(body)
+            else:
+                self.pending = self.executor.submit(self._put, body)
+        else:
+            if self.buffer:
+                self._upload_part(bytes(self.buffer))
+            self.s3.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={"Parts": self._resolve_parts()},
+            )
+        self.buffer = bytearray()
+
+    def _resolve_parts(self):
+        return [part.result() if hasattr(part, "result") else part for part in self.parts]
+
+    def wait(self):
+        if self.pending is not None:
+            self.pending.result()
+
+    def abort(self):
+        # Let in-flight uploads settle so none of them lands after the abort
+        for part in self.parts + [self.pending]:
+            if hasattr(part, "exception"):
+                part.exception()
+        if self.upload_id is not None:
+            try:
+                self.s3.abort_multipart_upload(
+                    Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+                )
+            except Exception as e:
+                logger.error(f"## Failed to abort multipart upload for {self.key}: {e}")
+        self.buffer = bytearray()
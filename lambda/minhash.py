@@ -0,0 +1,73 @@
+import re
+import zlib
+import hashlib
+
+import numpy as np
+
+NUM_PERM = 128
+# 16 bands of 8 rows put the LSH candidate threshold near a Jaccard
+# similarity of 0.7, the final decision uses the estimated similarity
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+SHINGLE_SIZE = 3
+
+TOKEN = re.compile(r"[a-z0-9]+")
+MAX_HASH = np.uint64(0xFFFFFFFF)
+
+# Fixed seeds, signatures are stored and compared across invocations
+_rng = np.random.default_rng(20240613)
+PERM_A = _rng.integers(1, 2**63, size=(NUM_PERM, 1), dtype=np.uint64) | np.uint64(1)
+PERM_B = _rng.integers(0, 2**63, size=(NUM_PERM, 1), dtype=np.uint64)
+SHINGLE_MIX = np.array([0x9E3779B1, 0x85EBCA77, 0xC2B2AE3D], dtype=np.uint64)
+
+
+def token_hashes(text: str) -> np.ndarray:
+    return np.fromiter(
+        (zlib.crc32(token.encode("utf-8")) for token in TOKEN.findall(text.lower())),
+        dtype=np.uint64,
+    )
+
+
+def shingle_hashes(text: str) -> np.ndarray:
+    """32 bit hashes of the distinct word shingles of text"""
+    tokens = token_hashes(text)
+    if len(tokens) < SHINGLE_SIZE:
+        return np.unique(tokens)
+    count = len(tokens) - SHINGLE_SIZE + 1
+    # Combine each window of token hashes at once instead of shingle by shingle
+    mixed = np.zeros(count, dtype=np.uint64)
+    for offset in range(SHINGLE_SIZE):
+        mixed += tokens[offset : offset + count] * SHINGLE_MIX[offset]
+    return np.unique(mixed & MAX_HASH)
+
+
+def signature(text: str):
+    """MinHash signature of text, or None if it has no words"""
+    shingles = shingle_hashes(text)
+    if len(shingles) == 0:
+        return None
+    # Multiply-shift hashing, one row per permutation; uint64 arithmetic wraps
+    with np.errstate(over="ignore"):
+        hashed = (PERM_A * shingles[np.newaxis, :] + PERM_B) >> np.uint64(32)
+    return hashed.min(axis=1).astype(np.uint32)
+
+
+def similarity(first: np.ndarray, second: np.ndarray) -> float:
+    """Estimated Jaccard similarity of the shingle sets behind two signatures"""
+    return float(np.count_nonzero(first == second)) / len(first)
+
+
+def band_keys(sig: np.ndarray) -> list:
+    """One key per band, similar texts are likely to share at least one"""
+    return [
+        f"{band}:{hashlib.blake2b(sig[band * ROWS : (band + 1) * ROWS].tobytes(), digest_size=8).hexdigest()}"
+        for band in range(BANDS)
+    ]
+
+
+def to_bytes(sig: np.ndarray) -> bytes:
+    return sig.astype(">u4").tobytes()
+
+
+def from_bytes(data: bytes) -> np.ndarray:
+    return np.frombuffer(bytes(data), dtype=">u4").astype(np.uint32)
@@ -0,0 +1,67 @@
+import hmac
+import json
+import base64
+import hashlib
+from decimal import Decimal
+
+
+class InvalidCursor(ValueError):
+    """A cursor that was not issued by this API, or not for this listing"""
+
+
+def load_cursor_key(ssm, parameter_name: str) -> bytes:
+    """Signing key of page cursors, kept out of the environment because the
+    handlers log it"""
+    response = ssm.get_parameter(Name=parameter_name, WithDecryption=True)
+    return response["Parameter"]["Value"].encode("utf-8")
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _json_default(value):
+    # Number attributes of a LastEvaluatedKey come back as Decimal
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(f"Cannot encode {type(value).__name__} in a cursor")
+
+
+def _signature(key: bytes, payload: bytes) -> bytes:
+    return hmac.new(key, payload, hashlib.sha256).digest()[:16]
+
+
+def encode_cursor(key: bytes, scope: str, last_key: dict) -> str:
+    """Opaque cursor for resuming a query after last_key
+
+    :param scope: what the cursor lists, a cursor only decodes for the
+        same scope
+    """
+    payload = json.dumps(
+        {"s": scope, "k": last_key}, separators=(",", ":"), default=_json_default
+    ).encode("utf-8")
+    return f"{_b64encode(payload)}.{_b64encode(_signature(key, payload))}"
+
+
+def decode_cursor(key: bytes, scope: str, cursor: str) -> dict:
+    """ExclusiveStartKey carried by a cursor from encode_cursor
+
+    :raises InvalidCursor: if the cursor is malformed, tampered with or
+        issued for another scope
+    """
+    try:
+        encoded_payload, encoded_signature = cursor.split(".")
+        payload = _b64decode(encoded_payload)
+        signature = _b64decode(encoded_signature)
+    except ValueError as e:
+        raise InvalidCursor("Malformed cursor") from e
+    if not hmac.compare_digest(signature, _signature(key, payload)):
+        raise InvalidCursor("Bad cursor signature")
+    data = json.loads(payload)
+    if data.get("s") != scope:
+        raise InvalidCursor("Cursor issued for another listing")
+    return data["k"]
@@ -0,0 +1,54 @@
+import re
+
+# Lines after which everything belongs to an earlier message or a footer.
+# Reply headers may be wrapped over two lines by the sending client, some
+# languages put the sender after the verb. A header block only counts when
+# it looks like a quoted message, a From: line directly followed by header
+# lines with both a Sent: or Date: and a Subject:, so transactional mail
+# listing a sender and a date keeps its content. The underscore rule Outlook
+# puts above such a block is part of it, a rule on its own is no marker.
+QUOTED_HEADERS = (
+    r"From:[^\n]*"
+    r"(?=\n(?:[ \t]*(?:To|Cc|Reply-To|Sent|Date):[^\n]*\n){0,4}?[ \t]*Subject:)"
+    r"(?=\n(?:[ \t]*(?:To|Cc|Reply-To|Subject):[^\n]*\n){0,4}?[ \t]*(?:Sent|Date):)"
+)
+MARKERS = re.compile(
+    r"^[ \t]*(?:"
+    r"(?P<reply>(?:On|Le|Am|El|Il|Op)\s[^\n]{0,300}?(?:\n[^\n]{0,300}?)?"
+    r"\s(?:wrote|a écrit|schrieb|escribió|ha scritto|schreef)(?:\s[^\n]{0,200}?)?\s?:)"
+    r"|(?P<original>-{2,}\s*Original Message\s*-{2,})"
+    r"|(?P<forward>-{2,}\s*Forwarded message\s*-{2,}|Begin forwarded message:)"
+    rf"|(?P<header>(?:__{{2,}}[ \t]*\n(?:[ \t]*\n)?[ \t]*)?{QUOTED_HEADERS})"
+    r"|(?P<signature>--|Sent from my [^\n]*|Get Outlook for [^\n]*)"
+    r")[ \t]*$",
+    re.MULTILINE | re.IGNORECASE,
+)
+# Header block of a forwarded or quoted message
+HEADER_LINES = re.compile(r"(?:[ \t]*(?:From|Date|Sent|Subject|To|Cc|Reply-To):[^\n]*\n)*")
+QUOTED_LINES = re.compile(r"^[ \t]*>[^\n]*(?:\n|$)", re.MULTILINE)
+CONTENT = re.compile(r"^[ \t]*[^\s>]", re.MULTILINE)
+
+
+def latest_content(text: str) -> str:
+    """Newest part of an email body, without quoted history and signature
+
+    Cuts at the first reply header, original or forwarded message marker,
+    Outlook style header block or signature delimiter that has content of
+    its own above it. A marker with nothing new above it, as in a plain
+    forward, is skipped together with its header block so the forwarded
+    message is kept instead. Quoted lines are dropped from what remains.
+    Returns text unchanged if nothing would be left.
+    """
+    start = 0
+    end = len(text)
+    for match in MARKERS.finditer(text):
+        if match.start() < start:
+            continue
+        if CONTENT.search(text, start, match.start()):
+            end = match.start()
+            break
+        start = match.end() + 1
+        if match.lastgroup != "signature":
+            start = HEADER_LINES.match(text, min(start, len(text))).end()
+    latest = QUOTED_LINES.sub("", text[start:end]).strip()
+    return latest or text
@@ -5,6 +5,10 @@ import boto3
 from botocore.exceptions import ClientError
 from aws_xray_sdk.core import xray_recorder, patch_all
 
+from address_index import BloomSnapshotReader, ChangeFeedReader
+from ttl_cache import MISSING, TTLCache
+from util import batch_get_addresses
+
 if os.environ.get("XRAY_ENABLED", "false").lower() == "true":
     XRAY_NAME = os.environ.get("XRAY_NAME", "email-catcher")
     xray_recorder.configure(service=XRAY_NAME)
@@ -16,23 +20,75 @@ logger.setLevel(LOGGING_LEVEL)
 
 ddb_client = boto3.resource("dynamodb")
 table_addresses = ddb_client.Table(os.environ["ADDRESS_TABLE_NAME"])
+s3 = boto3.client("s3")
+
+# Lookups are cached per container, the change feed written by the address
+# table stream invalidates entries that changed since they were cached
+address_cache = TTLCache(
+    maxsize=int(os.environ.get("ADDRESS_CACHE_SIZE", 10000)),
+    ttl=float(os.environ.get("ADDRESS_CACHE_TTL", 300)),
+)
+NEGATIVE_CACHE_TTL = float(os.environ.get("ADDRESS_NEGATIVE_CACHE_TTL", 60))
+ADDRESS_FEED_POLL_SECONDS = float(os.environ.get("ADDRESS_FEED_POLL_SECONDS", 5))
+change_feed = ChangeFeedReader(
+    s3, os.environ["ADDRESS_INDEX_BUCKET"], poll_interval=ADDRESS_FEED_POLL_SECONDS
+)
+# Addresses missing from the filter snapshot are rejected without a lookup
+ADDRESS_FILTER_ENABLED = os.environ.get("ADDRESS_FILTER_ENABLED", "true").lower() == "true"
+address_filter = BloomSnapshotReader(
+    s3, os.environ["ADDRESS_INDEX_BUCKET"], poll_interval=ADDRESS_FEED_POLL_SECONDS
+)
 
 
-def address_exists(address: str) -> bool:
+def lookup_addresses(addresses):
+    """:return: dict of address to whether it exists, or None if the lookup failed"""
     try:
-        response = table_addresses.get_item(Key={"address": address.lower()})
-        if "Item" in response:
-            item = response["Item"]
-            if item["address"]:
-                return True
-            else:
-                return False
-        else:
-            return False
+        found = batch_get_addresses(ddb_client, table_addresses, addresses)
     except ClientError as e:
         logger.warning("## DynamoDB Client Exception")
         logger.warning(e.response["Error"]["Message"])
+        return None
+    except RuntimeError as e:
+        logger.warning(f"## DynamoDB batch lookup incomplete: {e}")
+        return None
+    return {address: address in found for address in addresses}
+
+
+def any_address_exists(addresses) -> bool:
+    """Whether at least one of the recipients is registered
+
+    The filter and cache answer what they can, the remaining recipients are
+    looked up together in one BatchGetItem.
+    """
+    addresses = list(dict.fromkeys(address.lower() for address in addresses))
+    change_feed.poll(address_cache)
+    if ADDRESS_FILTER_ENABLED:
+        bloom = address_filter.poll()
+        if bloom is not None and not address_filter.is_current(change_feed.last_seen):
+            # Addresses created since the snapshot are missing from it
+            logger.info("## ADDRESS FILTER BEHIND CHANGE FEED, NOT USED")
+        elif bloom is not None:
+            candidates = [address for address in addresses if address in bloom]
+            if len(candidates) < len(addresses):
+                logger.info(f"## ADDRESS FILTER MISS: {len(addresses) - len(candidates)}")
+            addresses = candidates
+    uncached = []
+    for address in addresses:
+        exists = address_cache.get(address)
+        if exists is MISSING:
+            uncached.append(address)
+        elif exists:
+            logger.info("## ADDRESS CACHE HIT")
+            return True
+    if not uncached:
+        return False
+    results = lookup_addresses(uncached)
+    if results is None:
+        # Errors are not cached
         return False
+    for address, exists in results.items():
+        address_cache.set(address, exists, ttl=None if exists else NEGATIVE_CACHE_TTL)
+    return any(results.values())
 
 
 def lambda_handler(event, context):
@@ -42,13 +98,13 @@ def lambda_handler(event, context):
     logger.info(event)
 
     for record in event["Records"]:
-        to_address = record["ses"]["mail"]["destination"][0]
-        logger.info("## DESTINATION")
-        logger.info(to_address)
-        if address_exists(to_address):
+        # Recipients this receipt rule matched, falling back to the envelope
+        recipients = record["ses"]["receipt"].get("recipients") or record["ses"]["mail"]["destination"]
+        logger.info("## RECIPIENTS")
+        logger.info(recipients)
+        if any_address_exists(recipients):
             logger.info("## ADDRESS EXISTS, CONTINUE")
             return {"disposition": "CONTINUE"}
         else:
             logger.info("## ADDRESS DOESNT EXIST, STOPPING RULE SET")
             return {"disposition": "STOP_RULE_SET"}
-        break
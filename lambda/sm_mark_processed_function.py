@@ -0,0 +1,62 @@
+import os
+import logging
+
+import boto3
+from botocore.exceptions import ClientError
+from aws_xray_sdk.core import xray_recorder, patch_all
+
+from address_counters import email_counts, update_counters
+from email_index import each_email_row
+from summary_queue import queue_summary
+
+if os.environ.get("XRAY_ENABLED", "false").lower() == "true":
+    XRAY_NAME = os.environ.get("XRAY_NAME", "email-catcher")
+    xray_recorder.configure(service=XRAY_NAME)
+    patch_all()
+
+LOGGING_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+logger = logging.getLogger()
+logger.setLevel(LOGGING_LEVEL)
+
+ddb_client = boto3.resource("dynamodb")
+email_table = ddb_client.Table(os.environ["EMAILS_TABLE_NAME"])
+address_table = ddb_client.Table(os.environ["ADDRESS_TABLE_NAME"])
+sqs = boto3.client("sqs")
+SUMMARY_QUEUE_URL = os.environ["SUMMARY_QUEUE_URL"]
+
+
+def mark_row_processed(message, destination):
+    """Make the row of destination visible and count it on its address, a
+    row made visible by an earlier attempt is not counted again"""
+    try:
+        response = email_table.update_item(
+            Key={"destination": destination, "messageId": message["messageId"]},
+            # visible_at puts the email in the sparse index the list reads
+            UpdateExpression="SET is_processed = :processed, visible_at = :visible_at",
+            ConditionExpression="attribute_exists(messageId) AND attribute_not_exists(visible_at)",
+            ExpressionAttributeValues={":processed": True, ":visible_at": message["timestamp"]},
+            ReturnValues="ALL_NEW",
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        logger.info(f"## {destination} row already processed or deleted")
+        return
+    update_counters(address_table, destination, **email_counts(response["Attributes"]))
+
+
+def lambda_handler(event, context):
+    """Show the email in the list once it is stored and its attachments are
+    extracted, the summary is queued and filled in later"""
+    logger.info("## ENVIRONMENT VARIABLES")
+    logger.info(os.environ)
+    logger.info("## EVENT")
+    logger.info(event)
+
+    message = event
+
+    each_email_row(message, lambda destination: mark_row_processed(message, destination))
+    queue_summary(sqs, SUMMARY_QUEUE_URL, message)
+    return {
+        "is_processed": True,
+    }
@@ -1,11 +1,40 @@
 import os
-import io
 import logging
-from email import policy
-from email.parser import BytesParser
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
 import boto3
+from botocore.config import Config
 from aws_xray_sdk.core import xray_recorder, patch_all
 
+from email_artifact import (
+    ARTIFACT_TEXT_LIMIT,
+    ARTIFACT_VERSION,
+    PAYLOAD_TEXT_LIMIT,
+    artifact_key,
+    attachment_metadata,
+    attachment_payload,
+    build_artifact,
+    decode_text,
+    header_map,
+    is_text_body,
+    leaf_fields,
+    load_artifact,
+    manifest_entry,
+    save_artifact,
+    strip_attachments,
+)
+from blob_store import BlobWriter, store_blob
+from email_index import update_email_rows
+from text_normalize import email_preview
+from stored_body import CompressingWriter, decode_body, encode_body, iter_body_chunks
+from mime_stream import (
+    BoundedExecutor,
+    MimeStreamParser,
+    MultipartUploadWriter,
+    stream_decoder,
+)
+
 if os.environ.get("XRAY_ENABLED", "false").lower() == "true":
     XRAY_NAME = os.environ.get("XRAY_NAME", "email-catcher")
     xray_recorder.configure(service=XRAY_NAME)
@@ -15,19 +44,253 @@ LOGGING_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
 logger = logging.getLogger()
 logger.setLevel(LOGGING_LEVEL)
 
-s3 = boto3.client("s3")
+UPLOAD_WORKERS = int(os.environ.get("ATTACHMENT_UPLOAD_WORKERS", 8))
+
+# One pooled client shared by every upload worker
+s3 = boto3.client("s3", config=Config(max_pool_connections=UPLOAD_WORKERS + 2))
+upload_executor = BoundedExecutor(
+    ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="upload"),
+    max_pending=UPLOAD_WORKERS * 2,
+)
 ddb_client = boto3.resource("dynamodb")
 email_table = ddb_client.Table(os.environ["EMAILS_TABLE_NAME"])
+blobs_table = ddb_client.Table(os.environ["BLOBS_TABLE_NAME"])
+
+# Messages larger than this are streamed instead of being read into memory
+STREAMING_THRESHOLD = int(os.environ.get("ATTACHMENT_STREAMING_THRESHOLD", 8 * 1024 * 1024))
+STREAM_CHUNK_SIZE = 1024 * 1024
+# Encoding of the stripped .eml written back, "gzip" or "identity"
+BODY_ENCODING = os.environ.get("STORED_BODY_ENCODING", "gzip")
+
+
+def add_ddb_attachments(message, attachments, artifact_object_key, preview, size_bytes):
+    update_email_rows(
+        email_table,
+        message,
+        UpdateExpression="SET attachments = :updated, artifactObjectKey = :artifact, bodyEncoding = :encoding, "
+        "attachment_count = :count, preview = :preview, size_bytes = :size",
+        ExpressionAttributeValues={
+            ":updated": attachments,
+            ":artifact": artifact_object_key,
+            ":count": len(attachments),
+            ":preview": preview,
+            ":size": size_bytes,
+            ":encoding": BODY_ENCODING,
+        },
+    )
+
+
+def upload_attachment(message, email_content_bytes, attachment):
+    # Decoding happens on the worker so only in-flight payloads are held
+    blob = store_blob(
+        s3,
+        blobs_table,
+        message["bucketName"],
+        attachment_payload(email_content_bytes, attachment),
+        attachment["Content-Type"],
+    )
+    return {**attachment_metadata(attachment), **blob}
+
 
+def save_extraction(message, artifact, attachments, size_bytes):
+    """Save the artifact and point the rows at the stored attachments
 
-def add_ddb_attachments(destination, messageId, attachments):
-    email_table.update_item(
-        Key={"destination": destination, "messageId": messageId},
-        UpdateExpression="SET attachments = :updated",
-        ExpressionAttributeValues={":updated": attachments},
+    Runs before the stored body is overwritten. The stripped body keeps the
+    headers of every attachment, parsing it again would find them empty, so
+    a retry reuses the artifact instead.
+    """
+    for entry, metadata in zip(artifact["attachments"], attachments):
+        entry["sha256"] = metadata["sha256"]
+        entry["size"] = metadata["size"]
+    # Counted in the stored bytes of every recipient, attachments included
+    artifact["stored_size"] = size_bytes
+    save_artifact(s3, message["bucketName"], artifact_key(message["bucketObjectKey"]), artifact)
+    record_attachments(message, artifact)
+
+
+def record_attachments(message, artifact):
+    """Fill in the rows and the stage output from the artifact"""
+    artifact_object_key = artifact_key(message["bucketObjectKey"])
+    attachments = [attachment_metadata(entry) for entry in artifact["attachments"]]
+    preview = email_preview(artifact["text"], artifact["text_type"])
+    message["size_bytes"] = artifact["stored_size"]
+    add_ddb_attachments(message, attachments, artifact_object_key, preview, message["size_bytes"])
+    message["attachments"] = attachments
+    message["artifactObjectKey"] = artifact_object_key
+    message["text_body"] = (artifact["text"] or "")[:PAYLOAD_TEXT_LIMIT]
+    message["text_type"] = artifact["text_type"]
+
+
+def extract_buffered(message, email_object, on_extracted):
+    # A retried invocation finds the object already compressed
+    email_content_bytes = decode_body(email_object["Body"].read())
+    # Parse once, every later stage works from the artifact
+    artifact = build_artifact(email_content_bytes)
+
+    # Process and upload attachments, the manifest entries are copied because
+    # stripping below rewrites their offsets
+    futures = [
+        upload_executor.submit(upload_attachment, message, email_content_bytes, dict(attachment))
+        for attachment in artifact["attachments"]
+    ]
+
+    # Metadata is gathered in part order regardless of completion order. Every
+    # attachment is stored before the original is overwritten, so a retry
+    # after a failed upload still finds the attachment in the body
+    attachments = [future.result() for future in futures]
+
+    # Save the new email without attachments, the bodies are spliced out
+    # so the rest of the message is stored byte for byte before compression
+    stripped = strip_attachments(email_content_bytes, artifact)
+    on_extracted(artifact, attachments)
+    s3.put_object(
+        Bucket=message["bucketName"],
+        Key=message["bucketObjectKey"],
+        Body=encode_body(stripped, BODY_ENCODING),
     )
 
 
+class StreamingExtractor:
+    """Consumes MimeStreamParser events for one message
+
+    Attachment parts are decoded chunk by chunk into their own uploads and
+    every other byte is written back as the stripped .eml, so memory use does
+    not depend on the size of the message. Offsets in the resulting artifact
+    refer to the stripped object before compression, the same as in the
+    buffered path.
+    """
+
+    def __init__(self, message):
+        self.message = message
+        self.stripped = CompressingWriter(
+            MultipartUploadWriter(
+                s3, message["bucketName"], message["bucketObjectKey"], executor=upload_executor
+            ),
+            BODY_ENCODING,
+        )
+        self.writers = [self.stripped]
+        self.position = 0
+        self.root = None
+        self.nodes = []
+        self.leaves = {}
+        self.attachments = []
+        self.text_parts = {}
+
+    def run(self, body, on_extracted):
+        parser = MimeStreamParser()
+        try:
+            for chunk in iter_body_chunks(body, chunk_size=STREAM_CHUNK_SIZE):
+                for event in parser.feed(chunk):
+                    self.handle(event)
+            for event in parser.close():
+                self.handle(event)
+            # The stripped .eml replaces the original only once every
+            # attachment is stored, as in the buffered path
+            for writer in self.writers[1:]:
+                writer.wait()
+            on_extracted(
+                self.artifact(),
+                [{**attachment_metadata(entry), **writer.blob} for entry, writer in self.attachments],
+            )
+            self.stripped.close()
+            self.stripped.wait()
+        except Exception:
+            for writer in self.writers:
+                writer.abort()
+            raise
+
+    def handle(self, event):
+        kind, part = event[0], event[1]
+        if kind == "raw":
+            self.stripped.write(part)
+            self.position += len(part)
+        elif kind == "headers":
+            self.start_part(part)
+        elif kind == "body":
+            self.body(part, event[2])
+        else:
+            self.end_part(part)
+
+    def start_part(self, part):
+        node = {
+            "content_type": part.headers.get_content_type(),
+            "offset": [self.position - part.header_size, self.position],
+            "body": [self.position, self.position],
+        }
+        if self.nodes:
+            self.nodes[-1]["parts"].append(node)
+        else:
+            self.root = (part.headers, node)
+        if part.is_multipart:
+            node["parts"] = []
+            self.nodes.append(node)
+            return
+
+        node.update(leaf_fields(part.headers))
+        writer, text_buffer = None, None
+        entry = manifest_entry(part.headers, node)
+        if entry is not None:
+            writer = BlobWriter(
+                s3,
+                blobs_table,
+                self.message["bucketName"],
+                executor=upload_executor,
+                content_type=entry["Content-Type"],
+            )
+            self.writers.append(writer)
+            self.attachments.append((entry, writer))
+        elif is_text_body(part.headers) and node["content_type"] not in self.text_parts:
+            text_buffer = bytearray()
+            self.text_parts[node["content_type"]] = (text_buffer, node["charset"])
+        self.leaves[id(part)] = (node, stream_decoder(node["encoding"]), writer, text_buffer)
+
+    def body(self, part, data):
+        node, decoder, writer, text_buffer = self.leaves[id(part)]
+        if writer is not None:
+            writer.write(decoder.decode(data))
+            return
+        if text_buffer is not None and len(text_buffer) < ARTIFACT_TEXT_LIMIT * 4:
+            text_buffer += decoder.decode(data)
+        self.stripped.write(data)
+        self.position += len(data)
+
+    def end_part(self, part):
+        leaf = self.leaves.pop(id(part), None)
+        if leaf is None:
+            if part.headers is not None and part.is_multipart and self.nodes:
+                node = self.nodes.pop()
+                node["offset"][1] = self.position
+                node["body"][1] = self.position
+            return
+        node, decoder, writer, text_buffer = leaf
+        node["offset"][1] = self.position
+        node["body"][1] = self.position
+        if writer is not None:
+            writer.write(decoder.flush())
+            writer.close()
+        elif text_buffer is not None:
+            text_buffer += decoder.flush()
+
+    def artifact(self):
+        text, text_type = None, None
+        for content_type in ("text/plain", "text/html"):
+            if content_type in self.text_parts:
+                text_buffer, charset = self.text_parts[content_type]
+                text = decode_text(bytes(text_buffer), charset)[:ARTIFACT_TEXT_LIMIT]
+                text_type = content_type.split("/")[1]
+                break
+        headers, root = self.root
+        return {
+            "version": ARTIFACT_VERSION,
+            "size": self.position,
+            "headers": header_map(headers),
+            "parts": root,
+            "text": text,
+            "text_type": text_type,
+            "attachments": [entry for entry, _ in self.attachments],
+        }
+
+
 def lambda_handler(event, context):
     logger.info("## ENVIRONMENT VARIABLES")
     logger.info(os.environ)
@@ -35,52 +298,31 @@ def lambda_handler(event, context):
     logger.info(event)
 
     message = event
-    attachments = []
+    artifact = load_artifact(s3, message["bucketName"], artifact_key(message["bucketObjectKey"]))
+    if artifact is not None:
+        # A retry after the artifact was saved, the stored body may already
+        # be stripped
+        logger.info("## Attachments already extracted, reusing the artifact")
+        if "stored_size" not in artifact:
+            # Saved before the stored size was kept in the artifact
+            artifact["stored_size"] = s3.head_object(
+                Bucket=message["bucketName"], Key=message["bucketObjectKey"]
+            )["ContentLength"]
+        record_attachments(message, artifact)
+        return message
+
     email_object = s3.get_object(
         Bucket=message["bucketName"],
         Key=message["bucketObjectKey"],
     )
+    on_extracted = functools.partial(save_extraction, message, size_bytes=email_object["ContentLength"])
 
-    email_content_bytes = email_object["Body"].read()
-    email_content = BytesParser(policy=policy.default).parse(
-        io.BytesIO(email_content_bytes)
-    )
+    if email_object["ContentLength"] > STREAMING_THRESHOLD:
+        logger.info(f"## Streaming {email_object['ContentLength']} byte email")
+        StreamingExtractor(message).run(email_object["Body"], on_extracted)
+    else:
+        extract_buffered(message, email_object, on_extracted)
 
-    # Process and upload attachments
-    attachments = []
-    for part in email_content.walk():
-        content_disposition = part.get("Content-Disposition", "")
-        if "attachment" in content_disposition or "inline" in content_disposition:
-            filename = part.get_filename()
-            if not filename:
-                # Generate a filename if not present
-                filename = "inline_attachment"
-            # Save the attachment to S3
-            s3.put_object(
-                Bucket=message["bucketName"],
-                Key=f"stored_emails/{message['destination']}/{message['messageId']}/attachments/{filename}",
-                Body=part.get_payload(decode=True),
-            )
-            # Record metadata
-            metadata = {
-                "filename": filename,
-                "Content-Type": part.get_content_type(),
-                "Content-Transfer-Encoding": part["Content-Transfer-Encoding"],
-                "Content-ID": part["Content-ID"],
-                "X-Attachment-Id": part["X-Attachment-Id"],
-            }
-            attachments.append(metadata)
-            # Optionally, remove attachment from the email to reduce size
-            part.set_payload(None)
-
-    # # Save the new email without attachments
-    s3.put_object(
-        Bucket=message["bucketName"],
-        Key=message["bucketObjectKey"],
-        Body=email_content.as_bytes(),
-    )
-    add_ddb_attachments(message["destination"], message["messageId"], attachments)
-    message["attachments"] = attachments
     logger.info(
         f"Email saved without attachments: {message['bucketName']}/{message['bucketObjectKey']}"
     )
@@ -3,9 +3,13 @@ import json
 import logging
 
 import boto3
+from botocore.exceptions import ClientError
 
 from aws_xray_sdk.core import xray_recorder, patch_all
 
+from util import batch_get_addresses
+from email_index import each_email_row, header_fields
+
 if os.environ.get("XRAY_ENABLED", "false").lower() == "true":
     XRAY_NAME = os.environ.get("XRAY_NAME", "email-catcher")
     xray_recorder.configure(service=XRAY_NAME)
@@ -18,6 +22,47 @@ logger.setLevel(LOGGING_LEVEL)
 s3 = boto3.client("s3")
 ddb_client = boto3.resource("dynamodb")
 email_table = ddb_client.Table(os.environ["EMAILS_TABLE_NAME"])
+address_table = ddb_client.Table(os.environ["ADDRESS_TABLE_NAME"])
+
+# "copy" moves the SES object under stored_emails/, "in_place" leaves it where
+# SES wrote it and only records its key
+INGEST_LAYOUT = os.environ.get("INGEST_LAYOUT", "copy")
+
+
+def registered_recipients(message):
+    """Recipients of the mail that have a registered address, the first
+    destination for mail that matched none of them"""
+    recipients = message["receipt"].get("recipients") or message["mail"]["destination"]
+    recipients = list(dict.fromkeys(recipient.lower() for recipient in recipients))
+    found = batch_get_addresses(ddb_client, address_table, recipients)
+    registered = [recipient for recipient in recipients if recipient in found]
+    return registered or [message["mail"]["destination"][0]]
+
+
+def object_exists(bucket, key) -> bool:
+    try:
+        s3.head_object(Bucket=bucket, Key=key)
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+
+
+def put_row(row) -> bool:
+    """Write the row of a recipient unless an earlier attempt did, a row
+    already extracted or processed is kept as it is
+
+    :return: True if the row was written, False if it existed
+    """
+    try:
+        email_table.put_item(Item=row, ConditionExpression="attribute_not_exists(messageId)")
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        logger.info(f"## Row of {row['destination']} already stored")
+        return False
+    return True
 
 
 def lambda_handler(event, context):
@@ -30,41 +75,72 @@ def lambda_handler(event, context):
 
     source_bucket = message["receipt"]["action"]["bucketName"]
     source_key = message["receipt"]["action"]["objectKey"]
-    destination_key = f"stored_emails/{message['mail']['destination'][0]}/{message['mail']['messageId']}/{message['mail']['messageId']}.eml"
+    recipients = registered_recipients(message)
+    if INGEST_LAYOUT == "in_place":
+        destination_key = source_key
+    else:
+        # Stored once under the first recipient and shared by all of them
+        destination_key = f"stored_emails/{recipients[0]}/{message['mail']['messageId']}/{message['mail']['messageId']}.eml"
 
     try:
-        # Copy object to new location in S3
-        s3.copy_object(
-            CopySource={"Bucket": source_bucket, "Key": source_key},
-            Bucket=source_bucket,
-            Key=destination_key,
-        )
-        if LOGGING_LEVEL.lower() == "debug":
+        # A redelivered record can find the object already moved, what the
+        # earlier attempt copied is kept and the gone source left alone
+        moving = destination_key != source_key
+        source_exists = not moving or object_exists(source_bucket, source_key)
+        if moving and not object_exists(source_bucket, destination_key):
+            # Copy object to new location in S3
+            s3.copy_object(
+                CopySource={"Bucket": source_bucket, "Key": source_key},
+                Bucket=source_bucket,
+                Key=destination_key,
+            )
+        if LOGGING_LEVEL.lower() == "debug" and source_exists:
             s3.copy_object(
                 CopySource={"Bucket": source_bucket, "Key": source_key},
                 Bucket=source_bucket,
                 Key=destination_key + ".orginal",
             )
 
-        # Delete the original object
-        s3.delete_object(Bucket=source_bucket, Key=source_key)
-
-        # Record object in DDB
-        ddb_email = {
-            "destination": message["mail"]["destination"][0],
-            "messageId": message["mail"]["messageId"],
-            "timestamp": message["mail"]["timestamp"],
-            "source": message["mail"]["source"],
-            "attachments": [],
-            "commonHeaders": message["mail"]["commonHeaders"],
-            "bucketName": source_bucket,
-            "bucketObjectKey": destination_key,
-            "is_read": False,
-            "is_processed": False,
-        }
-
-        email_table.put_item(Item=ddb_email)
-        return ddb_email
+        if moving and source_exists:
+            # Delete the original object
+            s3.delete_object(Bucket=source_bucket, Key=source_key)
+
+        # Record object in DDB, one row per recipient
+        ddb_emails = [
+            {
+                "destination": recipient,
+                "messageId": message["mail"]["messageId"],
+                "timestamp": message["mail"]["timestamp"],
+                "source": message["mail"]["source"],
+                "attachments": [],
+                "commonHeaders": message["mail"]["commonHeaders"],
+                **header_fields(message["mail"]["commonHeaders"]),
+                "bucketName": source_bucket,
+                "bucketObjectKey": destination_key,
+                "storageLayout": INGEST_LAYOUT,
+                "recipients": recipients,
+                "is_read": False,
+                "is_processed": False,
+            }
+            for recipient in recipients
+        ]
+
+        rows = {row["destination"]: row for row in ddb_emails}
+        written = {}
+
+        def write(destination):
+            written[destination] = put_row(rows[destination])
+
+        each_email_row(ddb_emails[0], write)
+        if not written[recipients[0]]:
+            # Redelivered, later stages can skip what the earlier attempt did
+            existing = email_table.get_item(
+                Key={"destination": recipients[0], "messageId": message["mail"]["messageId"]},
+                ProjectionExpression="is_processed",
+                ConsistentRead=True,
+            ).get("Item", {})
+            ddb_emails[0]["is_processed"] = existing.get("is_processed", False)
+        return ddb_emails[0]
 
     except Exception as e:
         logger.exception("## EXCEPTION ##")
@@ -1,17 +1,28 @@
-import io
 import json
 import os
+import functools
+import time
 import logging
-import re
-from email import policy
-from email.parser import BytesParser
 
 import boto3
 from botocore.exceptions import ClientError
 from botocore.config import Config
 from aws_xray_sdk.core import xray_recorder, patch_all
 
-from util import check_summarize
+from util import summarize_recipients
+from token_bucket import TokenBucket
+from email_artifact import artifact_key, build_artifact, load_artifact
+from email_index import email_recipients, update_email_rows
+from stored_body import read_body
+from text_normalize import prompt_text
+import minhash
+from summary_cache import (
+    content_key,
+    find_similar_summary,
+    get_cached_summary,
+    put_cached_summary,
+    put_similarity_index,
+)
 
 if os.environ.get("XRAY_ENABLED", "false").lower() == "true":
     XRAY_NAME = os.environ.get("XRAY_NAME", "email-catcher")
@@ -22,28 +33,106 @@ LOGGING_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
 logger = logging.getLogger()
 logger.setLevel(LOGGING_LEVEL)
 
-brk_client = boto3.client("bedrock-runtime", config=Config(region_name="us-east-1"))
+# Throttling is retried through the summary queue, not inside the client
+brk_client = boto3.client(
+    "bedrock-runtime",
+    config=Config(region_name="us-east-1", retries={"max_attempts": 2, "mode": "standard"}),
+)
 s3 = boto3.client("s3")
 ddb_client = boto3.resource("dynamodb")
 email_table = ddb_client.Table(os.environ["EMAILS_TABLE_NAME"])
 address_table = ddb_client.Table(os.environ["ADDRESS_TABLE_NAME"])
+summary_cache_table = ddb_client.Table(os.environ["SUMMARY_CACHE_TABLE_NAME"])
 
 TOKEN_LIMIT = 4096
 AVG_TOKEN_CHAR_CONVERSION = 3.25
 CHARACTER_LIMIT = int(TOKEN_LIMIT * AVG_TOKEN_CHAR_CONVERSION - 1000)
+MODEL_ID = "amazon.titan-text-lite-v1"
+# Bump when the prompt or generation settings change, cached summaries
+# made with the old ones are then no longer used
+PROMPT_VERSION = 1
+SUMMARY_CACHE_TTL = int(os.environ.get("SUMMARY_CACHE_TTL", 7 * 24 * 60 * 60))
+# Estimated Jaccard similarity from which an earlier summary of the same
+# address is reused, 0 disables near duplicate reuse
+SIMILAR_SUMMARY_THRESHOLD = float(os.environ.get("SIMILAR_SUMMARY_THRESHOLD", 0.8))
+# Estimated input tokens per minute for all summary workers together,
+# every container paces its share of it; 0 disables pacing
+TOKENS_PER_MINUTE = int(os.environ.get("SUMMARY_TOKENS_PER_MINUTE", 0))
+MAX_CONCURRENCY = int(os.environ.get("SUMMARY_MAX_CONCURRENCY", 1))
+token_bucket = TokenBucket(
+    rate=TOKENS_PER_MINUTE / MAX_CONCURRENCY / 60,
+    capacity=max(TOKENS_PER_MINUTE / MAX_CONCURRENCY, TOKEN_LIMIT),
+)
+THROTTLING_ERRORS = (
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "ServiceUnavailableException",
+    "ModelNotReadyException",
+    "ModelTimeoutException",
+)
 
 
-def summarize(text: str):
+# Seconds between writes of a summary still being generated
+PARTIAL_INTERVAL = 0.5
+
+
+class SummaryThrottled(Exception):
+    """The model is at capacity, summarize again later"""
+
+
+def is_throttling(e: ClientError) -> bool:
+    # Errors raised from a response stream name the event, "throttlingException"
+    code = e.response["Error"]["Code"]
+    return code[:1].upper() + code[1:] in THROTTLING_ERRORS
+
+
+def invoke_summary(body: str) -> str:
+    response = brk_client.invoke_model(
+        body=body, modelId=MODEL_ID, accept="application/json", contentType="application/json"
+    )
+    logger.debug("## Loading bedrock response to json ##")
+    response_body = json.loads(response.get("body").read())
+    logger.debug("## Bedrock client response ##")
+    logger.debug(response_body["results"][0]["outputText"])
+    return response_body["results"][0]["outputText"]
+
+
+def stream_summary(body: str, on_partial) -> str:
+    """Generate the summary as a response stream, passing the text so far to
+    on_partial as soon as it starts and then every PARTIAL_INTERVAL seconds"""
+    response = brk_client.invoke_model_with_response_stream(
+        body=body, modelId=MODEL_ID, accept="application/json", contentType="application/json"
+    )
+    pieces = []
+    written = 0
+    for event in response["body"]:
+        chunk = event.get("chunk")
+        if chunk is None:
+            continue
+        pieces.append(json.loads(chunk["bytes"])["outputText"])
+        now = time.monotonic()
+        if now - written >= PARTIAL_INTERVAL:
+            on_partial("".join(pieces))
+            written = now
+    return "".join(pieces)
+
+
+def summarize(text: str, max_wait: float, on_partial=None) -> str:
+    """Summary of text, streamed through on_partial when a reader is waiting
+
+    Errors are raised, the job is retried through the summary queue and
+    ends up in its dead letter queue rather than storing no summary.
+    """
     prompt = f"""Please provide a summary of the following email content. Do not add any information that is not mentioned in the text.
 <text>
 {text}
 </text>
 """
     logger.debug("## Summarizing text via bedrock-runtime: %s", prompt)
-    logger.info(
-        "## Bedrock estimated Tokens Usage: %s",
-        (len(prompt) / AVG_TOKEN_CHAR_CONVERSION),
-    )
+    estimated_tokens = len(prompt) / AVG_TOKEN_CHAR_CONVERSION
+    logger.info("## Bedrock estimated Tokens Usage: %s", estimated_tokens)
+    if not token_bucket.acquire(estimated_tokens, timeout=max_wait):
+        raise SummaryThrottled("Token budget exhausted")
     try:
         body = json.dumps(
             {
@@ -56,33 +145,29 @@ def summarize(text: str):
                 },
             }
         )
-
-        modelId = "amazon.titan-text-lite-v1"
-        accept = "application/json"
-        contentType = "application/json"
-
-        response = brk_client.invoke_model(
-            body=body, modelId=modelId, accept=accept, contentType=contentType
-        )
-        logger.debug("## Loading bedrock response to json ##")
-        response_body = json.loads(response.get("body").read())
-        logger.debug("## Bedrock client response ##")
-        logger.debug(response_body["results"][0]["outputText"])
-        return response_body["results"][0]["outputText"]
-    except Exception as e:
+        if on_partial is not None:
+            return stream_summary(body, on_partial)
+        return invoke_summary(body)
+    except ClientError as e:
+        if is_throttling(e):
+            raise SummaryThrottled(e.response["Error"]["Message"]) from e
         logger.error("## Bedrock Invoke Model Error ##")
-        logger.exception(e)
-        return None
+        logger.error(e.response["Error"]["Message"])
+        raise
 
 
-def set_summary(destination, messageId, summary):
+def set_summary(message, summary, destinations):
+    """Store the summary on the rows of the recipients that asked for it"""
+    destination, messageId = message["destination"], message["messageId"]
     logger.info(
-        f"## Setting summary for destination: {destination} and messageId: {messageId}"
+        f"## Setting summary for destinations: {destinations} and messageId: {messageId}"
     )
     try:
-        email_table.update_item(
-            Key={"destination": destination, "messageId": messageId},
-            UpdateExpression="SET summary_text = :summary",
+        update_email_rows(
+            email_table,
+            message,
+            destinations,
+            UpdateExpression="SET summary_text = :summary REMOVE summary_partial",
             ExpressionAttributeValues={":summary": summary},
         )
     except ClientError as e:
@@ -91,10 +176,92 @@ def set_summary(destination, messageId, summary):
         )
         logger.error("## DynamoDB Client Exception")
         logger.error(e.response["Error"]["Message"])
+        raise
 
 
-def extract_recent_content(email_body: str, char_limit: int) -> str:
-    return email_body[:char_limit]
+def set_partial_summary(message, partial):
+    """Summary generated so far, on the row of the reader waiting for it"""
+    try:
+        email_table.update_item(
+            Key={"destination": message["destination"], "messageId": message["messageId"]},
+            UpdateExpression="SET summary_partial = :partial",
+            ExpressionAttributeValues={":partial": partial},
+        )
+    except ClientError as e:
+        logger.error("## Error setting partial summary")
+        logger.error(e.response["Error"]["Message"])
+
+
+def clear_summary_request(message):
+    """Drop the summary request of the reader's row when no summary comes,
+    the email then reads as not summarized instead of pending"""
+    try:
+        email_table.update_item(
+            Key={"destination": message["destination"], "messageId": message["messageId"]},
+            UpdateExpression="REMOVE summary_requested_at, summary_partial",
+        )
+    except ClientError as e:
+        logger.error("## Error clearing summary request")
+        logger.error(e.response["Error"]["Message"])
+
+
+def get_email_text(message):
+    """Text body and its type ("plain" or "html") produced by the attachment
+    stage, from the job itself or else from the stored artifact.
+
+    Only emails stored before artifacts existed have none, their .eml is
+    indexed here. Either version of the object works, stripping attachments
+    leaves the text parts untouched and compression is undone by read_body.
+    """
+    if message.get("text_body") is not None:
+        return message["text_body"], message.get("text_type")
+    key = message.get("artifactObjectKey") or artifact_key(message["bucketObjectKey"])
+    artifact = load_artifact(s3, message["bucketName"], key)
+    if artifact is None:
+        logger.info("## No artifact, indexing the stored email")
+        artifact = build_artifact(read_body(s3, message["bucketName"], message["bucketObjectKey"]))
+    return artifact["text"] or "", artifact["text_type"]
+
+
+def cached_summarize(message, text: str, max_wait: float, destinations):
+    """summarize(), reusing the summary of identical content or of a
+    near duplicate sent to one of destinations"""
+    cache_key = content_key(text, MODEL_ID, PROMPT_VERSION)
+    summary = get_cached_summary(summary_cache_table, cache_key)
+    if summary is not None:
+        logger.info("## Summary cache hit")
+        return summary
+
+    sig = minhash.signature(text) if SIMILAR_SUMMARY_THRESHOLD > 0 else None
+    # Band keys are tied to the model and prompt through the address prefix,
+    # every address keeps its own index
+    index_names = [f"{destination}:{MODEL_ID}:{PROMPT_VERSION}" for destination in destinations]
+    if sig is not None:
+        for index_name in index_names:
+            summary = find_similar_summary(
+                ddb_client, summary_cache_table, index_name, sig, SIMILAR_SUMMARY_THRESHOLD
+            )
+            if summary is not None:
+                return summary
+
+    # Someone has the email open when it is summarized on read
+    on_partial = None
+    if message.get("on_read"):
+        on_partial = functools.partial(set_partial_summary, message)
+    summary = summarize(text, max_wait, on_partial)
+    put_cached_summary(summary_cache_table, cache_key, summary, SUMMARY_CACHE_TTL)
+    if sig is not None:
+        for index_name in index_names:
+            put_similarity_index(
+                ddb_client,
+                summary_cache_table,
+                index_name,
+                message["messageId"],
+                sig,
+                summary,
+                SUMMARY_CACHE_TTL,
+            )
+    return summary
 
 
 def lambda_handler(event, context):
@@ -105,32 +272,35 @@ def lambda_handler(event, context):
 
     message = event
 
-    if check_summarize(address_table, message["destination"]):
-        data = s3.get_object(
-            Bucket=message["bucketName"],
-            Key=message["bucketObjectKey"],
-        )
-        email_content_bytes = data["Body"].read()
-        msg = BytesParser(policy=policy.default).parse(io.BytesIO(email_content_bytes))
+    # Settings are per address, an email opened by one recipient is only
+    # summarized for that recipient
+    on_read = message.get("on_read", False)
+    recipients = [message["destination"]] if on_read else email_recipients(message)
+    destinations = summarize_recipients(ddb_client, address_table, recipients, on_read)
+    if not destinations:
+        if on_read:
+            clear_summary_request(message)
+    else:
         try:
-            email_body = msg.get_body(preferencelist=("plain", "html")).get_content()
-            pattern = r"<https?://[^>]*>"
-            email_body = re.sub(pattern, "", email_body)
-            email_body = re.sub(r"\n>", "", email_body)
-            email_body = re.sub(r">+", "", email_body)
-            email_body = re.sub(r"[ \t]+", " ", email_body)
-            email_body = extract_recent_content(email_body, CHARACTER_LIMIT)
-            summary = summarize(email_body)
-            set_summary(message["destination"], message["messageId"], summary)
+            text, text_type = get_email_text(message)
+            email_body = prompt_text(text, text_type, CHARACTER_LIMIT)
+            # Leave time to store the summary after waiting for the budget
+            max_wait = max(context.get_remaining_time_in_millis() / 1000 - 60, 0)
+            summary = cached_summarize(message, email_body, max_wait, destinations)
+            set_summary(message, summary, destinations)
+        except SummaryThrottled:
+            # Still pending, the job comes back
+            raise
         except Exception as e:
-            logger.error("## Failed to parse email for AI summary:")
+            logger.error("## Failed to summarize email:")
             logger.exception(e)
+            if on_read:
+                # The queue retries the job, meanwhile the reader is not kept
+                # waiting and opening the email again asks for it anew
+                clear_summary_request(message)
+            raise
 
-    email_table.update_item(
-        Key={"destination": message["destination"], "messageId": message["messageId"]},
-        UpdateExpression="SET is_processed = :processed",
-        ExpressionAttributeValues={":processed": True},
-    )
     return {
-        "is_processed": True,
+        "destination": message["destination"],
+        "messageId": message["messageId"],
     }
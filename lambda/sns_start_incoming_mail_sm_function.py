@@ -1,11 +1,15 @@
-import json
 import os
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
 
 from aws_xray_sdk.core import xray_recorder, patch_all
 
+from util import get_record_id, get_record_message
+
 if os.environ.get("XRAY_ENABLED", "false").lower() == "true":
     XRAY_NAME = os.environ.get("XRAY_NAME", "email-catcher")
     xray_recorder.configure(service=XRAY_NAME)
@@ -15,18 +19,49 @@ LOGGING_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
 logger = logging.getLogger()
 logger.setLevel(LOGGING_LEVEL)
 
-stepfunction_client = boto3.client("stepfunctions")
+START_WORKERS = int(os.environ.get("START_EXECUTION_WORKERS", 10))
+
+# Adaptive retries back off on StartExecution throttling instead of failing the record
+stepfunction_client = boto3.client(
+    "stepfunctions",
+    config=Config(
+        max_pool_connections=START_WORKERS,
+        retries={"max_attempts": 8, "mode": "adaptive"},
+    ),
+)
+start_executor = ThreadPoolExecutor(max_workers=START_WORKERS, thread_name_prefix="start")
 
 incoming_mail_state_machine_arn = os.environ["INCOMING_MAIL_STATE_MACHINE_ARN"]
 
 
+def start_execution(record):
+    stepfunction_client.start_execution(
+        stateMachineArn=incoming_mail_state_machine_arn,
+        input=get_record_message(record),
+    )
+
+
 def lambda_handler(event, context):
     logger.info("## ENVIRONMENT VARIABLES")
     logger.info(os.environ)
     logger.info("## EVENT")
     logger.info(event)
 
-    stepfunction_client.start_execution(
-        stateMachineArn=incoming_mail_state_machine_arn,
-        input=event["Records"][0]["Sns"]["Message"],
-    )
+    records = event["Records"]
+    futures = [start_executor.submit(start_execution, record) for record in records]
+
+    failures = []
+    for record, future in zip(records, futures):
+        try:
+            future.result()
+        except ClientError as e:
+            logger.error(f"## Failed to start execution for {get_record_id(record)}")
+            logger.error(e.response["Error"]["Message"])
+            failures.append({"itemIdentifier": get_record_id(record)})
+        except Exception as e:
+            logger.error(f"## Failed to start execution for {get_record_id(record)}: {e}")
+            failures.append({"itemIdentifier": get_record_id(record)})
+
+    logger.info(f"## Started {len(records) - len(failures)} of {len(records)} executions")
+    # Only the failed messages go back to the queue
+    return {"batchItemFailures": failures}
@@ -0,0 +1,74 @@
+import os
+import json
+import random
+import logging
+
+import boto3
+from botocore.exceptions import ClientError
+from aws_xray_sdk.core import xray_recorder, patch_all
+
+# The summarizer module keeps its clients, caches and token bucket for the
+# life of the container
+import sm_summarize_email_function
+from sm_summarize_email_function import SummaryThrottled
+
+if os.environ.get("XRAY_ENABLED", "false").lower() == "true":
+    XRAY_NAME = os.environ.get("XRAY_NAME", "email-catcher")
+    xray_recorder.configure(service=XRAY_NAME)
+    patch_all()
+
+LOGGING_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+logger = logging.getLogger()
+logger.setLevel(LOGGING_LEVEL)
+
+sqs = boto3.client("sqs")
+SUMMARY_QUEUE_URL = os.environ["SUMMARY_QUEUE_URL"]
+
+# Throttled jobs come back after a jittered delay growing with every receive
+RETRY_BASE_SECONDS = 10
+RETRY_CAP_SECONDS = 15 * 60
+
+
+def retry_later(record):
+    attempt = int(record["attributes"]["ApproximateReceiveCount"])
+    delay = random.uniform(RETRY_BASE_SECONDS, min(RETRY_CAP_SECONDS, RETRY_BASE_SECONDS * 2**attempt))
+    try:
+        sqs.change_message_visibility(
+            QueueUrl=SUMMARY_QUEUE_URL,
+            ReceiptHandle=record["receiptHandle"],
+            VisibilityTimeout=int(delay),
+        )
+    except ClientError as e:
+        # The job still comes back once the queue visibility timeout ends
+        logger.error(f"## Unable to delay {record['messageId']}")
+        logger.error(e.response["Error"]["Message"])
+
+
+def lambda_handler(event, context):
+    """Summarize queued emails, the emails are already visible without a summary"""
+    logger.info("## ENVIRONMENT VARIABLES")
+    logger.info(os.environ)
+    logger.info("## EVENT")
+    logger.info(event)
+
+    failures = []
+    throttled = False
+    for record in event["Records"]:
+        if throttled:
+            # The rest of the batch would only wait on the same budget
+            retry_later(record)
+            failures.append({"itemIdentifier": record["messageId"]})
+            continue
+        try:
+            sm_summarize_email_function.lambda_handler(json.loads(record["body"]), context)
+        except SummaryThrottled as e:
+            logger.warning(f"## Summary throttled, retrying {record['messageId']} later: {e}")
+            throttled = True
+            retry_later(record)
+            failures.append({"itemIdentifier": record["messageId"]})
+        except Exception as e:
+            logger.error(f"## Failed to summarize {record['messageId']}")
+            logger.exception(e)
+            failures.append({"itemIdentifier": record["messageId"]})
+
+    return {"batchItemFailures": failures}
@@ -0,0 +1,77 @@
+import gzip
+import zlib
+
+GZIP = "gzip"
+IDENTITY = "identity"
+GZIP_MAGIC = b"\x1f\x8b"
+COMPRESS_LEVEL = 6
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+def is_gzip(data: bytes) -> bool:
+    """An .eml starts with a header line, never with the gzip magic bytes, so
+    readers can tell both forms apart without trusting the email item"""
+    return data[:2] == GZIP_MAGIC
+
+
+def encode_body(data: bytes, encoding: str) -> bytes:
+    if encoding == GZIP:
+        return gzip.compress(data, compresslevel=COMPRESS_LEVEL)
+    return data
+
+
+def decode_body(data: bytes) -> bytes:
+    if is_gzip(data):
+        return gzip.decompress(data)
+    return data
+
+
+def read_body(s3, bucket: str, key: str) -> bytes:
+    """Stored .eml bytes, decompressed while they are downloaded"""
+    body = s3.get_object(Bucket=bucket, Key=key)["Body"]
+    return b"".join(iter_body_chunks(body))
+
+
+def iter_body_chunks(body, chunk_size: int = READ_CHUNK_SIZE):
+    """Decompressed chunks of an S3 streaming body, whether it is gzip or not"""
+    decompressor = None
+    chunks = body.iter_chunks(chunk_size=chunk_size)
+    for chunk in chunks:
+        if decompressor is None:
+            if not is_gzip(chunk):
+                yield chunk
+                yield from chunks
+                return
+            decompressor = zlib.decompressobj(wbits=31)
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    if decompressor is not None:
+        data = decompressor.flush()
+        if data:
+            yield data
+
+
+class CompressingWriter:
+    """Gzip compresses everything written to an upload writer"""
+
+    def __init__(self, writer, encoding: str):
+        self.writer = writer
+        self.compressor = zlib.compressobj(COMPRESS_LEVEL, wbits=31) if encoding == GZIP else None
+
+    def write(self, data: bytes):
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        if data:
+            self.writer.write(data)
+
+    def close(self):
+        if self.compressor is not None:
+            self.writer.write(self.compressor.flush())
+        self.writer.close()
+
+    def wait(self):
+        return self.writer.wait()
+
+    def abort(self):
+        self.writer.abort()
@@ -0,0 +1,102 @@
+import re
+import time
+import hashlib
+import logging
+
+from botocore.exceptions import ClientError
+
+import minhash
+from util import batch_write_items
+
+logger = logging.getLogger()
+
+WHITESPACE = re.compile(r"\s+")
+
+
+def content_key(text: str, model_id: str, prompt_version: int) -> str:
+    """Cache key of a summary: the model, the prompt and the text it was
+    given, with whitespace differences ignored"""
+    normalized = WHITESPACE.sub(" ", text).strip()
+    digest = hashlib.sha256(f"{model_id}\n{prompt_version}\n{normalized}".encode("utf-8"))
+    return f"sha256:{digest.hexdigest()}"
+
+
+def get_cached_summary(table, cache_key: str):
+    try:
+        response = table.get_item(Key={"cache_key": cache_key})
+    except ClientError as e:
+        logger.warning("## Summary cache lookup failed")
+        logger.warning(e.response["Error"]["Message"])
+        return None
+    item = response.get("Item")
+    # Expired items linger until DynamoDB removes them
+    if item is None or item["expires_at"] <= int(time.time()):
+        return None
+    return item["summary"]
+
+
+def put_cached_summary(table, cache_key: str, summary: str, ttl_seconds: int):
+    try:
+        table.put_item(
+            Item={
+                "cache_key": cache_key,
+                "summary": summary,
+                "expires_at": int(time.time()) + ttl_seconds,
+            }
+        )
+    except ClientError as e:
+        logger.warning("## Summary cache write failed")
+        logger.warning(e.response["Error"]["Message"])
+
+
+def band_cache_key(destination: str, band_key: str) -> str:
+    return f"lsh:{destination}:{band_key}"
+
+
+def find_similar_summary(ddb_client, table, destination: str, sig, threshold: float):
+    """Summary of the most similar recent email of the same address
+
+    Candidates are the emails sharing an LSH band with sig; the summary is
+    only reused if their estimated similarity reaches threshold.
+    """
+    keys = [{"cache_key": band_cache_key(destination, band_key)} for band_key in minhash.band_keys(sig)]
+    try:
+        response = ddb_client.batch_get_item(RequestItems={table.name: {"Keys": keys}})
+    except ClientError as e:
+        logger.warning("## Summary similarity lookup failed")
+        logger.warning(e.response["Error"]["Message"])
+        return None
+    now = int(time.time())
+    best, best_similarity = None, threshold
+    # Unprocessed keys are skipped, a missed candidate only costs a summary
+    for item in response["Responses"].get(table.name, []):
+        if item["expires_at"] <= now:
+            continue
+        candidate_similarity = minhash.similarity(sig, minhash.from_bytes(item["signature"]))
+        if candidate_similarity >= best_similarity:
+            best, best_similarity = item, candidate_similarity
+    if best is None:
+        return None
+    logger.info(f"## Reusing summary of {best['messageId']}, similarity {best_similarity:.2f}")
+    return best["summary"]
+
+
+def put_similarity_index(ddb_client, table, destination: str, messageId: str, sig, summary: str, ttl_seconds: int):
+    """Make the summary findable by later similar emails, the newest email
+    takes over each band it lands in"""
+    expires_at = int(time.time()) + ttl_seconds
+    signature_bytes = minhash.to_bytes(sig)
+    items = [
+        {
+            "cache_key": band_cache_key(destination, band_key),
+            "messageId": messageId,
+            "signature": signature_bytes,
+            "summary": summary,
+            "expires_at": expires_at,
+        }
+        for band_key in minhash.band_keys(sig)
+    ]
+    try:
+        batch_write_items(ddb_client, table, items)
+    except (ClientError, RuntimeError) as e:
+        logger.warning(f"## Summary similarity index write failed: {e}")
@@ -0,0 +1,45 @@
+import json
+import time
+
+# What the summary worker needs to find the text and update every row
+SUMMARY_JOB_FIELDS = (
+    "destination",
+    "messageId",
+    "recipients",
+    "bucketName",
+    "bucketObjectKey",
+    "artifactObjectKey",
+    "text_body",
+    "text_type",
+)
+
+# Per address summarize_mode, summaries are made for every incoming email
+# or only when an email is first opened
+SUMMARIZE_ON_INGEST = "ingest"
+SUMMARIZE_ON_READ = "on_read"
+SUMMARIZE_MODES = (SUMMARIZE_ON_INGEST, SUMMARIZE_ON_READ)
+# Seconds after which a summary request that got no answer, such as a job
+# that ended up in the dead letter queue, is no longer pending and can be
+# made again
+SUMMARY_REQUEST_EXPIRY = 15 * 60
+
+
+def queue_summary(sqs, queue_url: str, message, on_read: bool = False):
+    """Send the summary job of a stored email to the summary worker"""
+    job = {field: message[field] for field in SUMMARY_JOB_FIELDS if field in message}
+    if on_read:
+        job["on_read"] = True
+    sqs.send_message(QueueUrl=queue_url, MessageBody=json.dumps(job, default=str))
+
+
+def summary_state(item):
+    """Summary of an email row, or the text generated so far while the
+    summary worker streams it"""
+    if "summary_text" in item:
+        return {"summary": item["summary_text"], "partial": None, "pending": False}
+    requested_at = item.get("summary_requested_at")
+    return {
+        "summary": None,
+        "partial": item.get("summary_partial"),
+        "pending": requested_at is not None and requested_at >= int(time.time()) - SUMMARY_REQUEST_EXPIRY,
+    }
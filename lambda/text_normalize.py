@@ -0,0 +1,130 @@
+import re
+from html.parser import HTMLParser
+
+from reply_extract import latest_content
+
+# Bracketed links, quote markers at line starts (also when a removed link
+# stood between the line break and the marker), any other ">" and runs of
+# spaces or tabs. Adjacent noise is matched as one run so the whitespace
+# around a removed link collapses to a single space, as it did when each
+# rule was a separate re.sub over the whole body. Whitespace inside a link
+# goes with the link.
+LINK = r"<https?://[^>]*>"
+NOISE = re.compile(rf"(?:{LINK}|\n(?:{LINK})*>|>+|[ \t]+)+")
+LINKS = re.compile(LINK)
+WHITESPACE = re.compile(r"[ \t]")
+HTML_FEED_SIZE = 16 * 1024
+HTML_REPLY_FACTOR = 4
+# Characters of the snippet shown in the email list
+PREVIEW_LENGTH = 160
+
+BLOCK_TAGS = frozenset(
+    (
+        "address", "article", "aside", "blockquote", "br", "dd", "div", "dl",
+        "dt", "footer", "h1", "h2", "h3", "h4", "h5", "h6", "header", "hr",
+        "li", "ol", "p", "pre", "section", "table", "td", "th", "tr", "ul",
+    )
+)
+SKIP_TAGS = frozenset(("head", "script", "style", "template", "title"))
+
+
+def normalize_text(text: str, limit: int) -> str:
+    """Strip links and quote markers and collapse whitespace in one pass
+
+    Scanning stops once limit characters of output exist, so the cost
+    depends on the limit rather than on the size of the body.
+    """
+    pieces = []
+    size = 0
+    position = 0
+    for match in NOISE.finditer(text):
+        kept = text[position : match.start()]
+        pieces.append(kept)
+        size += len(kept)
+        if size >= limit:
+            break
+        if WHITESPACE.search(LINKS.sub("", match.group())):
+            pieces.append(" ")
+            size += 1
+        position = match.end()
+    else:
+        pieces.append(text[position : position + limit - size])
+    return "".join(pieces)[:limit]
+
+
+class _TextExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.pieces = []
+        self.size = 0
+        self.skip_depth = 0
+        # Whitespace seen since the last word, data can end mid-word at the
+        # end of a fed slice
+        self.space = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIP_TAGS:
+            self.skip_depth += 1
+        elif tag in BLOCK_TAGS:
+            self.newline()
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in BLOCK_TAGS:
+            self.newline()
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TAGS:
+            self.skip_depth = max(self.skip_depth - 1, 0)
+        elif tag in BLOCK_TAGS:
+            self.newline()
+
+    def handle_data(self, data):
+        if self.skip_depth:
+            return
+        # Runs of markup whitespace are a single space, line breaks come
+        # from block tags
+        if data[:1].isspace():
+            self.space = True
+        words = data.split()
+        if words:
+            text = " ".join(words)
+            if self.space and self.pieces and self.pieces[-1] != "\n":
+                text = " " + text
+            self.pieces.append(text)
+            self.size += len(text)
+            self.space = data[-1].isspace()
+
+    def newline(self):
+        self.space = False
+        if self.pieces and self.pieces[-1] != "\n":
+            self.pieces.append("\n")
+            self.size += 1
+
+
+def html_to_text(html: str, limit: int) -> str:
+    """Visible text of an HTML body, parsing only as much as limit needs"""
+    parser = _TextExtractor()
+    for start in range(0, len(html), HTML_FEED_SIZE):
+        parser.feed(html[start : start + HTML_FEED_SIZE])
+        if parser.size >= limit:
+            break
+    else:
+        parser.close()
+    return "".join(parser.pieces).strip()[:limit]
+
+
+def prompt_text(text: str, text_type, limit: int) -> str:
+    """Newest content of the body as sent to the model, at most limit characters"""
+    if text_type == "html":
+        # Quoted history is usually most of a reply, convert enough of it
+        # for the newest content to still fill the limit
+        return latest_content(html_to_text(text, limit * HTML_REPLY_FACTOR))[:limit]
+    return normalize_text(latest_content(text), limit)
+
+
+def email_preview(text: str, text_type, length: int = PREVIEW_LENGTH) -> str:
+    """One line snippet of the newest content of the body for the list view"""
+    if not text:
+        return ""
+    # Extra room for the whitespace collapsed below
+    return " ".join(prompt_text(text, text_type, length * 2).split())[:length]
@@ -0,0 +1,43 @@
+import time
+import threading
+
+
+class TokenBucket:
+    """Paces work by a budget of units per second, shared by the threads of
+    one container
+
+    A bucket with a rate of 0 never waits.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount: float, timeout: float) -> bool:
+        """Take amount tokens, waiting at most timeout seconds for them
+
+        Requests larger than the capacity are capped to it so they can
+        still run once the bucket is full.
+        """
+        if self.rate <= 0:
+            return True
+        amount = min(amount, self.capacity)
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return True
+                wait = (amount - self.tokens) / self.rate
+            if now + wait > deadline:
+                return False
+            time.sleep(wait)
@@ -1,10 +1,15 @@
 import json
 import os
+import time
+import random
 import logging
+from decimal import Decimal
 from typing import Dict, Any, Union
 
 from aws_xray_sdk.core import xray_recorder, patch_all
 
+from summary_queue import SUMMARIZE_ON_READ
+
 if os.environ.get("XRAY_ENABLED", "false").lower() == "true":
     XRAY_NAME = os.environ.get("XRAY_NAME", "email-catcher")
     xray_recorder.configure(service=XRAY_NAME)
@@ -15,6 +20,17 @@ logger = logging.getLogger()
 logger.setLevel(LOGGING_LEVEL)
 
 
+def _json_default(value):
+    # DynamoDB numbers, such as attachment sizes and counters, come back as
+    # Decimal
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    # Handlers answer 500 with the exception as body
+    if isinstance(value, Exception):
+        return str(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
 def create_response(
     status_code: int,
     body: Union[str, Dict[str, Any]],
@@ -31,7 +47,7 @@ def create_response(
 
     return {
         "statusCode": status_code,
-        "body": json.dumps(body) if jsonify_body is True else body,
+        "body": json.dumps(body, default=_json_default) if jsonify_body is True else body,
         "headers": additional_headers,
     }
 
@@ -53,25 +69,95 @@ def check_access(table_addresses, user_sub, destination, full_response=False):
         raise e
 
 
-def check_summarize(table_addresses, destination):
-    try:
-        response = table_addresses.get_item(Key={"address": destination})
-        item = response.get("Item", None)
-        if item:
-            summarize = item.get("summarize_emails", None)
-            if summarize:
-                if summarize == True:
-                    logger.info("## SUMMARIZE EMAIL, CONTINUE")
-                    return True
-                else:
-                    logger.info("## DONT SUMMARIZE EMAIL")
-                    return False
-            return False
-    except Exception as e:
-        logger.error("## DynamoDB Client Exception")
-        logger.exception(e)
-        raise e
+def wants_summary(address_item, on_read=False) -> bool:
+    """Whether an address asks for a summary of its email now, addresses in
+    the on_read summarize mode only get summaries for emails being opened"""
+    if not address_item or address_item.get("summarize_emails") is not True:
+        return False
+    return on_read or address_item.get("summarize_mode") != SUMMARIZE_ON_READ
+
+
+def summarize_recipients(ddb_client, table_addresses, recipients, on_read=False) -> list:
+    """The recipients of an email whose address settings ask for its summary"""
+    found = batch_get_addresses(
+        ddb_client, table_addresses, recipients, projection="address, summarize_emails, summarize_mode"
+    )
+    wanted = [recipient for recipient in recipients if wants_summary(found.get(recipient), on_read)]
+    logger.info(f"## Summary wanted by {len(wanted)} of {len(recipients)} recipients")
+    return wanted
+
+
+BATCH_GET_LIMIT = 100
+BATCH_WRITE_LIMIT = 25
+BATCH_RETRY_ATTEMPTS = 8
+
+
+def backoff(attempt: int, base: float = 0.05, cap: float = 2.0):
+    """Sleep with full jitter before retrying unprocessed batch items"""
+    time.sleep(random.uniform(0, min(cap, base * 2**attempt)))
+
+
+def batch_get_addresses(ddb_client, table_addresses, addresses, projection="address"):
+    """Fetch address items with BatchGetItem, 100 keys per request
+
+    :return: dict of address to item for the addresses that exist
+    """
+    found = {}
+    addresses = list(dict.fromkeys(addresses))
+    for start in range(0, len(addresses), BATCH_GET_LIMIT):
+        request = {
+            table_addresses.name: {
+                "Keys": [{"address": address} for address in addresses[start : start + BATCH_GET_LIMIT]],
+                "ProjectionExpression": projection,
+            }
+        }
+        attempt = 0
+        while request:
+            response = ddb_client.batch_get_item(RequestItems=request)
+            for item in response["Responses"].get(table_addresses.name, []):
+                found[item["address"]] = item
+            request = response.get("UnprocessedKeys")
+            if request:
+                attempt += 1
+                if attempt > BATCH_RETRY_ATTEMPTS:
+                    raise RuntimeError("Unprocessed keys left after retries")
+                backoff(attempt)
+    return found
+
+
+def batch_write_items(ddb_client, table, items):
+    """Put items with BatchWriteItem, 25 per request, retrying unprocessed items"""
+    for start in range(0, len(items), BATCH_WRITE_LIMIT):
+        request = {
+            table.name: [{"PutRequest": {"Item": item}} for item in items[start : start + BATCH_WRITE_LIMIT]]
+        }
+        attempt = 0
+        while request:
+            response = ddb_client.batch_write_item(RequestItems=request)
+            request = response.get("UnprocessedItems")
+            if request:
+                attempt += 1
+                if attempt > BATCH_RETRY_ATTEMPTS:
+                    raise RuntimeError("Unprocessed items left after retries")
+                backoff(attempt)
 
 
 def get_user_sub_from_event(event):
     return event["requestContext"]["authorizer"]["claims"]["sub"]
+
+
+def get_record_message(record):
+    """SES notification carried by an ingest record
+
+    Records come from the ingest queue, with raw message delivery from the
+    SNS topic, or straight from the topic for a direct subscription.
+    """
+    if "Sns" in record:
+        return record["Sns"]["Message"]
+    return record["body"]
+
+
+def get_record_id(record):
+    if "Sns" in record:
+        return record["Sns"]["MessageId"]
+    return record["messageId"]
@@ -14,6 +14,13 @@ PULUMI_ORG = "PULUMI_ORG"
 PULUMI_PROJECT_NAME = "PULUMI_PROJECT_NAME"
 PULUMI_PROJECT_DESC = "pulumi code to support and deploy the email catcher"
 PULUMI_WORK_DIR = os.path.join(os.path.dirname(__file__), ".")
+# The layer holds native wheels (numpy), they are fetched for the Lambda
+# runtime rather than the machine deploying. Keep in step with
+# LAMBDA_PYTHON_VERSION in config.py. Recent numpy only ships
+# manylinux_2_28 wheels, which the python3.12 runtime (Amazon Linux 2023)
+# supports
+LAYER_PLATFORMS = ["manylinux2014_x86_64", "manylinux_2_28_x86_64"]
+LAYER_PYTHON_VERSION = "3.12"
 
 pulumi_yaml_settings = {
     "name": PULUMI_PROJECT_NAME,
@@ -191,6 +198,12 @@ def main(stack_name: str, command: str, region: str, force: bool):
             "./lambda/requirements.txt",
             "-t",
             "./code_layer/python",
+            *[arg for platform in LAYER_PLATFORMS for arg in ("--platform", platform)],
+            "--python-version",
+            LAYER_PYTHON_VERSION,
+            "--implementation",
+            "cp",
+            "--only-binary=:all:",
         ],
         check=True,
         cwd=f"{PULUMI_WORK_DIR}",
@@ -16,6 +16,32 @@ bucket_emails = aws.s3.BucketV2(
 )
 pulumi.export("emails_bucket_name", bucket_emails.bucket)
 
+# Streamed attachment extraction uses multipart uploads, clean up any that a
+# failed invocation could not abort itself. Stored mail lives in incoming_mail/
+# as well as stored_emails/ depending on the ingest layout, neither prefix may
+# be expired here.
+aws.s3.BucketLifecycleConfigurationV2(
+    f"{local_name}_emails_lifecycle",
+    bucket=bucket_emails.id,
+    rules=[
+        aws.s3.BucketLifecycleConfigurationV2RuleArgs(
+            id="abort-incomplete-multipart-uploads",
+            status="Enabled",
+            filter=aws.s3.BucketLifecycleConfigurationV2RuleFilterArgs(prefix=""),
+            abort_incomplete_multipart_upload=aws.s3.BucketLifecycleConfigurationV2RuleAbortIncompleteMultipartUploadArgs(
+                days_after_initiation=1
+            ),
+        ),
+        # Leftovers of attachment uploads interrupted before being moved to their digest
+        aws.s3.BucketLifecycleConfigurationV2RuleArgs(
+            id="expire-temporary-blobs",
+            status="Enabled",
+            filter=aws.s3.BucketLifecycleConfigurationV2RuleFilterArgs(prefix="blobs/tmp/"),
+            expiration=aws.s3.BucketLifecycleConfigurationV2RuleExpirationArgs(days=1),
+        ),
+    ],
+)
+
 aws.s3.BucketPolicy(
     f"{local_name}_emails_policy",
     bucket=bucket_emails.id,
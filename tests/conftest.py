@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The Lambda modules are flat files deployed from lambda/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "lambda"))
@@ -0,0 +1,113 @@
+import io
+import json
+
+import pytest
+from botocore.exceptions import ClientError
+
+import address_index
+from address_index import (
+    BLOOM_ERROR_RATE,
+    FEED_KEY,
+    BloomFilter,
+    append_changes,
+    load_feed,
+)
+
+
+def test_bloom_has_no_false_negatives():
+    bloom = BloomFilter.for_capacity(1000)
+    addresses = [f"user{n}@example.com" for n in range(1000)]
+    for address in addresses:
+        bloom.add(address)
+    assert all(address in bloom for address in addresses)
+
+
+def test_bloom_false_positive_rate():
+    bloom = BloomFilter.for_capacity(5000)
+    for n in range(5000):
+        bloom.add(f"user{n}@example.com")
+    false_positives = sum(f"other{n}@example.org" in bloom for n in range(20000))
+    assert false_positives / 20000 < BLOOM_ERROR_RATE * 2
+
+
+def test_bloom_round_trip():
+    bloom = BloomFilter.for_capacity(100)
+    bloom.add("inbox@example.com")
+    bloom.removed = 3
+    copy = BloomFilter.from_bytes(bloom.to_bytes())
+    assert (copy.size, copy.hashes, copy.count, copy.removed) == (bloom.size, bloom.hashes, 1, 3)
+    assert "inbox@example.com" in copy
+    assert copy.bits == bloom.bits
+
+
+def test_bloom_rejects_unknown_format():
+    data = bytearray(BloomFilter.for_capacity(100).to_bytes())
+    data[:4] = b"XXXX"
+    with pytest.raises(ValueError):
+        BloomFilter.from_bytes(bytes(data))
+
+
+class ConditionalS3:
+    """S3 objects with ETags and conditional puts, a concurrent writer can
+    be slipped in after the next read"""
+
+    def __init__(self):
+        self.objects = {}
+        self.version = 0
+        self.interleave = []
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise ClientError({"Error": {"Code": "NoSuchKey", "Message": ""}}, "GetObject")
+        body, etag = self.objects[Key]
+        result = {"Body": io.BytesIO(body), "ETag": etag}
+        if self.interleave:
+            self.interleave.pop(0)()
+        return result
+
+    def put_object(self, Bucket, Key, Body, ContentType, IfMatch=None, IfNoneMatch=None):
+        current = self.objects.get(Key)
+        if (IfNoneMatch == "*" and current is not None) or (IfMatch is not None and (current is None or current[1] != IfMatch)):
+            raise ClientError({"Error": {"Code": "PreconditionFailed", "Message": ""}}, "PutObject")
+        self.version += 1
+        self.objects[Key] = (Body, f'"{self.version}"')
+
+
+def test_concurrent_feed_appends_are_kept(monkeypatch):
+    monkeypatch.setattr(address_index, "backoff", lambda attempt: None)
+    s3 = ConditionalS3()
+    append_changes(s3, "bucket", ["a@example.com"], now=100)
+    # Another shard appends between this writer's read and its put
+    s3.interleave.append(lambda: append_changes(s3, "bucket", ["b@example.com"], now=101))
+    append_changes(s3, "bucket", ["c@example.com"], now=102)
+    addresses = [entry["address"] for entry in load_feed(s3, "bucket")["entries"]]
+    assert sorted(addresses) == ["a@example.com", "b@example.com", "c@example.com"]
+
+
+def test_feed_update_gives_up(monkeypatch):
+    monkeypatch.setattr(address_index, "backoff", lambda attempt: None)
+    s3 = ConditionalS3()
+    s3.objects[FEED_KEY] = (json.dumps(address_index.empty_feed()).encode(), '"0"')
+    # Every read is overtaken by another write
+    s3.interleave.extend(
+        [lambda: s3.put_object("bucket", FEED_KEY, s3.objects[FEED_KEY][0], "application/json")]
+        * address_index.UPDATE_ATTEMPTS
+    )
+    with pytest.raises(RuntimeError):
+        append_changes(s3, "bucket", ["a@example.com"], now=100)
+
+
+def test_snapshot_behind_change_feed_is_not_current():
+    from datetime import datetime, timezone
+
+    class SnapshotS3:
+        def get_object(self, Bucket, Key):
+            body = BloomFilter.for_capacity(10).to_bytes()
+            return {"Body": io.BytesIO(body), "ETag": '"1"', "LastModified": datetime.fromtimestamp(200, timezone.utc)}
+
+    reader = address_index.BloomSnapshotReader(SnapshotS3(), "bucket", poll_interval=5)
+    assert not reader.is_current(None)
+    reader.poll()
+    assert reader.is_current(None)
+    assert reader.is_current(150)
+    assert not reader.is_current(250)
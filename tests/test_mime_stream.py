@@ -0,0 +1,84 @@
+import email
+from email import policy
+from email.message import EmailMessage
+
+import pytest
+
+from mime_stream import MimeStreamParser, stream_decoder
+
+
+def build_message(linesep="\n") -> bytes:
+    message = EmailMessage()
+    message["From"] = "sender@example.org"
+    message["To"] = "inbox@example.com"
+    message["Subject"] = "Round trip"
+    message.set_content("Plain text with a long line " + "x" * 200 + "\n--not a boundary\n", cte="quoted-printable")
+    message.add_alternative("<p>Hello <b>world</b></p>\n", subtype="html")
+    message.add_attachment(bytes(range(256)) * 40, maintype="application", subtype="octet-stream", filename="a.bin")
+    inner = EmailMessage()
+    inner["Subject"] = "Forwarded"
+    inner.set_content("Nested body\n")
+    inner.add_attachment(b"%PDF-1.4 " * 500, maintype="application", subtype="pdf", filename="b.pdf")
+    message.add_attachment(inner)
+    return message.as_bytes(policy=policy.default.clone(linesep=linesep))
+
+
+def parse(raw: bytes, chunk_size: int):
+    """Raw bytes and decoded leaf payloads of raw, fed chunk_size bytes at a
+    time"""
+    parser = MimeStreamParser()
+    events = []
+    for start in range(0, len(raw), chunk_size):
+        events.extend(parser.feed(raw[start : start + chunk_size]))
+    events.extend(parser.close())
+
+    output = []
+    payloads = {}
+    content_types = {}
+    decoders = {}
+    order = []
+    for event in events:
+        if event[0] == "raw":
+            output.append(event[1])
+        elif event[0] == "headers":
+            part = event[1]
+            if not part.is_multipart:
+                decoders[id(part)] = stream_decoder(part.headers.get("Content-Transfer-Encoding"))
+                payloads[id(part)] = b""
+                content_types[id(part)] = part.headers.get_content_type()
+                order.append(id(part))
+        elif event[0] == "body":
+            part, data = event[1], event[2]
+            output.append(data)
+            payloads[id(part)] += decoders[id(part)].decode(data)
+        elif event[0] == "end" and id(event[1]) in decoders:
+            payloads[id(event[1])] += decoders.pop(id(event[1])).flush()
+    leaves = []
+    for key in order:
+        if content_types[key] == "message/rfc822":
+            # Attached messages are a single leaf, the email package descends into them
+            leaves.extend(parse(payloads[key], chunk_size)[1])
+        else:
+            leaves.append(payloads[key])
+    return b"".join(output), leaves
+
+
+def stdlib_payloads(raw: bytes):
+    message = email.message_from_bytes(raw, policy=policy.compat32)
+    return [part.get_payload(decode=True) for part in message.walk() if not part.is_multipart()]
+
+
+@pytest.mark.parametrize("linesep", ["\n", "\r\n"])
+@pytest.mark.parametrize("chunk_size", [1, 7, 64, 4096, 1 << 20])
+def test_round_trip_matches_email_package(linesep, chunk_size):
+    raw = build_message(linesep)
+    output, payloads = parse(raw, chunk_size)
+    assert output == raw
+    assert payloads == stdlib_payloads(raw)
+
+
+def test_message_without_headers_end():
+    raw = b"Subject: truncated\r\nX-Header: value"
+    output, payloads = parse(raw, 5)
+    assert output == raw
+    assert payloads == [b""]
@@ -0,0 +1,47 @@
+from decimal import Decimal
+
+import pytest
+
+from page_cursor import InvalidCursor, decode_cursor, encode_cursor
+
+KEY = b"k" * 32
+SCOPE = "inbox@example.com"
+LAST_KEY = {"destination": SCOPE, "messageId": "abc", "visible_at": Decimal(1700000000)}
+
+
+def test_round_trip():
+    cursor = encode_cursor(KEY, SCOPE, LAST_KEY)
+    assert decode_cursor(KEY, SCOPE, cursor) == {**LAST_KEY, "visible_at": 1700000000}
+
+
+def test_rejects_other_scope():
+    cursor = encode_cursor(KEY, SCOPE, LAST_KEY)
+    with pytest.raises(InvalidCursor):
+        decode_cursor(KEY, "other@example.com", cursor)
+
+
+def test_rejects_other_key():
+    cursor = encode_cursor(KEY, SCOPE, LAST_KEY)
+    with pytest.raises(InvalidCursor):
+        decode_cursor(b"x" * 32, SCOPE, cursor)
+
+
+def test_rejects_tampered_payload():
+    # Rescoped payload carrying the original signature
+    forged = encode_cursor(KEY, "other@example.com", LAST_KEY).split(".")[0]
+    signature = encode_cursor(KEY, SCOPE, LAST_KEY).split(".")[1]
+    with pytest.raises(InvalidCursor):
+        decode_cursor(KEY, "other@example.com", f"{forged}.{signature}")
+
+
+def test_rejects_tampered_signature():
+    payload, signature = encode_cursor(KEY, SCOPE, LAST_KEY).split(".")
+    flipped = ("A" if signature[0] != "A" else "B") + signature[1:]
+    with pytest.raises(InvalidCursor):
+        decode_cursor(KEY, SCOPE, f"{payload}.{flipped}")
+
+
+@pytest.mark.parametrize("cursor", ["", "nodot", "a.b.c", "!!!.???"])
+def test_rejects_malformed(cursor):
+    with pytest.raises(InvalidCursor):
+        decode_cursor(KEY, SCOPE, cursor)
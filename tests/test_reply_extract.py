@@ -0,0 +1,16 @@
+import os
+import json
+
+import pytest
+
+from reply_extract import latest_content
+
+FIXTURES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks", "fixtures")
+
+with open(os.path.join(FIXTURES, "reply_extract.json"), encoding="utf-8") as fixture_file:
+    CASES = json.load(fixture_file)
+
+
+@pytest.mark.parametrize("case", CASES, ids=[case["name"] for case in CASES])
+def test_latest_content(case):
+    assert latest_content(case["text"]) == case["expected"]
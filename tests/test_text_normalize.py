@@ -0,0 +1,60 @@
+import re
+import random
+
+import pytest
+
+import text_normalize
+from text_normalize import html_to_text, normalize_text
+
+
+def chained_re_sub(email_body: str, char_limit: int) -> str:
+    """The summarizer's cleanup before it was fused into normalize_text"""
+    email_body = re.sub(r"<https?://[^>]*>", "", email_body)
+    email_body = re.sub(r"\n>", "", email_body)
+    email_body = re.sub(r">+", "", email_body)
+    email_body = re.sub(r"[ \t]+", " ", email_body)
+    return email_body[:char_limit]
+
+
+FRAGMENTS = ["<http://", "<https://x", ">", "\n", "\n>", " ", "\t", "a", "b", "<", "http://", " <http://x y>", "word "]
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "<<http://x><http://x>b<http://a <http://x><http://q>",
+        "See <https://example.org/a b> here\n> quoted\n>> twice",
+        "a \n<http://x>> b",
+        "trailing   \t ",
+        "",
+    ],
+)
+def test_matches_chained_re_sub(text):
+    assert normalize_text(text, 1000) == chained_re_sub(text, 1000)
+
+
+def test_matches_chained_re_sub_on_random_text():
+    rng = random.Random(16)
+    for _ in range(20000):
+        text = "".join(rng.choice(FRAGMENTS) for _ in range(rng.randint(0, 40)))
+        limit = rng.choice([1, 5, 20, 1000])
+        assert normalize_text(text, limit) == chained_re_sub(text, limit), (text, limit)
+
+
+def test_html_skips_invisible_and_breaks_at_blocks():
+    html = "<html><head><title>T</title><style>p{}</style></head><body><p>Hello <b>big</b>\n world</p><div>x&amp;y</div><b>a</b>b<br>c</body></html>"
+    assert html_to_text(html, 1000) == "Hello big world\nx&y\nab\nc"
+
+
+def test_html_words_survive_feed_slices(monkeypatch):
+    rng = random.Random(2)
+    pieces = ["alpha", "beta", "<b>gamma</b>", " ", "\n", "<p>", "&amp;", "<br>", "delta "]
+    html = "".join(rng.choice(pieces) for _ in range(2000))
+    expected = html_to_text(html, 10**6)
+    for feed_size in (1, 3, 17, 64):
+        monkeypatch.setattr(text_normalize, "HTML_FEED_SIZE", feed_size)
+        assert html_to_text(html, 10**6) == expected
+
+
+def test_html_limit():
+    assert html_to_text("<p>" + "word " * 1000 + "</p>", 20) == "word word word word "
@@ -0,0 +1,66 @@
+import pytest
+
+import token_bucket
+from token_bucket import TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(token_bucket.time, "monotonic", clock.monotonic)
+    monkeypatch.setattr(token_bucket.time, "sleep", clock.sleep)
+    return clock
+
+
+def test_zero_rate_never_waits(clock):
+    bucket = TokenBucket(rate=0, capacity=10)
+    assert all(bucket.acquire(10, timeout=0) for _ in range(100))
+    assert clock.now == 1000.0
+
+
+def test_full_bucket_does_not_wait(clock):
+    bucket = TokenBucket(rate=1, capacity=10)
+    assert bucket.acquire(10, timeout=0)
+    assert clock.now == 1000.0
+
+
+def test_waits_for_refill(clock):
+    bucket = TokenBucket(rate=2, capacity=10)
+    assert bucket.acquire(10, timeout=0)
+    assert bucket.acquire(4, timeout=5)
+    assert clock.now == pytest.approx(1002.0)
+
+
+def test_gives_up_past_timeout(clock):
+    bucket = TokenBucket(rate=1, capacity=10)
+    assert bucket.acquire(10, timeout=0)
+    assert not bucket.acquire(5, timeout=4)
+    # Nothing was taken, the budget is there once it refilled
+    clock.now += 5
+    assert bucket.acquire(5, timeout=0)
+
+
+def test_refill_is_capped(clock):
+    bucket = TokenBucket(rate=1, capacity=10)
+    assert bucket.acquire(10, timeout=0)
+    clock.now += 1000
+    assert bucket.acquire(10, timeout=0)
+    assert not bucket.acquire(1, timeout=0)
+
+
+def test_oversized_request_is_capped(clock):
+    bucket = TokenBucket(rate=1, capacity=10)
+    assert bucket.acquire(50, timeout=0)
+    assert bucket.acquire(50, timeout=10)
+    assert clock.now == pytest.approx(1010.0)